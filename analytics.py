@@ -0,0 +1,117 @@
+# Аналітика надійності на NumPy: MTBF, MTTR, перцентилі тривалості, теплова карта
+# відключень за днем тижня і годиною, серії днів без відключень.
+#
+# Усе рахується масивами без циклу по рядках: час без світла до моменту x - це
+# префіксна сума тривалостей плюс частина відключення, в яке x потрапляє
+# (searchsorted), тож погодинна сітка за кілька років - кілька векторних операцій.
+# NumPy - необов'язкова залежність: myhome імпортує модуль лише на запит /api/analytics.
+
+import numpy as np
+
+PERCENTILES = (50, 90, 95, 99)
+
+def normalize(starts, ends, t0, t1):
+    # Обрізаємо до [t0, t1), сортуємо і зливаємо перекриття - далі інтервали не перетинаються
+    s = np.clip(np.asarray(starts, dtype=np.float64), t0, t1)
+    e = np.clip(np.asarray(ends, dtype=np.float64), t0, t1)
+    keep = e > s
+    s, e = s[keep], e[keep]
+    order = np.argsort(s, kind="stable")
+    s, e = s[order], e[order]
+    if len(s) < 2:
+        return s, e
+    reach = np.maximum.accumulate(e)
+    new = np.empty(len(s), dtype=bool)
+    new[0] = True
+    new[1:] = s[1:] > reach[:-1]
+    groups = np.cumsum(new) - 1
+    merged_e = np.zeros(groups[-1] + 1)
+    np.maximum.at(merged_e, groups, e)
+    return s[new], merged_e
+
+def off_before(s, e, x):
+    # Секунд без світла до кожного моменту x (s, e - після normalize)
+    if not len(s):
+        return np.zeros(len(x))
+    cum = np.concatenate(([0.0], np.cumsum(e - s)))
+    k = np.searchsorted(s, x, side="right")   # скільки відключень почалось до x
+    i = np.maximum(k - 1, 0)
+    inside = np.where(k > 0, np.minimum(x - s[i], e[i] - s[i]), 0.0)
+    return cum[i] + inside
+
+def local_time(ts, utcoffset):
+    # utcoffset(ts) -> секунди. Питаємо раз на добу, а погодинно - лише в добу переходу DST
+    if not len(ts):
+        return ts.copy()
+    day = ts // 86400
+    days = np.arange(day.min(), day.max() + 2)
+    day_off = np.array([utcoffset(int(d) * 86400) for d in days], dtype=np.int64)
+    offsets = day_off[day - days[0]]
+    for i in np.nonzero(day_off[:-1] != day_off[1:])[0]:
+        sel = day == days[i]
+        offsets[sel] = [utcoffset(int(t)) for t in ts[sel]]
+    return ts + offsets
+
+def runs(flags):
+    # Довжини серій True поспіль
+    padded = np.concatenate(([False], flags, [False])).astype(np.int8)
+    edges = np.diff(padded)
+    return np.nonzero(edges == -1)[0] - np.nonzero(edges == 1)[0]
+
+def stat(values, scale=1.0):
+    if not len(values):
+        return None
+    values = np.asarray(values) / scale
+    return {"mean": round(float(values.mean()), 2), "max": round(float(values.max()), 2),
+            **{f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}}
+
+def reliability(starts, ends, t0, t1, utcoffset):
+    """Метрики одного пристрою за [t0, t1) (epoch-секунди).
+
+    starts/ends - відключення, що перетинаються з діапазоном, разом з поточним
+    (кінець - t1). Тривалості - у хвилинах, MTBF - у годинах.
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    # Відмова = відключення, що почалось у діапазоні; MTTR - за повною тривалістю
+    started = (starts >= t0) & (starts < t1)
+    durations = ends[started] - starts[started]
+    s, e = normalize(starts, ends, t0, t1)
+    off_total = float((e - s).sum())
+    span = t1 - t0
+
+    # Погодинна сітка: час без світла в кожній годині UTC (зміщення Києва - цілі години)
+    hours = np.arange(t0 // 3600 * 3600, t1 if t1 > t0 else 0, 3600, dtype=np.int64)
+    lo = np.maximum(hours, t0)
+    hi = np.minimum(hours + 3600, t1)
+    off = off_before(s, e, hi) - off_before(s, e, lo)
+    local = local_time(hours, utcoffset)
+    weekday = (local // 86400 + 3) % 7   # 01.01.1970 - четвер; 0 = понеділок
+    cell = weekday * 24 + local % 86400 // 3600
+    off_cells = np.bincount(cell, weights=off, minlength=168)
+    span_cells = np.bincount(cell, weights=hi - lo, minlength=168)
+    heatmap = np.divide(off_cells, span_cells, out=np.zeros(168), where=span_cells > 0)
+
+    # Серії діб (за місцевим часом) без жодної хвилини без світла
+    local_day = local // 86400
+    day_off = np.bincount(local_day - local_day[0], weights=off) if len(local_day) else np.zeros(0)
+    clean = runs(day_off == 0)
+    current = int(len(day_off) - np.nonzero(day_off)[0][-1] - 1) if day_off.any() else len(day_off)
+    lengths, counts = np.unique(clean, return_counts=True)
+
+    failures = int(started.sum())
+    uptime = span - off_total
+    # Безперервна робота між двома відключеннями (краї діапазону - неповні серії, не рахуємо)
+    gaps = s[1:] - e[:-1]
+    return {
+        "failures": failures,
+        "availability": round(uptime / span * 100, 3) if span > 0 else None,
+        "off_hours": round(off_total / 3600, 2),
+        "mtbf_hours": round(uptime / failures / 3600, 2) if failures else None,
+        "mttr_minutes": round(float(durations.mean()) / 60, 2) if failures else None,
+        "duration_minutes": stat(durations, 60),
+        "up_streak_hours": stat(gaps, 3600),
+        "heatmap": np.round(heatmap.reshape(7, 24), 4).tolist(),
+        "clean_day_streaks": {"longest": int(clean.max()) if len(clean) else 0, "current": current,
+                              "histogram": {int(k): int(v) for k, v in zip(lengths, counts)}},
+    }
@@ -0,0 +1,138 @@
+# Архів старих рядків SQLite: незмінні стиснуті сегменти на таблицю і місяць (UTC)
+# плюс невеликий manifest.json. Гарячу БД чистить retention-задача в myhome.py,
+# а читачі зливають рядки з БД і з сегментів, що потрапляють у діапазон.
+#
+# Сегмент <root>/<table>/<YYYYMM>-<seq>.jsonl.gz (gzip, рядок JSON на запис):
+#   {"table": ..., "month": ..., "columns": [...], "rows": n, "max_rowid": ...}
+#   [значення колонок], ... - за колонкою початку
+# Сегмент після запису не змінюється: рядки, що потрапили в уже заархівований місяць
+# пізніше, йдуть у наступний seq. Файл і маніфест пишуться через tmp + rename.
+#
+# Запис у маніфесті: file, table, month, rows, bytes, sha256, first (мін. початок),
+# max_end (макс. кінець), devices, max_rowid і purged (рядки вже видалені з БД).
+# max_rowid потрібен, щоб не задвоїти рядки між записом маніфесту і комітом DELETE.
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+MANIFEST = "manifest.json"
+
+def month_of(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y%m")
+
+def month_bounds(month):
+    # "YYYYMM" -> [початок, початок наступного) в epoch-секундах
+    y, m = int(month[:4]), int(month[4:])
+    start = datetime(y, m, 1, tzinfo=timezone.utc)
+    end = datetime(y + m // 12, m % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+class MonthlyArchive:
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.RLock()
+        self.entries = []
+        self.mtime = None
+
+    # --- маніфест ---
+
+    def manifest(self):
+        # Перечитуємо, лише якщо файл змінився (сегменти пише інший процес - лідер)
+        path = os.path.join(self.root, MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self.lock:
+            if mtime != self.mtime:
+                with open(path) as f:
+                    self.entries = json.load(f)["segments"]
+                self.mtime = mtime
+            return self.entries
+
+    def _save(self, entries):
+        path = os.path.join(self.root, MANIFEST)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "segments": entries}, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def segments(self, table, device_id=None, start=None, end=None):
+        # Сегменти таблиці, рядки яких можуть перетинатися з [start, end]
+        return [e for e in self.manifest()
+                if e["table"] == table
+                and (device_id is None or device_id in e["devices"])
+                and (start is None or e["max_end"] >= start)
+                and (end is None or e["first"] <= end)]
+
+    def covered(self, table):
+        # {month: max_rowid} - рядки БД з rowid <= max_rowid у цьому місяці вже в архіві
+        out = {}
+        for e in self.manifest():
+            if e["table"] == table:
+                out[e["month"]] = max(out.get(e["month"], 0), e["max_rowid"])
+        return out
+
+    # --- запис ---
+
+    def write(self, table, month, columns, rows, max_rowid, start_col, end_col):
+        """Пише сегмент з rows (списки значень за columns) і додає його в маніфест."""
+        s, e = columns.index(start_col), columns.index(end_col)
+        rows = sorted(rows, key=lambda r: r[s])
+        folder = os.path.join(self.root, table)
+        os.makedirs(folder, exist_ok=True)
+        with self.lock:
+            entries = list(self.manifest())
+            seq = sum(1 for x in entries if x["table"] == table and x["month"] == month)
+            name = f"{table}/{month}-{seq}.jsonl.gz"
+            path = os.path.join(self.root, name)
+            tmp = path + ".tmp"
+            header = {"table": table, "month": month, "columns": columns, "rows": len(rows), "max_rowid": max_rowid}
+            with open(tmp, "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=9, mtime=0) as f:
+                    f.write((json.dumps(header, ensure_ascii=False) + "\n").encode())
+                    for row in rows:
+                        f.write((json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n").encode())
+                raw.flush()
+                os.fsync(raw.fileno())
+            with open(tmp, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            os.replace(tmp, path)
+            entry = {"file": name, "table": table, "month": month, "rows": len(rows),
+                     "bytes": os.path.getsize(path), "sha256": digest,
+                     "first": rows[0][s], "max_end": max(r[e] for r in rows),
+                     "devices": sorted({r[columns.index("device_id")] for r in rows} - {None}),
+                     "max_rowid": max_rowid, "purged": False}
+            entries.append(entry)
+            self._save(entries)
+            self.entries, self.mtime = entries, os.stat(os.path.join(self.root, MANIFEST)).st_mtime_ns
+        return entry
+
+    def mark_purged(self, files):
+        with self.lock:
+            entries = [dict(e, purged=True) if e["file"] in files else e for e in self.manifest()]
+            self._save(entries)
+            self.entries, self.mtime = entries, os.stat(os.path.join(self.root, MANIFEST)).st_mtime_ns
+
+    # --- читання ---
+
+    def read(self, entry, start_col, end_col, device_id=None, start=None, end=None):
+        # Потоково: у пам'яті один рядок, а не весь сегмент
+        with gzip.open(os.path.join(self.root, entry["file"]), "rt", encoding="utf-8") as f:
+            columns = json.loads(f.readline())["columns"]
+            s, e, d = columns.index(start_col), columns.index(end_col), columns.index("device_id")
+            for line in f:
+                row = json.loads(line)
+                if device_id is not None and row[d] != device_id:
+                    continue
+                if start is not None and row[e] < start:
+                    continue
+                if end is not None and row[s] > end:
+                    break
+                yield dict(zip(columns, row))
@@ -0,0 +1,64 @@
+# Холодний старт процесу: імпорт myhome + create_app() для різних наборів підсистем.
+#
+# Кожен замір - новий інтерпретатор у тимчасовій копії репозиторію (чиста БД),
+# Telegram направлено на закритий локальний порт, тож мережі прогін не потребує.
+# Звіт: медіана і мінімум за --runs запусків і які важкі модулі опинились у процесі.
+#
+#     python bench/cold_start.py --runs 10
+#     python bench/cold_start.py --subsystems ingest ingest,web ingest,web,watchdog,bot
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+
+from run import prepare_tree
+
+HEAVY = ("telebot", "requests", "numpy", "jinja2")
+
+CHILD = """
+import json, os, sys, time
+started = time.perf_counter()
+import myhome
+imported = time.perf_counter()
+myhome.create_app(sys.argv[1])
+ready = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "ready_ms": (ready - started) * 1000,
+                  "modules": len(sys.modules), "heavy": [m for m in sys.argv[2:] if m in sys.modules]}))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+def measure(work, subsystems, runs):
+    env = dict(os.environ, TG_TOKEN="123456:bench", TG_CHAT_ID="1", API_SECRET="bench",
+               TG_API_URL="http://127.0.0.1:9", LOG_FILE="bench.log")
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", CHILD, subsystems, *HEAVY], cwd=work, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    ready = [s["ready_ms"] for s in samples]
+    return {"subsystems": subsystems, "ready_ms_p50": round(statistics.median(ready), 1),
+            "ready_ms_min": round(min(ready), 1),
+            "import_ms_p50": round(statistics.median(s["import_ms"] for s in samples), 1),
+            "modules": samples[-1]["modules"], "heavy": samples[-1]["heavy"]}
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time per subsystem set")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--subsystems", nargs="+", default=["ingest", "ingest,web", "ingest,web,watchdog,bot"])
+    args = parser.parse_args()
+    work = prepare_tree()
+    try:
+        for subsystems in args.subsystems:
+            r = measure(work, subsystems, args.runs)
+            print(f"{r['subsystems']:<26} ready p50 {r['ready_ms_p50']:>7.1f} ms  min {r['ready_ms_min']:>7.1f} ms"
+                  f"  (import {r['import_ms_p50']:.1f} ms, {r['modules']} modules, heavy: {', '.join(r['heavy']) or '-'})")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
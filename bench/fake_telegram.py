@@ -0,0 +1,112 @@
+# Заглушка Telegram Bot API для бенчмарків і локальних прогонів.
+#
+# Сервер запускається з TG_API_URL=http://127.0.0.1:8090 і шле все сюди, а не в
+# справжній Telegram. Кожен sendMessage записується з часом отримання, тож
+# bench/run.py рахує затримку сповіщень. --error-rate віддає частину відповідей
+# як 429 з retry_after (перевірка ретраїв Notifier).
+#
+#     python bench/fake_telegram.py --port 8090
+#     curl http://127.0.0.1:8090/_sent     # отримані повідомлення (JSON)
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+class FakeBotApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, error_rate=0.0, seed=0):
+        super().__init__(("127.0.0.1", port), FakeBotApiHandler)
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sent = []      # [{"at", "chat_id", "text", "message_id"}]
+        self.calls = {}     # метод -> кількість
+        self.rejected = 0
+        self.message_id = 0
+
+    def handle_error(self, request, client_address):
+        # Сервер зупинили посеред long polling - це не помилка заглушки
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True, name="FakeBotApi").start()
+        return self
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method in ("sendMessage", "sendDocument") and self.rng.random() < self.error_rate:
+                self.rejected += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}
+            if method in ("sendMessage", "sendDocument"):
+                self.message_id += 1
+                self.sent.append({"at": time.time(), "method": method, "chat_id": params.get("chat_id"),
+                                  "text": params.get("text", ""), "message_id": self.message_id})
+                return 200, {"ok": True, "result": {
+                    "message_id": self.message_id, "date": int(time.time()),
+                    "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                    "text": params.get("text", "")}}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench",
+                                                "username": "bench_bot"}}
+        if method == "getUpdates":
+            # Long polling: тримаємо запит, як справжній API, але недовго
+            time.sleep(min(float(params.get("timeout") or 0), 1.0))
+            return 200, {"ok": True, "result": []}
+        return 200, {"ok": True, "result": True}
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/_sent":
+            with self.server.lock:
+                self.reply(200, list(self.server.sent))
+            return
+        self.handle_api()
+
+    def do_POST(self):
+        self.handle_api()
+
+    def handle_api(self):
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        elif self.headers.get("Content-Type", "").startswith("application/json") and body:
+            params.update(json.loads(body))
+        # /bot<token>/<method>
+        method = url.path.rsplit("/", 1)[-1]
+        status, payload = self.server.call(method, params)
+        self.reply(status, payload)
+
+    def reply(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="частка відповідей 429 на send*")
+    args = parser.parse_args()
+    api = FakeBotApi(args.port, args.error_rate)
+    print(f"Fake Bot API on http://127.0.0.1:{args.port}")
+    api.serve_forever()
+
+if __name__ == "__main__":
+    main()
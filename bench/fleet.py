@@ -0,0 +1,140 @@
+# Симуляція парку ESP32: кожен пристрій - корутина з власним keep-alive з'єднанням.
+#
+# Сценарії (ймовірність на кожен такт пристрою, генератор детермінований від seed):
+#   reboot   - коротка пауза і пінг з новим boot_id (Software Reset / WDT / Panic);
+#   brownout - те саме з причиною "Brownout (Voltage Dip)";
+#   glitch   - мовчання довше TIMEOUT_SECONDS, але коротше порогу відключення (тех. збій);
+#   outage   - мовчання довше порогу відключення, потім "Power On" з новим boot_id.
+# Після duration пристрої ще drain секунд просто пінгують: сповіщення встигають
+# дійти, а кінець прогону не виглядає для сервера як масове відключення.
+# Журнал сценаріїв і затримки пінгів повертаються в bench/run.py для звіту.
+
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlsplit
+
+REBOOT_REASONS = ["Software Reset", "Watchdog (Task)", "Exception/Panic"]
+
+class FleetConfig:
+    def __init__(self, url, key, devices=100, duration=120.0, drain=30.0, interval=2.0, seed=1,
+                 p_reboot=0.002, p_brownout=0.002, p_glitch=0.002, p_outage=0.002,
+                 glitch_range=(8.0, 12.0), outage_range=(30.0, 45.0)):
+        self.url = url
+        self.key = key
+        self.devices = devices
+        self.duration = duration
+        self.drain = drain
+        self.interval = interval
+        self.seed = seed
+        self.p_reboot = p_reboot
+        self.p_brownout = p_brownout
+        self.p_glitch = p_glitch
+        self.p_outage = p_outage
+        self.glitch_range = glitch_range
+        self.outage_range = outage_range
+
+class FleetResult:
+    def __init__(self):
+        self.latencies = []     # секунди на пінг
+        self.statuses = {}      # HTTP статус -> кількість
+        self.errors = 0
+        self.scenarios = []     # {"device", "kind", "silent_from", "resumed_at"}
+
+class Connection:
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port, self.path, self.netloc = parts.hostname, parts.port or 80, parts.path, parts.netloc
+        self.reader = self.writer = None
+
+    async def post(self, payload):
+        body = json.dumps(payload).encode()
+        request = (f"POST {self.path} HTTP/1.1\r\nHost: {self.netloc}\r\nContent-Type: application/json\r\n"
+                   f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n").encode() + body
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(request)
+        await self.writer.drain()
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ")[1])
+        length, close = 0, lines[0].startswith("HTTP/1.0")
+        for line in lines[1:]:
+            k, _, v = line.partition(":")
+            if k.strip().lower() == "content-length":
+                length = int(v)
+            elif k.strip().lower() == "connection":
+                close = v.strip().lower() == "close"
+        if length:
+            await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def run_device(idx, cfg, result, scenarios_until, deadline):
+    rng = random.Random(cfg.seed * 1000003 + idx)
+    device_id = f"bench-{idx}"
+    conn = Connection(cfg.url)
+    boot = 0
+    boot_at = time.time()
+    pending = {"first": "1", "reason": "Power On"}
+
+    async def ping(extra):
+        payload = {"key": cfg.key, "device_id": device_id, "boot_id": f"{device_id}-{boot}",
+                   "uptime": int(time.time() - boot_at), "ip": f"10.{idx // 250 % 250}.{idx % 250}.1"}
+        payload.update(extra)
+        started = time.perf_counter()
+        try:
+            status = await conn.post(payload)
+            result.latencies.append(time.perf_counter() - started)
+            result.statuses[status] = result.statuses.get(status, 0) + 1
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            result.errors += 1
+            conn.close()
+
+    # Розносимо старт по інтервалу, як у реального парку
+    await asyncio.sleep(cfg.interval * idx / cfg.devices)
+    while time.time() < deadline:
+        await ping(pending)
+        pending = {}
+        roll = rng.random()
+        silence, kind = 0.0, None
+        if roll < cfg.p_outage:
+            kind, silence = "outage", rng.uniform(*cfg.outage_range)
+        elif roll < cfg.p_outage + cfg.p_glitch:
+            kind, silence = "glitch", rng.uniform(*cfg.glitch_range)
+        elif roll < cfg.p_outage + cfg.p_glitch + cfg.p_brownout:
+            kind, silence = "brownout", rng.uniform(1.0, 3.0)
+        elif roll < cfg.p_outage + cfg.p_glitch + cfg.p_brownout + cfg.p_reboot:
+            kind, silence = "reboot", rng.uniform(1.0, 3.0)
+
+        if kind is None or time.time() + silence > scenarios_until:
+            await asyncio.sleep(cfg.interval)
+            continue
+
+        silent_from = time.time()
+        conn.close()   # ESP без живлення/після ресету відкриває нове з'єднання
+        await asyncio.sleep(silence)
+        if kind == "glitch":
+            pending = {"reason": "N/A"}
+        else:
+            boot += 1
+            boot_at = time.time()
+            pending = {"first": "1", "reason": {"outage": "Power On", "brownout": "Brownout (Voltage Dip)"}
+                       .get(kind) or rng.choice(REBOOT_REASONS)}
+        result.scenarios.append({"device": device_id, "kind": kind, "silent_from": silent_from,
+                                 "resumed_at": time.time()})
+    conn.close()
+
+async def run_fleet(cfg):
+    result = FleetResult()
+    scenarios_until = time.time() + cfg.duration
+    deadline = scenarios_until + cfg.drain
+    await asyncio.gather(*(run_device(i, cfg, result, scenarios_until, deadline) for i in range(cfg.devices)))
+    return result
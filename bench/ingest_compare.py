@@ -0,0 +1,127 @@
+# Порівняння шляхів прийому heartbeat-ів: Flask /ping проти асинхронного приймача.
+#
+# Кожне з N з'єднань - окремий "ESP32" (device_id bench-N), що тримає keep-alive
+# і пінгує раз на --interval секунд. Запускати проти тестової БД:
+#
+#     ASYNC_INGEST_PORT=8081 python myhome.py
+#     python bench/ingest_compare.py --key $API_SECRET --connections 5000 --duration 30 \
+#         --target flask=http://127.0.0.1:5000/ping --target async=http://127.0.0.1:8081/ping
+
+import argparse
+import asyncio
+import json
+import resource
+import time
+from urllib.parse import urlsplit
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.reconnects = 0
+        self.connect_failures = 0
+        self.peak_open = 0
+        self.open = 0
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    length, close = 0, lines[0].startswith("HTTP/1.0")
+    for line in lines[1:]:
+        k, _, v = line.partition(":")
+        k, v = k.strip().lower(), v.strip().lower()
+        if k == "content-length":
+            length = int(v)
+        elif k == "connection":
+            close = v == "close"
+    if length:
+        await reader.readexactly(length)
+    return status, close
+
+async def device(idx, url, args, stats, deadline):
+    parts = urlsplit(url)
+    body = json.dumps({"key": args.key, "device_id": f"bench-{idx}", "uptime": 1000,
+                       "boot_id": f"boot-{idx}", "ip": "10.0.0.1"}).encode()
+    request = (f"POST {parts.path} HTTP/1.1\r\nHost: {parts.netloc}\r\nContent-Type: application/json\r\n"
+               f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n").encode() + body
+    reader = writer = None
+    # Розносимо перші пінги по інтервалу, як у реального парку
+    await asyncio.sleep(args.interval * idx / args.connections)
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+                stats.open += 1
+                stats.peak_open = max(stats.peak_open, stats.open)
+            writer.write(request)
+            await writer.drain()
+            status, close = await read_response(reader)
+            stats.latencies.append(time.perf_counter() - started)
+            if status != 200:
+                stats.errors += 1
+            if close:
+                writer.close()
+                stats.open -= 1
+                stats.reconnects += 1
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            if writer is None:
+                stats.connect_failures += 1
+            else:
+                writer.close()
+                stats.open -= 1
+                stats.errors += 1
+            writer = None
+        await asyncio.sleep(max(0, args.interval - (time.perf_counter() - started)))
+    if writer is not None:
+        writer.close()
+        stats.open -= 1
+
+async def run_target(name, url, args):
+    stats = Stats()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(device(i, url, args, stats, deadline) for i in range(args.connections)))
+    elapsed = time.perf_counter() - started
+    lat = [x * 1000 for x in stats.latencies]
+    return {"target": name, "requests": len(lat), "rps": len(lat) / elapsed,
+            "p50_ms": percentile(lat, 50), "p99_ms": percentile(lat, 99), "errors": stats.errors,
+            "connect_failures": stats.connect_failures, "reconnects": stats.reconnects,
+            "peak_connections": stats.peak_open}
+
+def main():
+    parser = argparse.ArgumentParser(description="Flask /ping vs async ingest")
+    parser.add_argument("--target", action="append", metavar="NAME=URL",
+                        help="може повторюватись; типово flask=:5000 і async=:8081")
+    parser.add_argument("--key", required=True, help="API_SECRET сервера")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--interval", type=float, default=1.0, help="секунд між пінгами одного пристрою")
+    args = parser.parse_args()
+    targets = args.target or ["flask=http://127.0.0.1:5000/ping", "async=http://127.0.0.1:8081/ping"]
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+    for target in targets:
+        name, _, url = target.partition("=")
+        print(f"→ {name}: {args.connections} connections, {args.duration:.0f}s ...", flush=True)
+        results.append(asyncio.run(run_target(name, url, args)))
+
+    cols = ["target", "requests", "rps", "p50_ms", "p99_ms", "errors", "connect_failures", "reconnects",
+            "peak_connections"]
+    print("  ".join(f"{c:>16}" for c in cols))
+    for r in results:
+        print("  ".join(f"{r[c]:>16.1f}" if isinstance(r[c], float) else f"{r[c]:>16}" for c in cols))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# Навантажувальний бенчмарк: симульований парк ESP32 проти справжнього myhome.py.
+#
+# Сервер стартує окремим процесом у тимчасовій копії репозиторію (чиста БД),
+# Telegram підмінено заглушкою bench/fake_telegram.py через TG_API_URL. Звіт:
+#   - пропускна здатність /ping, p50/p99 затримки;
+#   - затримка виявлення watchdog: подія SSE "offline" мінус (останній пінг + TIMEOUT_SECONDS);
+#   - затримка сповіщення про відключення: sendMessage у заглушці мінус подія SSE "outage";
+#   - затримка сповіщення про відновлення: sendMessage мінус перший пінг після відключення.
+# Той самий --seed дає той самий сценарій; --out зберігає результат, --baseline порівнює з ним.
+#
+#     python bench/run.py --devices 200 --duration 120 --out bench/last.json
+#     python bench/run.py --devices 200 --duration 120 --baseline bench/last.json
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from fake_telegram import FakeBotApi
+from fleet import FleetConfig, run_fleet
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEVICE_RE = re.compile(r"bench-\d+")
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def summary(values, scale=1.0):
+    values = [v * scale for v in values]
+    return {"count": len(values), "p50": percentile(values, 50), "p99": percentile(values, 99),
+            "max": max(values) if values else None}
+
+def prepare_tree():
+    work = tempfile.mkdtemp(prefix="pm-bench-")
+    for name in os.listdir(REPO_DIR):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(REPO_DIR, name), work)
+    for name in ("templates", "static"):
+        shutil.copytree(os.path.join(REPO_DIR, name), os.path.join(work, name))
+    return work
+
+def start_server(work, args, tg_url):
+    env = dict(os.environ, TG_TOKEN="123456:bench", TG_CHAT_ID="1", API_SECRET=args.key,
+               TG_API_URL=tg_url, PORT=str(args.port), TIMEOUT_SECONDS=str(args.timeout),
+               REAL_OUTAGE_THRESHOLD=str(args.threshold), LOG_FILE="bench.log")
+    if args.async_port:
+        env["ASYNC_INGEST_PORT"] = str(args.async_port)
+    for pair in args.env or []:
+        k, _, v = pair.partition("=")
+        env[k] = v
+    if args.server == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-k", "gthread", "--threads", str(args.threads), "-w", "1",
+               "-b", f"127.0.0.1:{args.port}", "myhome:create_app()"]
+    else:
+        cmd = [sys.executable, "myhome.py"]
+    out = open(os.path.join(work, "server.out"), "w")
+    proc = subprocess.Popen(cmd, cwd=work, env=env, stdout=out, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{args.port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base + "/api/devices", timeout=1).read()
+            return proc, base
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit(f"server did not start, see {work}/server.out")
+
+class StreamRecorder(threading.Thread):
+    # Події SSE з /api/stream (усі пристрої)
+    def __init__(self, base):
+        super().__init__(daemon=True, name="StreamRecorder")
+        self.url = base + "/api/stream"
+        self.events = []
+
+    def run(self):
+        try:
+            stream = urllib.request.urlopen(self.url)
+            event = None
+            for raw in stream:
+                line = raw.decode().rstrip("\n")
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:") and event:
+                    self.events.append((time.time(), event, json.loads(line[5:])))
+                elif not line:
+                    event = None
+        except OSError:
+            pass
+
+def first_message(messages, device, after, marker):
+    for m in messages:
+        if m["at"] >= after and marker in m["text"] and device in DEVICE_RE.findall(m["text"]):
+            return m["at"]
+    return None
+
+def analyse(args, fleet, events, messages, elapsed):
+    status = [(ts, data) for ts, kind, data in events if kind == "status"]
+    detection = [data["ts"] - data["since"] - args.timeout for _, data in status if data["change"] == "offline"]
+
+    outage_notify, missed_outage = [], 0
+    for _, data in status:
+        if data["change"] != "outage":
+            continue
+        at = first_message(messages, data["device"], data["ts"] - 0.5, "Відключили")
+        if at is None:
+            missed_outage += 1
+        else:
+            outage_notify.append(at - data["ts"])
+
+    restore_notify, missed_restore = [], 0
+    for sc in fleet.scenarios:
+        if sc["kind"] != "outage":
+            continue
+        at = first_message(messages, sc["device"], sc["resumed_at"], "Відновлено")
+        if at is None:
+            missed_restore += 1
+        else:
+            restore_notify.append(at - sc["resumed_at"])
+
+    kinds = {}
+    for sc in fleet.scenarios:
+        kinds[sc["kind"]] = kinds.get(sc["kind"], 0) + 1
+    return {
+        "config": {k: getattr(args, k) for k in ("devices", "duration", "interval", "seed", "chaos", "timeout",
+                                                 "threshold", "server")} | {"async": bool(args.async_port)},
+        "ping": {"requests": len(fleet.latencies), "rps": len(fleet.latencies) / elapsed,
+                 "errors": fleet.errors, "statuses": {str(k): v for k, v in fleet.statuses.items()},
+                 "latency_ms": summary(fleet.latencies, 1000)},
+        "scenarios": kinds,
+        "watchdog_detection_s": summary(detection),
+        "outage_notify_s": summary(outage_notify) | {"missed": missed_outage},
+        "restore_notify_s": summary(restore_notify) | {"missed": missed_restore},
+        "telegram_messages": len(messages),
+    }
+
+def flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[prefix + k] = v
+    return out
+
+def print_report(result, baseline=None):
+    flat = flatten({k: v for k, v in result.items() if k != "config"})
+    base = flatten({k: v for k, v in baseline.items() if k != "config"}) if baseline else {}
+    print(json.dumps(result["config"]))
+    for key, value in flat.items():
+        line = f"{key:<36} {value:>12.3f}" if isinstance(value, float) else f"{key:<36} {value:>12}"
+        old = base.get(key)
+        if old is not None:
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            line += f"   (baseline {old:.3f}, {change})" if isinstance(old, float) else f"   (baseline {old}, {change})"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Power monitor load benchmark")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=120, help="секунд зі сценаріями збоїв")
+    parser.add_argument("--drain", type=float, default=30, help="секунд спокійних пінгів наприкінці")
+    parser.add_argument("--interval", type=float, default=2.0, help="інтервал heartbeat пристрою")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chaos", type=float, default=1.0, help="множник ймовірностей збоїв")
+    parser.add_argument("--timeout", type=int, default=5, help="TIMEOUT_SECONDS сервера")
+    parser.add_argument("--threshold", type=float, default=0.25, help="REAL_OUTAGE_THRESHOLD, хв")
+    parser.add_argument("--server", choices=("flask", "gunicorn"), default="flask")
+    parser.add_argument("--threads", type=int, default=32, help="потоки gthread")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--async-port", type=int, default=0, help="пінгувати через ASYNC_INGEST_PORT")
+    parser.add_argument("--tg-port", type=int, default=8095)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--env", action="append", metavar="KEY=VALUE", help="додаткове оточення сервера")
+    parser.add_argument("--key", default="bench-secret")
+    parser.add_argument("--out", help="зберегти результат у JSON")
+    parser.add_argument("--baseline", help="JSON попереднього прогону для порівняння")
+    parser.add_argument("--keep", action="store_true", help="не видаляти тимчасову копію з БД і логами")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.tg_port, args.tg_error_rate, args.seed).start()
+    work = prepare_tree()
+    proc, base = start_server(work, args, f"http://127.0.0.1:{args.tg_port}")
+    recorder = StreamRecorder(base)
+    recorder.start()
+    try:
+        ping_url = f"http://127.0.0.1:{args.async_port}/ping" if args.async_port else base + "/ping"
+        cfg = FleetConfig(ping_url, args.key, devices=args.devices, duration=args.duration, drain=args.drain,
+                          interval=args.interval, seed=args.seed,
+                          p_reboot=0.002 * args.chaos, p_brownout=0.002 * args.chaos,
+                          p_glitch=0.002 * args.chaos, p_outage=0.002 * args.chaos,
+                          # Збій - довше таймауту, але коротше порогу; відключення - з запасом на такт watchdog
+                          glitch_range=(args.timeout + 2, max(args.timeout + 2, args.threshold * 60 - 2)),
+                          outage_range=(args.threshold * 60 + 15, args.threshold * 60 + 30))
+        print(f"Fleet: {args.devices} devices, {args.duration:.0f}s + {args.drain:.0f}s drain, seed {args.seed}",
+              flush=True)
+        started = time.time()
+        fleet = asyncio.run(run_fleet(cfg))
+        elapsed = time.time() - started
+    finally:
+        # SIGINT для dev-сервера - щоб спрацювали atexit (дописати чергу запису)
+        proc.send_signal(signal.SIGTERM if args.server == "gunicorn" else signal.SIGINT)
+        try: proc.wait(timeout=30)
+        except subprocess.TimeoutExpired: proc.kill()
+        api.shutdown()
+        if args.keep:
+            print(f"Server tree kept at {work}")
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with api.lock:
+        messages = sorted(api.sent, key=lambda m: m["at"])
+    result = analyse(args, fleet, recorder.events, messages, elapsed)
+    result["telegram_rejected_429"] = api.rejected
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# Асинхронний приймач heartbeat-ів (HTTP/1.1 keep-alive) на чистому asyncio.
+#
+# Flask /ping тримає потік на кожне з'єднання, тож тисячі ESP32 з keep-alive
+# вичерпують воркери задовго до завантаження CPU. Тут з'єднання - це корутина:
+# десятки тисяч на одному ядрі. Логіка пінгу та сама (handle_ping з myhome.py),
+# диск і Telegram і так винесені у фонові потоки (IngestWriter, Notifier).
+#
+# Вмикається змінною ASYNC_INGEST_PORT; TLS знімає Nginx:
+#     location ~ ^/ping(/batch)?$ { proxy_pass http://127.0.0.1:8081; proxy_http_version 1.1;
+#                        proxy_set_header Connection ""; proxy_set_header X-Real-IP $remote_addr; }
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import resource
+import threading
+
+logger = logging.getLogger("PowerMonitor")
+
+MAX_HEADER = 8192
+MAX_BODY = int(os.getenv("ASYNC_INGEST_MAX_BODY", 262144))   # з запасом на /ping/batch
+IDLE_TIMEOUT = float(os.getenv("ASYNC_INGEST_IDLE_TIMEOUT", 75))
+BACKLOG = int(os.getenv("ASYNC_INGEST_BACKLOG", 4096))
+WORKERS = int(os.getenv("ASYNC_INGEST_WORKERS", 32))
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+class IngestServer:
+    def __init__(self, routes):
+        # routes: шлях -> handler(data, remote_ip) -> (тіло, статус[, заголовки])
+        self.routes = routes
+        # Обробники синхронні й чекають на потокові примітиви (блокування пристрою, місце
+        # в черзі IngestWriter до INGEST_PUT_TIMEOUT, SQLite у спільному режимі) - лише в пулі,
+        # інакше один пінг при повній черзі зупиняє всі з'єднання
+        self.executor = concurrent.futures.ThreadPoolExecutor(WORKERS, thread_name_prefix="AsyncIngestWorker")
+        self.connections = 0
+        self.requests = 0
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        self.connections += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 413, "Headers Too Large", False)
+                    return
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                keep_alive = await self.handle_request(head, reader, writer, peer)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def handle_request(self, head, reader, writer, peer):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            await self.respond(writer, 400, "Bad Request", False)
+            return False
+
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                k, v = line.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            await self.respond(writer, 411, "Length Required", False)
+            return False
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            await self.respond(writer, 400, "Bad Request", False)
+            return False
+        if length > MAX_BODY:
+            await self.respond(writer, 413, "Payload Too Large", False)
+            return False
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT) if length else b""
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            # Клієнт закрив з'єднання чи завис посеред тіла - відповідати нікому
+            return False
+
+        self.requests += 1
+        handler = self.routes.get(target.split("?", 1)[0])
+        if handler is None:
+            result = ("Not Found", 404)
+        elif method != "POST":
+            result = ("Method Not Allowed", 405)
+        else:
+            try:
+                data = json.loads(body) if body else None
+            except ValueError:
+                data = None
+            remote_ip = headers.get("x-real-ip") or (peer[0] if peer else None)
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self.executor, handler, data, remote_ip)
+            except Exception as e:
+                logger.error(f"Async ingest handler error: {e}")
+                result = ("Internal Server Error", 500)
+
+        await self.respond(writer, result[1], result[0], keep_alive, result[2] if len(result) > 2 else None)
+        return keep_alive
+
+    async def respond(self, writer, status, body, keep_alive, headers=None):
+        if isinstance(body, (dict, list)):
+            payload, content_type = json.dumps(body, ensure_ascii=False).encode(), "application/json"
+        else:
+            payload, content_type = body.encode(), "text/plain; charset=utf-8"
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                f"Content-Type: {content_type}",
+                f"Content-Length: {len(payload)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        for k, v in (headers or {}).items():
+            head.append(f"{k}: {v}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+    async def serve(self, host, port, ready=None):
+        try:
+            # reuse_port: кожен воркер Gunicorn (WORKER_MODE=shared) слухає той самий порт,
+            # ядро розподіляє з'єднання між ними
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER,
+                                                backlog=BACKLOG, reuse_port=True)
+        except OSError as e:
+            logger.error(f"Async ingest failed to bind {host}:{port}: {e}")
+            return
+        finally:
+            if ready:
+                ready.set()
+        logger.info(f"Async ingest listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+def raise_fd_limit():
+    # Кожне з'єднання - дескриптор; типовий soft-ліміт 1024 замалий
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError): pass
+
+def start_in_thread(host, port, routes):
+    raise_fd_limit()
+    server = IngestServer(routes)
+    ready = threading.Event()
+    threading.Thread(target=lambda: asyncio.run(server.serve(host, port, ready)),
+                     daemon=True, name="AsyncIngestThread").start()
+    ready.wait(5)
+    return server
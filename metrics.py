@@ -0,0 +1,153 @@
+# Мінімальні метрики у текстовому форматі Prometheus (exposition 0.0.4), без залежностей.
+#
+# На гарячому шляху - лише bisect по межах бакетів і кілька інкрементів під
+# коротким локом метрики; агрегація (кумулятивні бакети) робиться під час /metrics.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+def format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [(self.name + "_total", labels, (), value) for labels, value in items]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}   # labels -> [лічильники по бакетах (не кумулятивні) + +Inf, sum]
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            s[0][i] += 1
+            s[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(s[0]), s[1]) for labels, s in self.series.items()]
+        out = []
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append((self.name + "_bucket", labels, (("le", le),), cumulative))
+            out.append((self.name + "_sum", labels, (), total))
+            out.append((self.name + "_count", labels, (), cumulative))
+        return out
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        # callback() -> число або [(labels, значення)]; рахується лише під час /metrics
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if not self.labelnames:
+            return [(self.name, (), (), value)]
+        return [(self.name, labels, (), v) for labels, v in value]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, callback, labelnames=()):
+        return self._add(Gauge(name, help, labelnames, callback))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, extra, value in m.samples():
+                lines.append(f"{name}{format_labels(m.labelnames, labels, extra)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+class TimedLock:
+    # Замість threading.Lock: час очікування і утримання йде в гістограми.
+    # _acquired_at пише лише власник замка, тож окремої синхронізації не треба.
+    def __init__(self, wait_histogram, hold_histogram):
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.wait = wait_histogram
+        self.hold = hold_histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired_at = time.perf_counter()
+            self.wait.observe(self._acquired_at - start)
+        return acquired
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        self.hold.observe(held)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
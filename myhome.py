@@ -1,29 +1,44 @@
 import time
 import threading
 import sqlite3
-import telebot
 import json
+import csv
+import hashlib
+import zlib
 import logging
-from logging.handlers import RotatingFileHandler
-from telebot import types
-from flask import Flask, request, render_template, jsonify
-from datetime import datetime, timedelta
-import pytz
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, WatchedFileHandler, QueueHandler, QueueListener
+from flask import Flask, Blueprint, current_app, request, render_template, jsonify
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import os
+import sys
 import io
+import queue
+import atexit
+import heapq
+import itertools
+import bisect
+import fcntl
+import functools
+from collections import deque, OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
 from dotenv import load_dotenv
 
+import archive
+import metrics
+import tsstore
+
 # ================= CONFIG (LOAD FROM ENV) =================
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 
 LOG_DIR = os.path.join(BASE_DIR, "logs")
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
 
 TELEGRAM_TOKEN = os.getenv("TG_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TG_CHAT_ID")
+# Інший сервер Bot API (локальний telegram-bot-api або заглушка з bench/), напр. http://127.0.0.1:8090
+TG_API_URL = os.getenv("TG_API_URL")
 API_SECRET = os.getenv("API_SECRET")
 
 PORT = int(os.getenv("PORT", 5000))
@@ -31,34 +46,155 @@ TIMEOUT_SECONDS = int(os.getenv("TIMEOUT_SECONDS", 180))
 REAL_OUTAGE_THRESHOLD = float(os.getenv("REAL_OUTAGE_THRESHOLD", 5.0))
 LOCATION_NAME = os.getenv("LOCATION_NAME", "") 
 
-TZ = pytz.timezone("Europe/Kyiv")
+TZ = ZoneInfo("Europe/Kyiv")
 DB_PATH = os.path.join(BASE_DIR, "power_monitor.db")
 STATE_FILE = os.path.join(BASE_DIR, "system_state.json")
+DB_READERS = int(os.getenv("DB_READERS", 4))
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", 8192))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 2.0))
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", 512))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15))
+SSE_HISTORY = int(os.getenv("SSE_HISTORY", 1000))
+SSE_CLIENT_QUEUE = int(os.getenv("SSE_CLIENT_QUEUE", 256))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+INGEST_LINGER = float(os.getenv("INGEST_LINGER", 0.05))
+INGEST_PUT_TIMEOUT = float(os.getenv("INGEST_PUT_TIMEOUT", 2.0))
+# Ліміти Telegram: ~30 повідомлень/с глобально, у групу - не частіше 20/хв
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))
+TG_CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", 3.0))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 5))
+NOTIFY_COALESCE_SECONDS = float(os.getenv("NOTIFY_COALESCE_SECONDS", 10))
+# WORKER_MODE=shared - кілька воркерів Gunicorn на одній БД (див. SHARED MODE)
+SHARED_STATE = os.getenv("WORKER_MODE", "single") == "shared"
+BUS_POLL_INTERVAL = float(os.getenv("BUS_POLL_INTERVAL", 0.5))
+BUS_RETENTION = int(os.getenv("BUS_RETENTION", 600))
+LEADER_LOCK_FILE = os.path.join(BASE_DIR, "leader.lock")
+LEADER_RETRY = float(os.getenv("LEADER_RETRY", 5))
+# Асинхронний приймач /ping для тисяч keep-alive з'єднань (0 - вимкнено)
+ASYNC_INGEST_HOST = os.getenv("ASYNC_INGEST_HOST", "127.0.0.1")
+ASYNC_INGEST_PORT = int(os.getenv("ASYNC_INGEST_PORT", 0))
+PING_BATCH_MAX = int(os.getenv("PING_BATCH_MAX", 500))
+# Сирий журнал heartbeat-ів (tsstore.py): кілька байт на пінг замість рядка SQLite
+HEARTBEAT_LOG = os.getenv("HEARTBEAT_LOG", "1") == "1"
+HEARTBEAT_DIR = os.getenv("HEARTBEAT_DIR", os.path.join(BASE_DIR, "heartbeats"))
+HEARTBEAT_RAW_MAX_DAYS = int(os.getenv("HEARTBEAT_RAW_MAX_DAYS", 2))
+# Рядки outages/system_events/ip_history старші за RETENTION_DAYS (цілими місяцями)
+# переносяться в стиснутий архів ARCHIVE_DIR; 0 - не архівувати
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 365))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 86400))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))
+# /api/export: скільки вивантажень одночасно і розмір шматка відповіді
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", 2))
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", 65536))
+# Що запускає процес: ingest (/ping, журнал heartbeat-ів), web (дашборд, API, /metrics),
+# watchdog, bot (Telegram: polling і сповіщення). Напр. SUBSYSTEMS=ingest для воркера лише на пінги
+ALL_SUBSYSTEMS = ("ingest", "web", "watchdog", "bot")
+SUBSYSTEMS = os.getenv("SUBSYSTEMS", ",".join(ALL_SUBSYSTEMS))
 
 # ================= LOGGING SETUP =================
 
+# Потік, що логує (пінг, watchdog під lock пристрою), лише кладе запис у чергу.
+# Форматування, диск і консоль - у потоці QueueListener. Черга обмежена: якщо лог
+# не встигає, записи відкидаються (power_monitor_log_dropped), а не гальмують /ping.
+# У файл - JSON-рядок на подію (event, device і поля події), у консоль - як і раніше текст.
+
 # Читаємо ім'я файлу з .env (за замовчуванням server.log)
 LOG_FILE_NAME = os.getenv("LOG_FILE", "server.log")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# Ротація: за розміром або LOG_ROTATE_WHEN=midnight (TimedRotatingFileHandler).
+# У спільному режимі файл пишуть кілька процесів - ротацію лишаємо logrotate
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 0 if SHARED_STATE else 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+# Heartbeat у лог - не частіше раз на стільки секунд на пристрій (0 - вимкнено)
+LOG_HEARTBEAT_EVERY = float(os.getenv("LOG_HEARTBEAT_EVERY", 300))
 
-# Тепер логи пишуться і в файл (для logrotate), і в консоль
 logger = logging.getLogger("PowerMonitor")
-logger.setLevel(logging.INFO)
-
-# Форматування
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-# Файловий хендлер
-log_path = os.path.join(LOG_DIR, LOG_FILE_NAME)
-file_handler = logging.FileHandler(log_path)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+log_handlers = []       # файл і консоль - їх викликає лише QueueListener
+log_listener = None
+heartbeat_logged = {}   # device_id -> коли його heartbeat востаннє потрапив у лог
 
-# Консольний хендлер
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Без форматування в потоці, що логує: повідомлення і так f-рядки
+        return record
 
-logger.info(f"Logging initialized. Writing to: {log_path}")
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": datetime.fromtimestamp(record.created, TZ).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "thread": record.threadName,
+                 "msg": record.getMessage()}
+        event = getattr(record, "event", None)
+        if event:
+            entry["event"] = event
+            entry["device"] = record.device
+            entry.update(record.fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+log_queue_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+
+def setup_logging():
+    # Викликає create_app(): імпорт модуля не створює ні каталогів, ні файлів
+    if logger.handlers:
+        return
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logger.setLevel(logging.INFO)
+
+    log_path = os.path.join(LOG_DIR, LOG_FILE_NAME)
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(log_path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+    elif LOG_MAX_BYTES:
+        file_handler = RotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    else:
+        # Файл ротує logrotate - після перейменування відкриваємо новий
+        file_handler = WatchedFileHandler(log_path)
+    file_handler.setFormatter(JsonFormatter())
+    # Журнал запитів dev-сервера - лише в консоль, як і раніше
+    file_handler.addFilter(lambda record: record.name != "werkzeug")
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    log_handlers[:] = [file_handler, console_handler]
+
+    logger.addHandler(log_queue_handler)
+    # Dev-сервер Flask пише рядок на кожен запит - теж через чергу, не з потоку запиту
+    logging.getLogger("werkzeug").addHandler(log_queue_handler)
+    start_log_listener()
+    # Потік слухача не переживає fork (gunicorn --preload) - у дочірньому процесі новий
+    os.register_at_fork(after_in_child=start_log_listener)
+    atexit.register(lambda: log_listener.stop())
+
+    logger.info(f"Logging initialized. Writing to: {log_path}")
+
+def start_log_listener():
+    global log_listener
+    # Нова черга: замок старої міг лишитись захопленим потоком батьківського процесу
+    log_queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    log_listener = QueueListener(log_queue_handler.queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+
+def log_event(event, device_id=None, message=None, level=logging.INFO, **fields):
+    # Структурована подія: у файлі - окремі поля JSON
+    logger.log(level, message or event, extra={"event": event, "device": device_id, "fields": fields})
+
+def log_heartbeat(device_id, now, uptime, ip):
+    # Кожен пінг є в журналі heartbeat-ів (tsstore); у лог - вибірка: не частіше
+    # LOG_HEARTBEAT_EVERY на пристрій і зовсім нічого, коли черга логу заповнена наполовину
+    if not LOG_HEARTBEAT_EVERY or now - heartbeat_logged.get(device_id, 0) < LOG_HEARTBEAT_EVERY:
+        return
+    if log_queue_handler.queue.qsize() > LOG_QUEUE_SIZE // 2:
+        return
+    heartbeat_logged[device_id] = now
+    log_event("heartbeat", device_id, uptime=uptime, ip=ip)
 
 # === СЛОВНИК ПЕРЕКЛАДУ ПРИЧИН ===
 REASON_TRANSLATION = {
@@ -74,201 +210,1771 @@ REASON_TRANSLATION = {
     "N/A": "Невідомо"
 }
 
+# ================= METRICS =================
+
+# /metrics (Prometheus). Гістограми на гарячому шляху - bisect + інкремент,
+# gauges рахуються лише під час скрейпу.
+registry = metrics.Registry()
+# Замок тримається десятки мікросекунд - потрібні дрібніші бакети
+LOCK_BUCKETS = (0.000001, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+PING_SECONDS = registry.histogram("power_monitor_ping_duration_seconds",
+                                  "Heartbeat request handling time", ("endpoint",))
+PING_RESPONSES = registry.counter("power_monitor_ping_responses", "Heartbeat responses by status",
+                                  ("endpoint", "status"))
+LOCK_WAIT = registry.histogram("power_monitor_lock_wait_seconds", "Time waiting for a device state lock",
+                               buckets=LOCK_BUCKETS)
+LOCK_HOLD = registry.histogram("power_monitor_lock_hold_seconds", "Time a device state lock is held",
+                               buckets=LOCK_BUCKETS)
+DB_COMMIT = registry.histogram("power_monitor_db_commit_seconds", "SQLite commit time on the writer connection")
+INGEST_BATCH = registry.histogram("power_monitor_ingest_batch_seconds", "Write-behind batch transaction time")
+INGEST_ROWS = registry.counter("power_monitor_ingest_rows", "Rows written by the write-behind thread")
+STATE_FLUSH = registry.histogram("power_monitor_state_flush_seconds",
+                                 "Collecting dirty device state for the periodic flush", buckets=LOCK_BUCKETS)
+TG_SEND = registry.histogram("power_monitor_telegram_send_seconds", "Telegram sendMessage latency", ("kind",))
+TG_FAILURES = registry.counter("power_monitor_telegram_failures", "Failed Telegram send attempts", ("kind",))
+TG_DROPPED = registry.counter("power_monitor_telegram_dropped", "Notifications dropped after all retries")
+EXPORTED_ROWS = registry.counter("power_monitor_exported_rows", "Rows streamed by /api/export", ("table", "format"))
+ARCHIVED_ROWS = registry.counter("power_monitor_archived_rows", "Rows moved from SQLite to the archive", ("table",))
+LOG_DROPPED = registry.counter("power_monitor_log_dropped", "Log records dropped because the log queue was full")
+WATCHDOG_LOOP = registry.histogram("power_monitor_watchdog_loop_seconds", "Duration of one watchdog pass")
+
+def observed(endpoint):
+    # Час і статус відповіді handle_ping*/ - однаково для Flask і async-приймача
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args):
+            start = time.perf_counter()
+            result = fn(*args)
+            PING_SECONDS.observe(time.perf_counter() - start, endpoint)
+            PING_RESPONSES.inc(endpoint, str(result[1]))
+            return result
+        return inner
+    return wrap
+
 # ================= INIT =================
 
-app = Flask(__name__, 
-            template_folder='templates', 
-            static_folder='static',
-            static_url_path='/static')
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
-lock = threading.Lock()
+# Імпорт модуля нічого не запускає: Flask-додаток, бот і потоки створює create_app()
+# (див. AUTO-STARTUP). Маршрути збираються в blueprints, обробники бота - у bot_handlers.
+app = None
+bot = None
+web_bp = Blueprint("web", __name__)
+ingest_bp = Blueprint("ingest", __name__)
+bot_handlers = []   # (тип, параметри, функція) - реєструються в start_bot()
 last_auth_error_time = 0
 
+def bot_handler(kind, **kwargs):
+    # Замість @bot.message_handler: бота при імпорті ще немає
+    def wrap(fn):
+        bot_handlers.append((kind, kwargs, fn))
+        return fn
+    return wrap
+
 # ================= STATE =================
 
-def load_state():
-    default_state = {
-        "is_online": True,
-        "last_heartbeat": time.time(),
-        "outage_start": None,
-        "online_start": time.time(),
-        "last_boot_id": None,
-        "last_ip": None,
-        "notification_sent": False,
-	"last_outage_msg_id": None
-    }
-    if os.path.exists(STATE_FILE):
+# Один процес обслуговує багато ESP32. Ідентифікатор пристрою приходить у payload
+# ("device_id"); старі прошивки без нього потрапляють на DEFAULT_DEVICE_ID.
+DEFAULT_DEVICE_ID = os.getenv("DEVICE_ID", "main")
+
+# Людські назви локацій: DEVICE_NAMES="main:Дім,dacha:Дача"
+DEVICE_NAMES = {}
+for _pair in os.getenv("DEVICE_NAMES", "").split(","):
+    if ":" in _pair:
+        _dev_id, _dev_name = _pair.split(":", 1)
+        DEVICE_NAMES[_dev_id.strip()] = _dev_name.strip()
+if LOCATION_NAME:
+    DEVICE_NAMES.setdefault(DEFAULT_DEVICE_ID, LOCATION_NAME)
+
+# Блокування: у кожного пристрою свій lock, під яким змінюється лише його стан (пінги
+# різних пристроїв не чекають один одного). Після кожної зміни (mutating) у snapshots
+# кладеться новий незмінний знімок - дашборд, бот і метрики читають лише знімки, без
+# жодного lock, і завжди бачать узгоджений стан, а не половину переходу online/offline.
+class DeviceState:
+    # __slots__: без __dict__ на кожен пристрій, фіксована пам'ять на запис
+    __slots__ = ("device_id", "is_online", "last_heartbeat", "outage_start", "online_start",
+                 "last_boot_id", "last_ip", "notification_sent", "last_outage_msg_id", "lock")
+
+    FIELDS = __slots__[1:-1]
+
+    def __init__(self, device_id, now=None):
+        now = now or time.time()
+        self.device_id = device_id
+        self.is_online = True
+        self.last_heartbeat = now
+        self.outage_start = None
+        self.online_start = now
+        self.last_boot_id = None
+        self.last_ip = None
+        self.notification_sent = False
+        self.last_outage_msg_id = None
+        self.lock = metrics.TimedLock(LOCK_WAIT, LOCK_HOLD)
+
+    def snapshot(self):
+        return DeviceSnapshot(self.device_id, *(getattr(self, k) for k in self.FIELDS))
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, device_id, data):
+        dev = cls(device_id)
+        for k in cls.FIELDS:
+            if k in data:
+                setattr(dev, k, data[k])
+        # SQLite повертає 0/1 замість bool
+        dev.is_online = bool(dev.is_online)
+        dev.notification_sent = bool(dev.notification_sent)
+        return dev
+
+DeviceSnapshot = namedtuple("DeviceSnapshot", ("device_id",) + DeviceState.FIELDS)
+
+# Реєстр пристроїв: device_id -> DeviceState (O(1) на пінг); лише для тих, хто змінює стан
+devices = {}
+# device_id -> DeviceSnapshot; значення замінюється цілком, читається без lock
+snapshots = {}
+registry_lock = threading.Lock()   # лише додавання пристрою в реєстр
+# Пристрої, чия версія кешу /api/stats зросте на виході з mutating() - після нового знімка,
+# інакше паралельний запит закешує відповідь зі старого знімка під новим ETag
+version_pending = set()
+
+@contextmanager
+def mutating(dev):
+    # Зміна стану пристрою: під його lock, на виході - новий знімок для читачів
+    with dev.lock:
         try:
-            with open(STATE_FILE) as f:
-                data = json.load(f)
-                for k, v in default_state.items():
-                    if k not in data:
-                        data[k] = v
-                return data
-        except Exception:
-            pass
-    return default_state
-
-def save_state():
-    try:
-        with open(STATE_FILE, "w") as f:
-            json.dump(state, f)
-    except: pass
+            yield dev
+        finally:
+            snapshots[dev.device_id] = dev.snapshot()
+            deadlines.schedule(dev.device_id, next_deadline(dev))
+            if dev.device_id in version_pending:
+                version_pending.discard(dev.device_id)
+                bump_version(dev.device_id)
+
+def register_device(dev):
+    # -> (пристрій з реєстру, чи доданий щойно); паралельне створення лишає один об'єкт
+    with registry_lock:
+        existing = devices.get(dev.device_id)
+        if existing is not None:
+            return existing, False
+        snapshots[dev.device_id] = dev.snapshot()
+        devices[dev.device_id] = dev
+    deadlines.schedule(dev.device_id, next_deadline(dev))
+    return dev, True
+
+def get_device(device_id, create=True):
+    dev = devices.get(device_id)
+    if dev is None and create:
+        dev, created = register_device(DeviceState(device_id))
+        if created:
+            persist(dev, *DeviceState.FIELDS)
+            bump_version(device_id)
+            log_event("device_registered", device_id, f"New device registered: {device_id}")
+    return dev
+
+def device_snapshot(device_id):
+    return snapshots.get(device_id)
+
+def resolve_device(device_id=None):
+    # Для бота/дашборду (знімок): явний id, інакше дефолтний, інакше перший відомий
+    if device_id:
+        return snapshots.get(device_id)
+    return snapshots.get(DEFAULT_DEVICE_ID) or next(iter(snapshots.values()), None)
+
+def device_name(device_id):
+    return DEVICE_NAMES.get(device_id, device_id)
+
+# Стан живе в таблиці device_state. Пінг лише позначає змінені поля (persist),
+# StateFlusher раз на STATE_FLUSH_INTERVAL пише їх однією транзакцією через IngestWriter.
+# Переходи стану (online/offline) скидаються одразу, не чекаючи інтервалу.
+dirty_fields = {}   # device_id -> set(змінених полів); під dirty_lock
+dirty_lock = threading.Lock()
+_upsert_sql = {}
+
+def persist(dev, *fields, urgent=False):
+    with dirty_lock:
+        dirty_fields.setdefault(dev.device_id, set()).update(fields)
+    if urgent and state_flusher:
+        state_flusher.wake.set()
+
+def upsert_state_sql(fields):
+    sql = _upsert_sql.get(fields)
+    if sql is None:
+        cols = ", ".join(fields)
+        marks = ", ".join("?" * len(fields))
+        updates = ", ".join(f"{f}=excluded.{f}" for f in fields)
+        sql = _upsert_sql[fields] = (f"INSERT INTO device_state (device_id, {cols}) VALUES (?, {marks}) "
+                                     f"ON CONFLICT(device_id) DO UPDATE SET {updates}")
+    return sql
+
+def collect_dirty_state():
+    # Не викликати під lock пристрою. Позначку ставлять посеред зміни, тож значення
+    # читаються під lock пристрою - після того, як зміна, що її поставила, завершилась
+    global dirty_fields
+    with dirty_lock:
+        batch, dirty_fields = dirty_fields, {}
+    writes = []
+    for dev_id, fields in batch.items():
+        dev = devices.get(dev_id)
+        if dev is None:
+            continue
+        fields = tuple(f for f in DeviceState.FIELDS if f in fields)
+        with dev.lock:
+            values = tuple(getattr(dev, f) for f in fields)
+        writes.append((upsert_state_sql(fields), (dev_id, *values)))
+    return writes
+
+SQL_STATE_ROW = "SELECT * FROM device_state WHERE device_id = ?"
+
+def device_for_row(row):
+    # Пристрій з реєстру, а якщо його ще немає (створив інший воркер) - з рядка БД
+    dev = devices.get(row["device_id"])
+    if dev is None:
+        dev, _ = register_device(DeviceState.from_dict(row["device_id"], dict(row)))
+    return dev
+
+def apply_state_row(dev, row):
+    # Спільний режим: рядок device_state, записаний іншим воркером, поверх пам'яті процесу.
+    # Ще не скинуті локальні зміни (dirty) не перетираємо. Викликається під mutating(dev).
+    with dirty_lock:
+        dirty = set(dirty_fields.get(dev.device_id, ()))
+    for k in DeviceState.FIELDS:
+        if k not in dirty:
+            setattr(dev, k, row[k])
+    dev.is_online = bool(dev.is_online)
+    dev.notification_sent = bool(dev.notification_sent)
+    return dev
+
+def reload_device(device_id):
+    with db_read() as conn:
+        row = conn.execute(SQL_STATE_ROW, (device_id,)).fetchone()
+    if row:
+        dev = device_for_row(row)
+        with mutating(dev):
+            apply_state_row(dev, row)
+
+class StateFlusher(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True, name="StateFlusherThread")
+        self.wake = threading.Event()
+        self.stopping = False
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(STATE_FLUSH_INTERVAL)
+            self.wake.clear()
+            with STATE_FLUSH.time():
+                writes = collect_dirty_state()
+            enqueue_writes(writes)
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        self.join(timeout=5)
+        # Останній знімок - в чергу до IngestWriter, який зупиняється після нас
+        enqueue_writes(collect_dirty_state())
+
+# Потоки створюються в start_subsystems(), а не при імпорті: об'єкт Thread, створений
+# до fork (gunicorn --preload), у дочірньому процесі threading вважає зупиненим
+state_flusher = None
 
-state = load_state()
+def load_state():
+    with db_read() as conn:
+        for row in conn.execute("SELECT * FROM device_state"):
+            register_device(DeviceState.from_dict(row["device_id"], dict(row)))
+    if not devices and os.path.exists(STATE_FILE):
+        import_legacy_state()
+    logger.info(f"Loaded state for {len(devices)} device(s)")
+
+def import_legacy_state():
+    # Одноразова міграція з system_state.json (старий формат або {"devices": ...})
+    try:
+        with open(STATE_FILE) as f:
+            data = json.load(f)
+        if "devices" not in data:
+            # Старий формат: один плаский стейт -> дефолтний пристрій
+            data = {"devices": {DEFAULT_DEVICE_ID: data}}
+        for dev_id, dev_data in data["devices"].items():
+            dev, _ = register_device(DeviceState.from_dict(dev_id, dev_data))
+            persist(dev, *DeviceState.FIELDS)
+        with db_write() as conn:
+            for sql, params in collect_dirty_state():
+                conn.execute(sql, params)
+        os.replace(STATE_FILE, STATE_FILE + ".migrated")
+        logger.info(f"Imported legacy {STATE_FILE}")
+    except Exception as e:
+        logger.error(f"Legacy state import failed: {e}")
 
 # ================= DATABASE =================
 
-def db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Постійні з'єднання замість connect/close на кожен запит:
+# один writer (під write_lock) + кілька readers. У WAL читачі не блокуються записом.
+class DbPool:
+    def __init__(self, path, readers):
+        self.path = path
+        self.write_lock = threading.Lock()
+        self.writer = self._connect()
+        self.readers = queue.LifoQueue()
+        for _ in range(readers):
+            self.readers.put(self._connect(readonly=True))
+
+    def _connect(self, readonly=False):
+        # cached_statements: sqlite3 тримає підготовлені стейтменти на рівні з'єднання,
+        # тому SQL_* константи компілюються один раз і далі лише виконуються
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, cached_statements=128)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    @contextmanager
+    def read(self):
+        conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    @contextmanager
+    def dedicated(self):
+        # Окреме з'єднання для довгих читань (експорт): повільний клієнт не забирає readers у дашборду
+        conn = self._connect(readonly=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def write(self):
+        with self.write_lock:
+            try:
+                yield self.writer
+                with DB_COMMIT.time():
+                    self.writer.commit()
+            except:
+                self.writer.rollback()
+                raise
+
+    def close(self):
+        with self.write_lock:
+            self.writer.close()
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+
+pool = None
+
+def db_read():
+    return pool.read()
+
+def db_write():
+    return pool.write()
+
+SQL_INSERT_OUTAGE = ("INSERT INTO outages (start_time, end_time, duration_minutes, device_id, start_ts, end_ts) "
+                     "VALUES (?, ?, ?, ?, ?, ?)")
+SQL_INSERT_EVENT = ("INSERT INTO system_events (time, duration_minutes, reason, raw_reason, device_id, ts) "
+                    "VALUES (?, ?, ?, ?, ?, ?)")
+SQL_INSERT_IP = "INSERT INTO ip_history (time, ip, device_id, ts) VALUES (?, ?, ?, ?)"
+
+# ================= ARCHIVE =================
+
+# Історія не росте в БД безмежно: retention-задача (лідер, раз на RETENTION_INTERVAL)
+# переносить місяці, цілком старші за RETENTION_DAYS, у незмінні сегменти archive.py.
+# Порядок: сегмент -> маніфест -> DELETE рядків з rowid <= max_rowid сегмента -> purged.
+# Перерване падінням перенесення добивається на наступному проході, а history_rows()
+# до того часу не показує рядки БД, які вже є в сегменті. Звільнені сторінки SQLite
+# займають нові рядки, тож файл БД не росте і VACUUM не потрібен.
+ARCHIVED_TABLES = {   # таблиця -> (колонка початку, колонка кінця)
+    "outages": ("start_ts", "end_ts"),
+    "system_events": ("ts", "ts"),
+    "ip_history": ("ts", "ts"),
+}
+
+history_archive = archive.MonthlyArchive(ARCHIVE_DIR)
+
+def history_rows(table, device_id=None, start=None, end=None, conn=None):
+    """Рядки (dict) з БД і архіву, що перетинаються з [start, end], за колонкою початку.
+
+    Генератор: БД читається курсором, архів - сегмент за сегментом, тож пам'ять
+    не залежить від довжини діапазону. Поки генератор не вичерпано, він тримає
+    читацьке з'єднання з пулу; conn - читати БД через нього (всередині транзакції запису).
+    """
+    start_col, end_col = ARCHIVED_TABLES[table]
+    segments = history_archive.segments(table, device_id, start, end)
+    # Сегменти, рядки яких ще не видалені з БД: {місяць: max_rowid}
+    pending = {}
+    for e in segments:
+        if not e["purged"]:
+            pending[e["month"]] = max(pending.get(e["month"], 0), e["max_rowid"])
+
+    where, params = [f"{start_col} IS NOT NULL"], []
+    if device_id is not None:
+        where.append("device_id = ?")
+        params.append(device_id)
+    if start is not None:
+        where.append(f"{end_col} >= ?")
+        params.append(start)
+    if end is not None:
+        where.append(f"{start_col} <= ?")
+        params.append(end)
+    sql = f"SELECT rowid AS _rowid, * FROM {table} WHERE {' AND '.join(where)} ORDER BY {start_col}"
+
+    def live():
+        with (nullcontext(conn) if conn is not None else db_read()) as c:
+            for row in c.execute(sql, params):
+                if pending and row["_rowid"] <= pending.get(archive.month_of(row[end_col]), 0):
+                    continue
+                item = dict(row)
+                del item["_rowid"]
+                yield item
+
+    # Сегмент відкривається, лише коли злиття дійшло до його першого рядка:
+    # одночасно відкриті тільки ті, що перетинаються, а не всі місяці діапазону
+    sources = [(e["first"], functools.partial(history_archive.read, e, start_col, end_col, device_id, start, end))
+               for e in sorted(segments, key=lambda e: e["first"])]
+    yield from merge_lazy([(float("-inf"), live)] + sources, key=lambda r: r[start_col])
+
+def merge_lazy(sources, key):
+    # sources - [(мінімальний ключ, функція -> ітератор)] за зростанням ключа; як heapq.merge,
+    # але ітератор створюється, коли його мінімальний ключ стає найменшим серед відкритих
+    heap, tie = [], itertools.count()
+    pending = deque(sources)
+    while heap or pending:
+        while pending and (not heap or pending[0][0] <= heap[0][0]):
+            it = iter(pending.popleft()[1]())
+            for row in it:
+                heapq.heappush(heap, (key(row), next(tie), row, it))
+                break
+        if not heap:
+            continue
+        _, _, row, it = heap[0]
+        yield row
+        for row in it:
+            heapq.heapreplace(heap, (key(row), next(tie), row, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+def archive_old_rows(now=None):
+    # -> {таблиця: перенесено рядків}
+    cutoff = archive.month_bounds(archive.month_of((now or time.time()) - RETENTION_DAYS * 86400))[0]
+    purge_archived()
+    moved = {}
+    for table, (start_col, end_col) in ARCHIVED_TABLES.items():
+        with db_read() as conn:
+            cur = conn.execute(f"SELECT rowid AS _rowid, * FROM {table} WHERE {end_col} < ? ORDER BY {end_col}",
+                               (cutoff,))
+            columns = [c[0] for c in cur.description][1:]
+            month, batch = None, []
+            # Рядки йдуть за часом, тож у пам'яті лише один місяць
+            for row in itertools.chain(cur, [None]):
+                row_month = archive.month_of(row[end_col]) if row is not None else None
+                if batch and row_month != month:
+                    history_archive.write(table, month, columns, [list(r)[1:] for r in batch],
+                                          max(r["_rowid"] for r in batch), start_col, end_col)
+                    moved[table] = moved.get(table, 0) + len(batch)
+                    ARCHIVED_ROWS.inc(table, amount=len(batch))
+                    batch = []
+                month = row_month
+                if row is not None:
+                    batch.append(row)
+    purge_archived()
+    if moved:
+        logger.info(f"Archived rows older than {datetime.fromtimestamp(cutoff, TZ).date()}: {moved}")
+    return moved
+
+def purge_archived():
+    # Видаляє з БД рядки сегментів, ще не позначених purged
+    pending = [e for e in history_archive.manifest() if not e["purged"]]
+    if not pending:
+        return
+    with db_write() as conn:
+        for e in pending:
+            end_col = ARCHIVED_TABLES[e["table"]][1]
+            m0, m1 = archive.month_bounds(e["month"])
+            conn.execute(f"DELETE FROM {e['table']} WHERE {end_col} >= ? AND {end_col} < ? AND rowid <= ?",
+                         (m0, m1, e["max_rowid"]))
+    history_archive.mark_purged({e["file"] for e in pending})
+
+def retention_loop():
+    # Перший прохід - не в момент старту, далі раз на RETENTION_INTERVAL
+    time.sleep(60)
+    while True:
+        try: archive_old_rows()
+        except Exception as e: logger.error(f"Retention error: {e}")
+        time.sleep(RETENTION_INTERVAL)
+
+# ================= OUTAGE INDEX =================
+
+# Завершені відключення в пам'яті: на пристрій - відсортовані початки і кінці плюс
+# префіксні суми тривалостей. Відключення одного пристрою не перетинаються, тож обидва
+# списки впорядковані: перетин з [a, b] - два bisect і k елементів, час без світла з
+# обрізанням країв - O(log n). Заповнюється при старті і одразу, як пінг закриває
+# відключення (ще до коміту write-behind); активне відключення береться зі стейту.
+
+class OutageIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.starts = []
+        self.ends = []
+        self.cum = [0]   # cum[i] - сума тривалостей перших i відключень
+
+    def add(self, start, end):
+        with self.lock:
+            if not self.starts or start >= self.starts[-1]:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.cum.append(self.cum[-1] + end - start)
+                return
+            # Запізнілий запис (інший воркер) - вставка і перерахунок сум від неї
+            i = bisect.bisect_right(self.starts, start)
+            self.starts.insert(i, start)
+            self.ends.insert(i, end)
+            del self.cum[i + 1:]
+            for k in range(i, len(self.starts)):
+                self.cum.append(self.cum[-1] + self.ends[k] - self.starts[k])
+
+    # active - (start, now) поточного відключення з active_span(): у індексі його ще немає,
+    # але всі запити рахують його найновішим записом
+
+    def _range(self, a, b):
+        # [i, j) - відключення з end >= a і start <= b
+        i = bisect.bisect_left(self.ends, a)
+        return i, max(i, bisect.bisect_right(self.starts, b))
+
+    @staticmethod
+    def _hits(active, a, b):
+        return active is not None and active[1] >= a and active[0] <= b
+
+    def overlap(self, a, b, active=None):
+        with self.lock:
+            i, j = self._range(a, b)
+            spans = list(zip(self.starts[i:j], self.ends[i:j]))
+        if self._hits(active, a, b):
+            spans.append(active)
+        return spans
+
+    def count(self, a, b, active=None):
+        with self.lock:
+            i, j = self._range(a, b)
+        return j - i + self._hits(active, a, b)
+
+    def page(self, before=None, after=None, limit=10, a=None, b=None, active=None):
+        # Keyset за початком: до limit відключень зі start < before (новіші з них)
+        # або зі start > after (старіші з них), лише в межах [a, b]. Два bisect і зріз -
+        # ціна сторінки не залежить від того, як глибоко гортають.
+        # -> ([(start, end)] за зростанням, чи є старіші, чи є новіші)
+        a = float("-inf") if a is None else a
+        b = float("inf") if b is None else b
+        with self.lock:
+            lo, hi = self._range(a, b)
+            if after is not None:
+                i = max(lo, bisect.bisect_right(self.starts, after))
+                j = min(hi, i + limit)
+            else:
+                j = hi if before is None else min(hi, bisect.bisect_left(self.starts, before))
+                i = max(lo, j - limit)
+            spans, older, newer = list(zip(self.starts[i:j], self.ends[i:j])), i > lo, j < hi
+        if (not newer and self._hits(active, a, b)
+                and (before is None or active[0] < before) and (after is None or active[0] > after)):
+            spans.append(active)
+            if len(spans) > limit:
+                # Сторінка вже повна: униз гортали - випадає найстаріше, угору - активне
+                if after is None:
+                    spans.pop(0)
+                    older = True
+                else:
+                    spans.pop()
+                    newer = True
+        return spans, older, newer
+
+    def off_seconds(self, a, b, active=None):
+        with self.lock:
+            i, j = self._range(a, b)
+            # Обрізати можна лише перше і останнє - решта цілком усередині
+            total = 0 if i == j else (self.cum[j] - self.cum[i] - max(0, a - self.starts[i])
+                                      - max(0, self.ends[j - 1] - b))
+        if self._hits(active, a, b):
+            total += min(active[1], b) - max(active[0], a)
+        return total
+
+    def last_end(self):
+        with self.lock:
+            return self.ends[-1] if self.ends else 0
+
+outage_indexes = {}
+
+def outage_index(device_id):
+    idx = outage_indexes.get(device_id)
+    if idx is None:
+        idx = outage_indexes.setdefault(device_id, OutageIndex())
+    return idx
+
+def load_outage_index():
+    # Уся історія: архівні місяці і БД
+    for row in history_rows("outages"):
+        outage_index(row["device_id"]).add(row["start_ts"], row["end_ts"])
+
+def refresh_outage_index(device_id):
+    # Спільний режим: відключення, які закрив інший воркер
+    idx = outage_index(device_id)
+    with db_read() as conn:
+        rows = conn.execute("SELECT start_ts, end_ts FROM outages WHERE device_id = ? AND end_ts > ? ORDER BY start_ts",
+                            (device_id, idx.last_end())).fetchall()
+    for row in rows:
+        idx.add(row["start_ts"], row["end_ts"])
+
+def active_span(dev, now):
+    # (початок, now) відключення, про яке вже повідомили, за цим знімком стану, або None.
+    # Знімок передає викликач - той самий, з якого рахував ETag чи статус
+    if dev and not dev.is_online and dev.notification_sent and dev.outage_start:
+        return (dev.outage_start, now)
+    return None
+
+# ================= OUTAGE LISTING =================
+
+# Єдиний список відключень для /api/outages (нескінченна прокрутка дашборду) і /history
+# у Telegram. Курсор - "o<start>" (старіші за start) або "n<start>" (новіші); зсуву (OFFSET)
+# немає, тож сторінка коштує однаково на будь-якій глибині і не "з'їжджає", коли
+# додаються нові відключення. Архівні місяці теж тут - індекс будується з history_rows().
+HISTORY_PAGE_SIZE = 10     # Telegram
+OUTAGES_PAGE_SIZE = 20     # /api/outages типово
+OUTAGES_PAGE_MAX = 100
+
+def parse_cursor(cursor):
+    # -> (before, after); ValueError, якщо курсор зіпсований
+    if not cursor:
+        return None, None
+    if cursor[0] not in "on":
+        raise ValueError(cursor)
+    ts = int(cursor[1:])
+    return (ts, None) if cursor[0] == "o" else (None, ts)
+
+def outage_page(device_id, cursor=None, limit=HISTORY_PAGE_SIZE, a=None, b=None, now=None):
+    """Сторінка відключень, новіші першими: {"items": [(start, end, is_active)], "older", "newer"}.
+
+    older/newer - курсори сусідніх сторінок або None. [a, b] - лише відключення, що
+    перетинаються з цим проміжком. Активне відключення - найновіший запис, до now.
+    """
+    before, after = parse_cursor(cursor)
+    active = active_span(snapshots.get(device_id), now or time.time())
+    # Невідомий пристрій (/history xyz) - порожній список, без нового індексу в outage_indexes
+    spans, older, newer = outage_indexes.get(device_id, OutageIndex()).page(before, after, limit, a, b, active)
+    items = [(start, end, (start, end) == active) for start, end in reversed(spans)]
+    return {"items": items,
+            "older": f"o{int(items[-1][0])}" if items and older else None,
+            "newer": f"n{int(items[0][0])}" if items and newer else None}
+
+def outage_json(start, end, is_active):
+    return {
+        "start": datetime.fromtimestamp(start, TZ).isoformat(),
+        "end": None if is_active else datetime.fromtimestamp(end, TZ).isoformat(),
+        "duration_min": round((end - start) / 60, 2) if is_active else (end - start) / 60,
+        "is_active": is_active
+    }
+
+# ================= DAILY ROLLUP =================
+
+# daily_rollup: на пристрій і добу (за Києвом) - сума часу без світла, кількість
+# відключень і збоїв, найдовше відключення. Оновлюється в тій самій пачці запису,
+# що й сирі рядки, тож дашборд/звіти читають кілька сотень рядків замість історії.
+SQL_ROLLUP_OUTAGE = """
+    INSERT INTO daily_rollup (device_id, day, off_seconds, outage_count, tech_failure_count, longest_outage_seconds)
+    VALUES (?, ?, ?, 1, 0, ?)
+    ON CONFLICT(device_id, day) DO UPDATE SET
+        off_seconds = off_seconds + excluded.off_seconds,
+        outage_count = outage_count + 1,
+        longest_outage_seconds = max(longest_outage_seconds, excluded.longest_outage_seconds)
+"""
+SQL_ROLLUP_TECH = """
+    INSERT INTO daily_rollup (device_id, day, off_seconds, outage_count, tech_failure_count, longest_outage_seconds)
+    VALUES (?, ?, 0, 0, 1, 0)
+    ON CONFLICT(device_id, day) DO UPDATE SET tech_failure_count = tech_failure_count + 1
+"""
+SQL_ROLLUP_RANGE = ("SELECT day, off_seconds, outage_count, tech_failure_count, longest_outage_seconds "
+                    "FROM daily_rollup WHERE device_id = ? AND day >= ? AND day <= ? ORDER BY day")
+
+def day_start(d):
+    # Північ за Києвом з урахуванням переходу на літній/зимовий час
+    return datetime(d.year, d.month, d.day, tzinfo=TZ)
+
+def day_pieces(start_ts, end_ts):
+    # Розрізає інтервал по опівночах: [(YYYY-MM-DD, секунд), ...]
+    pieces = []
+    cur = start_ts
+    while cur < end_ts:
+        d = datetime.fromtimestamp(cur, TZ).date()
+        piece_end = min(end_ts, day_start(d + timedelta(days=1)).timestamp())
+        pieces.append((d.isoformat(), piece_end - cur))
+        cur = piece_end
+    return pieces
+
+def rollup_outage_writes(device_id, start_ts, end_ts):
+    longest = end_ts - start_ts
+    return [(SQL_ROLLUP_OUTAGE, (device_id, day, seconds, longest)) for day, seconds in day_pieces(start_ts, end_ts)]
+
+def rollup_tech_write(device_id, ts):
+    return (SQL_ROLLUP_TECH, (device_id, datetime.fromtimestamp(ts, TZ).date().isoformat()))
+
+def rebuild_rollup(conn, device_id=None):
+    # Повний перерахунок з сирих таблиць і архіву (міграція, ручне відновлення)
+    where, params = ("WHERE device_id = ?", (device_id,)) if device_id else ("", ())
+    conn.execute(f"DELETE FROM daily_rollup {where}", params)
+    for row in history_rows("outages", device_id, conn=conn):
+        for sql, args in rollup_outage_writes(row["device_id"], row["start_ts"], row["end_ts"]):
+            conn.execute(sql, args)
+    for row in history_rows("system_events", device_id, conn=conn):
+        conn.execute(*rollup_tech_write(row["device_id"], row["ts"]))
+
+# ================= MIGRATIONS =================
+
+# Версія схеми - у PRAGMA user_version; кожна міграція виконується в окремій транзакції
+
+def migrate_v1(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS outages (start_time TEXT, end_time TEXT, duration_minutes REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS system_events (time TEXT, duration_minutes REAL, reason TEXT, raw_reason TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS ip_history (time TEXT, ip TEXT)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS device_state (
+        device_id TEXT PRIMARY KEY, is_online INTEGER, last_heartbeat REAL, outage_start REAL,
+        online_start REAL, last_boot_id TEXT, last_ip TEXT, notification_sent INTEGER,
+        last_outage_msg_id INTEGER)""")
+    # Мультипристрійність: старі записи належать дефолтному пристрою
+    for table in ("outages", "system_events", "ip_history"):
+        cols = [r["name"] for r in conn.execute(f"PRAGMA table_info({table})")]
+        if "device_id" not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN device_id TEXT")
+            conn.execute(f"UPDATE {table} SET device_id = ? WHERE device_id IS NULL", (DEFAULT_DEVICE_ID,))
+
+def iso_to_ts(value):
+    return int(datetime.fromisoformat(value).timestamp()) if value else None
+
+def migrate_v2(conn):
+    # Цілі epoch-колонки замість порівняння ISO-рядків + покриваючі індекси
+    conn.execute("ALTER TABLE outages ADD COLUMN start_ts INTEGER")
+    conn.execute("ALTER TABLE outages ADD COLUMN end_ts INTEGER")
+    conn.execute("ALTER TABLE system_events ADD COLUMN ts INTEGER")
+    conn.execute("ALTER TABLE ip_history ADD COLUMN ts INTEGER")
+
+    rows = conn.execute("SELECT rowid, start_time, end_time FROM outages").fetchall()
+    conn.executemany("UPDATE outages SET start_ts = ?, end_ts = ? WHERE rowid = ?",
+                     [(iso_to_ts(r[1]), iso_to_ts(r[2]), r[0]) for r in rows])
+    for table in ("system_events", "ip_history"):
+        rows = conn.execute(f"SELECT rowid, time FROM {table}").fetchall()
+        conn.executemany(f"UPDATE {table} SET ts = ? WHERE rowid = ?", [(iso_to_ts(r[1]), r[0]) for r in rows])
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outages_device_end "
+                 "ON outages (device_id, end_ts, start_ts, duration_minutes)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_device_ts ON system_events (device_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ip_device_ts ON ip_history (device_id, ts)")
+    conn.execute("ANALYZE")
+
+def migrate_v3(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS daily_rollup (
+        device_id TEXT, day TEXT, off_seconds REAL, outage_count INTEGER,
+        tech_failure_count INTEGER, longest_outage_seconds REAL,
+        PRIMARY KEY (device_id, day)) WITHOUT ROWID""")
+    rebuild_rollup(conn)
+
+def migrate_v4(conn):
+    # Спільний режим: шина подій між воркерами і черга сповіщень для лідера
+    conn.execute("""CREATE TABLE IF NOT EXISTS bus (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, origin INTEGER,
+        kind TEXT, device_id TEXT, payload TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, payload TEXT)""")
+
+def migrate_v5(conn):
+    # history_rows() читає outages за start_ts - з цим індексом без сортування в пам'яті
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outages_device_start ON outages (device_id, start_ts, end_ts)")
+    conn.execute("ANALYZE")
+
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5]
 
 def init_db():
-    try:
-        conn = db()
-        conn.execute("CREATE TABLE IF NOT EXISTS outages (start_time TEXT, end_time TEXT, duration_minutes REAL)")
-        conn.execute("CREATE TABLE IF NOT EXISTS system_events (time TEXT, duration_minutes REAL, reason TEXT, raw_reason TEXT)")
-        conn.execute("CREATE TABLE IF NOT EXISTS ip_history (time TEXT, ip TEXT)")
-        conn.commit()
-        conn.close()
-    except: pass
+    global pool
+    pool = DbPool(DB_PATH, DB_READERS)
+    with db_write() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with db_write() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Кілька воркерів стартують одночасно - інший міг уже мігрувати, поки ми чекали
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+        logger.info(f"DB schema migrated to v{target}")
+
+# ================= WRITE-BEHIND =================
+
+# /ping не чекає на диск: записи йдуть у чергу, окремий потік пише їх пачками
+# в одній транзакції (group commit). Черга обмежена - при переповненні /ping віддає 503.
+# Елемент (AFTER_COMMIT, fn) - не SQL, а колбек, що викликається після коміту своєї пачки.
+_STOP = object()
+AFTER_COMMIT = None
+
+class IngestWriter(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True, name="IngestWriterThread")
+        # Місткість - окремі слоти: пінг займає місце до зміни стану пристрою, тож
+        # записи переходу, що вже стався в пам'яті, ніколи не відкидаються через повну чергу
+        self.queue = queue.Queue()
+        self.slots = threading.BoundedSemaphore(INGEST_QUEUE_SIZE)
+
+    def reserve(self, timeout=INGEST_PUT_TIMEOUT):
+        # Backpressure: чекаємо місце не довше timeout; False - черга повна
+        return self.slots.acquire(timeout=timeout)
+
+    def submit_reserved(self, writes):
+        # Список записів - один елемент черги, тож потрапляє в одну транзакцію цілком.
+        # Порожній список лише повертає слот
+        if writes:
+            self.queue.put(list(writes))
+        else:
+            self.slots.release()
+
+    def run(self):
+        running = True
+        while running:
+            items = [self.queue.get()]
+            # Коротко чекаємо, щоб зібрати більшу пачку, потім вигрібаємо все наявне
+            if INGEST_LINGER and items[0] is not _STOP:
+                time.sleep(INGEST_LINGER)
+            while len(items) < INGEST_BATCH_SIZE:
+                try: items.append(self.queue.get_nowait())
+                except queue.Empty: break
+            batch = []
+            for item in items:
+                if item is _STOP:
+                    running = False
+                elif isinstance(item, list):
+                    batch.extend(item)
+                else:
+                    batch.append(item)
+            self.write_batch(batch)
+            for item in items:
+                if item is not _STOP:
+                    self.slots.release()
+                self.queue.task_done()
+
+    def write_batch(self, batch):
+        callbacks = [params for sql, params in batch if sql is AFTER_COMMIT]
+        batch = [item for item in batch if item[0] is not AFTER_COMMIT]
+        if batch:
+            try:
+                with INGEST_BATCH.time(), db_write() as conn:
+                    for sql, params in batch:
+                        conn.execute(sql, params)
+                INGEST_ROWS.inc(amount=len(batch))
+            except Exception as e:
+                # Один битий запис не повинен забрати з собою всю пачку
+                logger.error(f"Batch write failed ({len(batch)} rows), retrying one by one: {e}")
+                for sql, params in batch:
+                    try:
+                        with db_write() as conn:
+                            conn.execute(sql, params)
+                    except Exception as e:
+                        logger.error(f"Dropped write {sql.split('(')[0].strip()}: {e}")
+        for callback in callbacks:
+            try: callback()
+            except Exception as e: logger.error(f"After-commit callback failed: {e}")
+
+    def flush(self):
+        self.queue.join()
+
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(_STOP)
+            self.join(timeout=30)
+
+ingest = None   # IngestWriter, див. start_subsystems()
+
+# Журнал heartbeat-ів (tsstore.HeartbeatStore) створюється при старті підсистем - там уже відомий pid
+hblog = None
+
+def enqueue_writes(writes):
+    # Фонові потоки (скидання стану) можуть чекати: записи не відкидаються, поки writer живий
+    if not writes:
+        return
+    while not ingest.reserve():
+        if not ingest.is_alive():
+            logger.error(f"Ingest writer stopped, dropped {len(writes)} writes")
+            return
+        logger.warning(f"Ingest queue full, waiting to enqueue {len(writes)} writes")
+    ingest.submit_reserved(writes)
+
+# ================= NOTIFICATIONS =================
+
+# Telegram ніколи не викликається з /ping чи watchdog: вони лише кладуть повідомлення
+# в чергу, а NotifierThread відправляє з урахуванням лімітів, ретраїв і склеювання.
+class Notification:
+    __slots__ = ("chat_id", "text", "kind", "device_id", "keyboard",
+                 "reply_to_outage", "summary_line", "merged", "attempts")
+
+    def __init__(self, chat_id, text, kind="info", device_id=None, keyboard=None,
+                 reply_to_outage=False, summary_line=None):
+        self.chat_id = chat_id
+        self.text = text
+        # "outage" - склеюються у зведення; решта йдуть як є
+        self.kind = kind
+        self.device_id = device_id
+        # Назва клавіатури з KEYBOARDS: будується лише при відправці, там, де працює бот
+        self.keyboard = keyboard
+        # Відповідь на повідомлення про відключення (dev.last_outage_msg_id береться в момент відправки)
+        self.reply_to_outage = reply_to_outage
+        self.summary_line = summary_line
+        self.merged = ()
+        self.attempts = 0
+
+class Notifier(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True, name="NotifierThread")
+        self.inbox = queue.Queue()
+        self.chats = {}            # chat_id -> deque[Notification] (FIFO в межах чату)
+        self.chat_ready_at = {}    # chat_id -> найближчий дозволений час відправки
+        self.coalescing = {}       # chat_id -> (deadline, [outage Notification])
+        self.tokens = TG_GLOBAL_RATE
+        self.tokens_at = time.time()
+        self.stopping = False
+
+    def send(self, notification):
+        self.inbox.put(notification)
+
+    def stop(self, timeout=10):
+        if self.is_alive():
+            self.inbox.put(_STOP)
+            self.join(timeout=timeout)
+
+    # --- приймання ---
+
+    def _accept(self, n, now):
+        if n is _STOP:
+            self.stopping = True
+            return
+        if n.kind == "outage" and NOTIFY_COALESCE_SECONDS > 0:
+            deadline, items = self.coalescing.setdefault(n.chat_id, (now + NOTIFY_COALESCE_SECONDS, []))
+            items.append(n)
+            return
+        # Все, що йде після відключень, не повинно їх обігнати
+        self._flush_coalesced(n.chat_id)
+        self.chats.setdefault(n.chat_id, deque()).append(n)
+
+    def _flush_coalesced(self, chat_id):
+        entry = self.coalescing.pop(chat_id, None)
+        if not entry:
+            return
+        items = entry[1]
+        out = self.chats.setdefault(chat_id, deque())
+        if len(items) == 1:
+            out.append(items[0])
+            return
+        # Багато локацій за одне вікно -> одне зведене повідомлення
+        lines = [n.summary_line or n.text for n in items[:50]]
+        if len(items) > 50:
+            lines.append(f"…і ще {len(items) - 50}")
+        summary = Notification(chat_id,
+                               f"🔴 **Відключили електропостачання** (локацій: {len(items)})\n" + "\n".join(lines),
+                               kind="outage_summary")
+        summary.merged = items
+        out.append(summary)
+
+    # --- відправка ---
+
+    def _take_token(self, now):
+        self.tokens = min(TG_GLOBAL_RATE, self.tokens + (now - self.tokens_at) * TG_GLOBAL_RATE)
+        self.tokens_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _deliver(self, n):
+        reply_to = None
+        if n.reply_to_outage and n.device_id:
+            if SHARED_STATE:
+                # Лідерство могло перейти - ID треду беремо з БД, а не з пам'яті
+                reload_device(n.device_id)
+            snap = device_snapshot(n.device_id)
+            reply_to = snap.last_outage_msg_id if snap else None
+        try:
+            with TG_SEND.time(n.kind):
+                markup = KEYBOARDS[n.keyboard](n.device_id) if n.keyboard else None
+                sent = bot.send_message(n.chat_id, n.text, parse_mode="Markdown",
+                                        reply_markup=markup, reply_to_message_id=reply_to)
+        except Exception as e:
+            TG_FAILURES.inc(n.kind)
+            if reply_to and "message to be replied not found" in str(e):
+                # Оригінал видалили - шлемо без треду
+                dev = devices.get(n.device_id)
+                if dev:
+                    with mutating(dev):
+                        dev.last_outage_msg_id = None
+                        persist(dev, "last_outage_msg_id")
+            raise
+
+        if n.kind == "outage":
+            updates = [(n.device_id, sent.message_id)]
+        elif n.kind == "outage_summary":
+            # Усі локації зі зведення відповідатимуть на нього
+            updates = [(item.device_id, sent.message_id) for item in n.merged]
+        elif n.reply_to_outage and n.device_id:
+            updates = [(n.device_id, None)]
+        else:
+            return
+        for dev_id, msg_id in updates:
+            dev = devices.get(dev_id)
+            if dev:
+                with mutating(dev):
+                    dev.last_outage_msg_id = msg_id
+                    persist(dev, "last_outage_msg_id", urgent=True)
+
+    def _retry_delay(self, n, error):
+        result = getattr(error, "result_json", None) or {}
+        retry_after = (result.get("parameters") or {}).get("retry_after")
+        if retry_after:
+            return float(retry_after)
+        return min(60, 2 ** n.attempts)
+
+    def _dispatch(self, now):
+        for chat_id, (deadline, _) in list(self.coalescing.items()):
+            if deadline <= now or self.stopping:
+                self._flush_coalesced(chat_id)
+
+        for chat_id, pending in self.chats.items():
+            if not pending or self.chat_ready_at.get(chat_id, 0) > now:
+                continue
+            if not self._take_token(now):
+                return
+            n = pending[0]
+            try:
+                self._deliver(n)
+                pending.popleft()
+                self.chat_ready_at[chat_id] = now + TG_CHAT_INTERVAL
+            except Exception as e:
+                n.attempts += 1
+                if n.attempts > TG_MAX_RETRIES:
+                    pending.popleft()
+                    TG_DROPPED.inc()
+                    logger.error(f"❌ SEND ERROR (dropped after {n.attempts} attempts): {e}")
+                else:
+                    delay = self._retry_delay(n, e)
+                    self.chat_ready_at[chat_id] = now + delay
+                    logger.warning(f"SEND ERROR, retry in {delay:.0f}s: {e}")
+
+    def _next_wakeup(self, now):
+        times = [deadline for deadline, _ in self.coalescing.values()]
+        times += [self.chat_ready_at.get(chat_id, now) for chat_id, pending in self.chats.items() if pending]
+        if not times:
+            return None
+        wake = min(times)
+        if self.tokens < 1:
+            wake = max(wake, now + (1 - self.tokens) / TG_GLOBAL_RATE)
+        return max(0, wake - now)
+
+    def pending(self):
+        return bool(self.coalescing) or any(self.chats.values()) or not self.inbox.empty()
+
+    def run(self):
+        stop_deadline = None
+        while True:
+            now = time.time()
+            try:
+                self._accept(self.inbox.get(timeout=self._next_wakeup(now)), now)
+                while True:
+                    self._accept(self.inbox.get_nowait(), now)
+            except queue.Empty:
+                pass
+            now = time.time()
+            self._dispatch(now)
+            if self.stopping:
+                stop_deadline = stop_deadline or now + 8
+                if not self.pending() or now > stop_deadline:
+                    return
+
+notifier = None   # Notifier, лише в процесі з ботом
+
+def notify(text, device_id=None, kind="info", keyboard=None, reply_to_outage=False, summary_line=None):
+    if not is_leader:
+        # Notifier працює лише в лідері - передаємо через outbox
+        bus_emit("notify", device_id, {"text": text, "kind": kind, "keyboard": keyboard,
+                                       "reply_to_outage": reply_to_outage, "summary_line": summary_line})
+        return
+    if "bot" not in running:
+        return
+    notifier.send(Notification(TELEGRAM_CHAT_ID, text, kind=kind, device_id=device_id, keyboard=keyboard,
+                               reply_to_outage=reply_to_outage, summary_line=summary_line))
 
 # ================= HELPERS =================
 
+PROJECT_START_DATE = "2026-01-26" # Раніше - тестові записи; фронтенд має ту саму межу
+
 def fmt(sec: float) -> str:
     if sec < 0: sec = 0
     m = int(sec // 60); h = m // 60
     return f"{h}г {m % 60}хв" if h else f"{m}хв"
 
-def get_header():
-    return f"🏠 {LOCATION_NAME}\n" if LOCATION_NAME else ""
+def get_header(device_id=DEFAULT_DEVICE_ID):
+    name = DEVICE_NAMES.get(device_id)
+    if not name and device_id != DEFAULT_DEVICE_ID:
+        name = device_id
+    return f"🏠 {name}\n" if name else ""
 
 # --- КЛАВІАТУРИ ---
 
 # 1. Для СПОВІЩЕНЬ (Зелені/Червоні/Жовті повідомлення)
-def kb_notification():
+# callback_data має вигляд "дія:device_id" (ліміт Telegram - 64 байти)
+def kb_notification(device_id=DEFAULT_DEVICE_ID):
+    from telebot import types
     k = types.InlineKeyboardMarkup(row_width=2)
     # Ті самі кнопки, що в меню
-    btn_stats = types.InlineKeyboardButton("📊 Звіт", callback_data="stats")
-    btn_last = types.InlineKeyboardButton("📜 Історія", callback_data="history")
+    btn_stats = types.InlineKeyboardButton("📊 Звіт", callback_data=f"stats:{device_id}")
+    btn_last = types.InlineKeyboardButton("📜 Історія", callback_data=f"history:{device_id}")
     k.add(btn_stats, btn_last)
     # Кнопка оновлення саме цього повідомлення
-    btn_update = types.InlineKeyboardButton("🔄 Оновити статус", callback_data="status")
+    btn_update = types.InlineKeyboardButton("🔄 Оновити статус", callback_data=f"status:{device_id}")
     k.add(btn_update)
     return k
 
 # 2. Для МЕНЮ (Панель керування - закріплене)
-def kb_menu():
+def kb_menu(device_id=DEFAULT_DEVICE_ID):
+    from telebot import types
     k = types.InlineKeyboardMarkup(row_width=2)
-    btn_stats = types.InlineKeyboardButton("📊 Звіт за день", callback_data="stats")
-    btn_last = types.InlineKeyboardButton("📜 Історія (10)", callback_data="history")
+    btn_stats = types.InlineKeyboardButton("📊 Звіт за день", callback_data=f"stats:{device_id}")
+    btn_last = types.InlineKeyboardButton("📜 Історія", callback_data=f"history:{device_id}")
     k.add(btn_stats, btn_last)
-    btn_status = types.InlineKeyboardButton("🔄 Стан зараз", callback_data="status")
+    btn_week = types.InlineKeyboardButton("📅 Тиждень", callback_data=f"week:{device_id}")
+    btn_month = types.InlineKeyboardButton("🗓 Місяць", callback_data=f"month:{device_id}")
+    k.add(btn_week, btn_month)
+    btn_status = types.InlineKeyboardButton("🔄 Стан зараз", callback_data=f"status:{device_id}")
     k.add(btn_status)
     return k
 
+# 3. Вибір пристрою (/devices)
+def kb_devices():
+    from telebot import types
+    k = types.InlineKeyboardMarkup(row_width=1)
+    for dev_id in sorted(snapshots):
+        k.add(types.InlineKeyboardButton(f"📍 {device_name(dev_id)}", callback_data=f"menu:{dev_id}"))
+    return k
+
+# 4. Гортання історії: hpage:<курсор>:<device>. Довгий device_id не влазить у 64 байти
+# callback_data - тоді замість нього "#" + хеш (стабільний між рестартами, на відміну від індексу)
+CALLBACK_DATA_MAX = 64
+
+def device_token(device_id):
+    return "#" + hashlib.sha1(device_id.encode()).hexdigest()[:12]
+
+def device_by_token(ref):
+    if ref.startswith("#"):
+        return next((dev_id for dev_id in list(snapshots) if device_token(dev_id) == ref), ref)
+    return ref
+
+def history_callback(cursor, device_id):
+    data = f"hpage:{cursor}:{device_id}"
+    return data if len(data.encode()) <= CALLBACK_DATA_MAX else f"hpage:{cursor}:{device_token(device_id)}"
+
+def kb_history(device_id, page):
+    from telebot import types
+    buttons = []
+    if page["older"]:
+        buttons.append(types.InlineKeyboardButton("◀️ Старіші", callback_data=history_callback(page["older"], device_id)))
+    if page["newer"]:
+        buttons.append(types.InlineKeyboardButton("Новіші ▶️", callback_data=history_callback(page["newer"], device_id)))
+    if not buttons:
+        return None
+    k = types.InlineKeyboardMarkup(row_width=2)
+    k.add(*buttons)
+    return k
+
+# Клавіатури сповіщень за назвою (Notification.keyboard, outbox)
+KEYBOARDS = {"notification": kb_notification, "menu": kb_menu}
+
+# ================= STATS CACHE =================
+
+# Версія даних пристрою росте при кожному переході стану і після коміту відключень/збоїв.
+# Відповідь /api/stats кешується за (device, range) і валідна, поки версія та сама.
+CACHE_EPOCH = int(time.time())  # різні ETag після рестарту
+data_versions = {}   # device_id -> (version, час зміни)
+stats_cache = OrderedDict()   # (device, start, end) -> (etag, json), LRU
+stats_cache_lock = threading.Lock()
+
+def bump_version(device_id, outage=False):
+    bump_local_version(device_id, outage)
+    bus_emit("version", device_id, {"outage": outage})
+
+def bump_local_version(device_id, outage=False):
+    version, _ = data_versions.get(device_id, (0, 0))
+    data_versions[device_id] = (version + 1, time.time())
+    if outage:
+        outage_versions[device_id] = outage_versions.get(device_id, 0) + 1
+
+def stats_etag(dev, start_day, end_day):
+    version, changed_at = data_versions.get(dev.device_id, (0, CACHE_EPOCH))
+    etag = f"{dev.device_id}-{CACHE_EPOCH}-{version}-{start_day}-{end_day}"
+    # Активне відключення "росте" - відповідь живе не довше хвилини
+    if not dev.is_online and dev.notification_sent:
+        minute = int(time.time() // 60)
+        etag += f"-{minute}"
+        changed_at = max(changed_at, minute * 60)
+    return etag, datetime.fromtimestamp(int(changed_at), timezone.utc)
+
+def after_commit(device_id, event=None):
+    # Після коміту: нова версія кешу і (опційно) подія в SSE - клієнт перечитає вже записане
+    def callback():
+        bump_version(device_id, outage=bool(event) and event[0] == "outage_closed")
+        if event:
+            publish_event(event[0], device_id, event[1])
+    return (AFTER_COMMIT, callback)
+
+# ================= LIVE STREAM (SSE) =================
+
+# /api/stream: дашборд отримує переходи стану одразу, без опитування /api/stats.
+# Події мають наскрізні id (мс від старту процесу), тож після реконекту з Last-Event-ID
+# клієнт дочитує пропущене з кільцевого буфера; якщо буфер уже не покриває - "resync".
+class Subscriber:
+    __slots__ = ("queue", "device_id", "overflow")
+
+    def __init__(self, device_id):
+        self.queue = queue.Queue(maxsize=SSE_CLIENT_QUEUE)
+        self.device_id = device_id
+        self.overflow = False
+
+class EventBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = int(time.time() * 1000)
+        self.history = deque(maxlen=SSE_HISTORY)
+        self.subscribers = set()
+
+    def publish(self, event_type, device_id, data):
+        with self.lock:
+            self.seq += 1
+            data = dict(data, device=device_id, ts=time.time())
+            ev = (self.seq, event_type, device_id, json.dumps(data, ensure_ascii=False))
+            self.history.append(ev)
+            for sub in self.subscribers:
+                if sub.device_id and sub.device_id != device_id:
+                    continue
+                try: sub.queue.put_nowait(ev)
+                except queue.Full: sub.overflow = True
+
+    def subscribe(self, device_id=None, last_event_id=None):
+        sub = Subscriber(device_id)
+        with self.lock:
+            backlog, resync = [], False
+            if last_event_id is not None:
+                oldest = self.history[0][0] if self.history else self.seq + 1
+                resync = last_event_id < oldest - 1 or last_event_id > self.seq
+                backlog = [ev for ev in self.history if ev[0] > last_event_id
+                           and (not device_id or ev[2] == device_id)]
+            self.subscribers.add(sub)
+        return sub, backlog, resync
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+broker = EventBroker()
+
+def publish_event(event_type, device_id, data):
+    broker.publish(event_type, device_id, data)
+    bus_emit("event", device_id, {"type": event_type, "data": data})
+
+def publish_status(dev, change):
+    log_event("status", dev.device_id, f"{dev.device_id}: {change}", change=change)
+    publish_event("status", dev.device_id, {"change": change, "is_online": dev.is_online,
+                                             "notification_sent": dev.notification_sent,
+                                             "since": dev.online_start if dev.is_online else dev.outage_start})
+
+def sse_format(ev):
+    return f"id: {ev[0]}\nevent: {ev[1]}\ndata: {ev[3]}\n\n"
+
+@web_bp.route("/api/stream")
+def api_stream():
+    device_id = request.args.get("device")
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    except (TypeError, ValueError):
+        last_event_id = None
+    sub, backlog, resync = broker.subscribe(device_id, last_event_id)
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            if resync:
+                yield "event: resync\ndata: {}\n\n"
+            for ev in backlog:
+                yield sse_format(ev)
+            while not sub.overflow:
+                try:
+                    yield sse_format(sub.queue.get(timeout=SSE_KEEPALIVE))
+                except queue.Empty:
+                    # Коментар SSE - тримає з'єднання живим через Nginx
+                    yield ": keepalive\n\n"
+            # Клієнт не встигав читати - хай перепідключиться і дочитає з буфера
+            yield "event: resync\ndata: {}\n\n"
+        finally:
+            broker.unsubscribe(sub)
+
+    return current_app.response_class(stream(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ================= SHARED MODE (MULTI-WORKER) =================
+
+# WORKER_MODE=shared: будь-яка кількість воркерів Gunicorn обслуговує /ping і /api/*.
+# - Стан пристрою - рядок device_state. Пінг і крок watchdog перечитують його і записують
+#   зміни в одній транзакції BEGIN IMMEDIATE: SQLite сам серіалізує запис між процесами.
+# - Версії кешу і SSE-події інших воркерів приходять через таблицю bus (BusPoller).
+# - Watchdog, бот і Notifier працюють лише в лідері: flock на leader.lock знімає ОС,
+#   коли лідер помирає, і роль перехоплює наступний воркер. Сповіщення від решти
+#   чекають лідера в таблиці outbox і не губляться при зміні лідера.
+is_leader = not SHARED_STATE
+bus_pending = []
+bus_lock = threading.Lock()
+
+SQL_BUS_INSERT = "INSERT INTO bus (created, origin, kind, device_id, payload) VALUES (?, ?, ?, ?, ?)"
+SQL_BUS_TAIL = "SELECT id, origin, kind, device_id, payload FROM bus WHERE id > ? ORDER BY id LIMIT 1000"
+SQL_OUTBOX_INSERT = "INSERT INTO outbox (created, payload) VALUES (?, ?)"
+# Пристрої, яким watchdog має щось зробити: мовчать довше таймауту або чекають сповіщення
+SQL_STATE_DUE = ("SELECT * FROM device_state WHERE (is_online = 1 AND last_heartbeat < ?) "
+                 "OR (is_online = 0 AND notification_sent = 0)")
+# Найближчий термін серед них (як next_deadline(), але по всій таблиці)
+SQL_STATE_NEXT_DEADLINE = ("SELECT MIN(CASE WHEN is_online = 1 THEN last_heartbeat + ? ELSE outage_start + ? END) "
+                           "FROM device_state WHERE is_online = 1 OR (notification_sent = 0 AND outage_start IS NOT NULL)")
+
+def bus_emit(kind, device_id, payload):
+    if not SHARED_STATE:
+        return
+    now = time.time()
+    if kind == "notify":
+        write = (SQL_OUTBOX_INSERT, (now, json.dumps(dict(payload, device_id=device_id), ensure_ascii=False)))
+    else:
+        write = (SQL_BUS_INSERT, (now, os.getpid(), kind, device_id, json.dumps(payload, ensure_ascii=False)))
+    with bus_lock:
+        bus_pending.append(write)
+
+def take_bus_writes():
+    global bus_pending
+    with bus_lock:
+        batch, bus_pending = bus_pending, []
+    return batch
+
+def flush_bus():
+    writes = take_bus_writes()
+    if writes:
+        with db_write() as conn:
+            for sql, params in writes:
+                conn.execute(sql, params)
+
+def run_shared(step):
+    # step(conn) -> writes; виконується під замком запису SQLite (один крок на процес),
+    # пристрої крок змінює під їхніми lock. Стан збираємо вже після кроку
+    callbacks = []
+    with db_write() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        writes = step(conn)
+        writes += collect_dirty_state() + take_bus_writes()
+        for sql, params in writes:
+            if sql is AFTER_COMMIT:
+                callbacks.append(params)
+            else:
+                conn.execute(sql, params)
+    for callback in callbacks:
+        callback()
+    # Події, які створили колбеки після коміту
+    flush_bus()
+
+class BusPoller(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True, name="BusPollerThread")
+        self.last_id = 0
+
+    def run(self):
+        with db_read() as conn:
+            self.last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM bus").fetchone()[0]
+        cleanup_at = 0
+        while True:
+            time.sleep(BUS_POLL_INTERVAL)
+            try:
+                flush_bus()
+                self.poll_bus()
+                if is_leader:
+                    self.drain_outbox()
+                    if time.time() > cleanup_at:
+                        cleanup_at = time.time() + 60
+                        with db_write() as conn:
+                            conn.execute("DELETE FROM bus WHERE created < ?", (time.time() - BUS_RETENTION,))
+            except Exception as e:
+                logger.error(f"Bus poll error: {e}")
+
+    def poll_bus(self):
+        with db_read() as conn:
+            rows = conn.execute(SQL_BUS_TAIL, (self.last_id,)).fetchall()
+        pid = os.getpid()
+        for row in rows:
+            self.last_id = row["id"]
+            if row["origin"] == pid:
+                continue
+            payload = json.loads(row["payload"])
+            if row["kind"] == "version":
+                reload_device(row["device_id"])
+                if payload.get("outage"):
+                    refresh_outage_index(row["device_id"])
+                bump_local_version(row["device_id"], payload.get("outage", False))
+            elif row["kind"] == "event":
+                broker.publish(payload["type"], row["device_id"], payload["data"])
+
+    def drain_outbox(self):
+        with db_write() as conn:
+            rows = conn.execute("SELECT id, payload FROM outbox ORDER BY id").fetchall()
+            if rows:
+                conn.execute("DELETE FROM outbox WHERE id <= ?", (rows[-1]["id"],))
+        for row in rows:
+            p = json.loads(row["payload"])
+            notifier.send(Notification(TELEGRAM_CHAT_ID, p["text"], kind=p["kind"], device_id=p["device_id"],
+                                       keyboard=p.get("keyboard"), reply_to_outage=p["reply_to_outage"],
+                                       summary_line=p["summary_line"]))
+
+bus_poller = None   # BusPoller, лише у спільному режимі
+
+class LeaderElection(threading.Thread):
+    def __init__(self, on_elected):
+        super().__init__(daemon=True, name="LeaderElectionThread")
+        self.on_elected = on_elected
+        self.lock_file = None
+
+    def run(self):
+        global is_leader
+        # Файл тримаємо відкритим до кінця процесу - при закритті замок знімається
+        self.lock_file = open(LEADER_LOCK_FILE, "a")
+        while True:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                time.sleep(LEADER_RETRY)
+        is_leader = True
+        logger.info(f"Worker {os.getpid()} elected leader (watchdog + bot)")
+        self.on_elected()
+
 # ================= WEB & API (FOR HTML DASHBOARD) =================
 
-@app.route("/")
+@web_bp.route("/")
 def index():
     # Беремо назву з .env, або ставимо дефолтну
     title = os.getenv("LOCATION_NAME", "Energy Monitor")
     return render_template("index.html", page_title=title)
 
-@app.route("/api/stats")
+@web_bp.route("/api/devices")
+def api_devices():
+    return jsonify([
+        {"id": dev_id, "name": device_name(dev_id), "is_online": dev.is_online}
+        for dev_id, dev in sorted(snapshots.items())
+    ])
+
+@web_bp.route("/api/stats")
 def api_stats():
     # Отримуємо параметри дати
     start_str = request.args.get('start')
     end_str = request.args.get('end')
+    device_id = request.args.get('device') or DEFAULT_DEVICE_ID
+    dev = device_snapshot(device_id)
+    if dev is None:
+        return jsonify({"error": "Unknown device"}), 404
     
     now = datetime.now(TZ)
-    PROJECT_START_DATE = "2026-01-26" # Фіксуємо для бекенда теж
-    
+
     # Логіка дат за замовчуванням (7 днів)
-    if not start_str or not end_str:
-        end_dt = now
-        start_dt = end_dt - timedelta(days=7)
-    else:
-        try:
-            # Тут має бути 12 пробілів від початку рядка (4 для def, 4 для else, 4 для try)
-            start_dt = datetime.strptime(start_str, "%Y-%m-%d").replace(tzinfo=TZ)
-            end_dt = datetime.strptime(end_str, "%Y-%m-%d").replace(hour=23, minute=59, second=59, tzinfo=TZ)
-        except:
-             end_dt = now
-             start_dt = end_dt - timedelta(days=7)
+    # Діапазон завжди цілими добами - так його покриває daily_rollup
+    try:
+        start_day = datetime.strptime(start_str, "%Y-%m-%d").date()
+        end_day = datetime.strptime(end_str, "%Y-%m-%d").date()
+    except:
+        end_day = now.date()
+        start_day = end_day - timedelta(days=7)
 
     # Додаємо обмеження, щоб не брати сміття раніше 26.01
-    actual_start = max(start_dt, datetime.strptime(PROJECT_START_DATE, "%Y-%m-%d").replace(tzinfo=TZ))
+    start_day = max(start_day, datetime.strptime(PROJECT_START_DATE, "%Y-%m-%d").date())
+
+    # Більшість оновлень дашборду - це пошук у словнику і 304
+    etag, last_modified = stats_etag(dev, start_day, end_day)
+    key = (device_id, start_day, end_day)
+    with stats_cache_lock:
+        cached = stats_cache.get(key)
+        if cached is not None and cached[0] == etag:
+            stats_cache.move_to_end(key)
+    if cached is None or cached[0] != etag:
+        body = json.dumps(build_stats(dev, start_day, end_day, now), ensure_ascii=False)
+        cached = (etag, body)
+        with stats_cache_lock:
+            stats_cache[key] = cached
+            while len(stats_cache) > STATS_CACHE_SIZE:
+                stats_cache.popitem(last=False)
+
+    resp = current_app.response_class(cached[1], mimetype="application/json")
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    # no-cache = браузер може тримати копію, але щоразу перепитує (If-None-Match)
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+@web_bp.route("/api/outages")
+def api_outages():
+    # Список відключень сторінками, новіші першими: ?cursor= з older/newer попередньої відповіді.
+    # start/end (дні) - лише відключення цього діапазону, як у /api/stats
+    device_id = request.args.get('device') or DEFAULT_DEVICE_ID
+    if device_snapshot(device_id) is None:
+        return jsonify({"error": "Unknown device"}), 404
+    try:
+        limit = min(max(int(request.args.get('limit', OUTAGES_PAGE_SIZE)), 1), OUTAGES_PAGE_MAX)
+        parse_cursor(request.args.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Bad cursor or limit"}), 400
+    a = b = None
+    try:
+        start_day = datetime.strptime(request.args.get('start'), "%Y-%m-%d").date()
+        end_day = datetime.strptime(request.args.get('end'), "%Y-%m-%d").date()
+        a = day_start(start_day).timestamp()
+        b = day_start(end_day + timedelta(days=1)).timestamp() - 1
+    except:
+        pass
+    page = outage_page(device_id, request.args.get('cursor'), limit, a, b)
+    return jsonify({"device": device_id, "items": [outage_json(*item) for item in page["items"]],
+                    "older": page["older"], "newer": page["newer"]})
+
+@web_bp.route("/api/heartbeats")
+def api_heartbeats():
+    # Сирі пінги (resolution=raw) або агрегати 1m/1h з журналу heartbeat-ів
+    if hblog is None:
+        return jsonify({"error": "Heartbeat log disabled"}), 404
+    device_id = request.args.get('device') or DEFAULT_DEVICE_ID
+    if device_snapshot(device_id) is None:
+        return jsonify({"error": "Unknown device"}), 404
+    resolution = request.args.get('resolution', '1h')
+    if resolution not in ("raw", "1m", "1h"):
+        return jsonify({"error": "resolution must be raw, 1m or 1h"}), 400
 
-    # Формуємо SQL запит
-    conn = db()
-    cursor = conn.cursor()
-    
-    # Вибираємо відключення, які перетинаються з діапазоном
-    query = """
-        SELECT start_time, end_time, duration_minutes 
-        FROM outages 
-        WHERE start_time <= ? AND end_time >= ?
-        ORDER BY start_time DESC
-    """
-    cursor.execute(query, (end_dt.isoformat(), actual_start.isoformat()))
-    rows = cursor.fetchall()
-    conn.close()
-
-    outages_list = []
-    total_off_minutes = 0
-    # total_events = 0
-
-    # Додаємо активне відключення, якщо воно є в базі або в стейті
-    if not state["is_online"] and state.get("notification_sent"):
-        current_dur = (time.time() - state["outage_start"]) / 60
-        outages_list.append({
-            "start": datetime.fromtimestamp(state["outage_start"], TZ).isoformat(),
-            "end": None,
-            "duration_min": round(current_dur, 2),
-            "is_active": True
-        })
-        total_off_minutes += current_dur
+    try:
+        start_day = datetime.strptime(request.args.get('start'), "%Y-%m-%d").date()
+        end_day = datetime.strptime(request.args.get('end'), "%Y-%m-%d").date()
+    except:
+        end_day = datetime.now(TZ).date()
+        start_day = end_day - timedelta(days=1 if resolution == "raw" else 7)
+    # Сирі дані - лише за короткий проміжок, довші періоди - агрегатами
+    max_days = {"raw": HEARTBEAT_RAW_MAX_DAYS, "1m": 31}.get(resolution)
+    if max_days and (end_day - start_day).days >= max_days:
+        return jsonify({"error": f"Range too long for {resolution}, max {max_days} days"}), 400
+
+    start_ts = day_start(start_day).timestamp()
+    end_ts = day_start(end_day + timedelta(days=1)).timestamp() - 1
+    if resolution == "raw":
+        hblog.flush()
+        items = [{"ts": ts, "uptime": uptime, "boot_id": boot, "reason": reason, "ip": ip}
+                 for ts, uptime, boot, reason, ip, _ in hblog.samples(device_id, start_ts, end_ts)]
+    else:
+        items = hblog.aggregates(device_id, resolution, start_ts, end_ts)
+    return jsonify({"device": device_id, "resolution": resolution,
+                    "start": start_day.isoformat(), "end": end_day.isoformat(), "items": items})
 
-    for row in rows:
-        outages_list.append({
-            "start": row['start_time'],
-            "end": row['end_time'],
-            "duration_min": row['duration_minutes'],
-            "is_active": False
-        })
-        total_off_minutes += row['duration_minutes']
+@web_bp.route("/api/analytics")
+def api_analytics():
+    # MTBF/MTTR, перцентилі, теплова карта і серії за довільний діапазон; devices=a,b або all
+    try:
+        import analytics
+    except ImportError:
+        return jsonify({"error": "Analytics requires NumPy (pip install numpy)"}), 501
+    arg = request.args.get('devices') or request.args.get('device') or DEFAULT_DEVICE_ID
+    ids = sorted(snapshots) if arg == "all" else arg.split(",")
+    if any(device_snapshot(i) is None for i in ids):
+        return jsonify({"error": "Unknown device"}), 404
+
+    now = datetime.now(TZ)
+    try:
+        start_day = datetime.strptime(request.args.get('start'), "%Y-%m-%d").date()
+        end_day = datetime.strptime(request.args.get('end'), "%Y-%m-%d").date()
+    except:
+        end_day = now.date()
+        start_day = end_day - timedelta(days=90)
+    start_day = max(start_day, datetime.strptime(PROJECT_START_DATE, "%Y-%m-%d").date())
+    if end_day < start_day:
+        return jsonify({"error": "Empty range"}), 400
+
+    t0 = int(day_start(start_day).timestamp())
+    # Поточна доба - лише до зараз, інакше майбутнє рахувалось би як "світло було"
+    t1 = int(min(day_start(end_day + timedelta(days=1)).timestamp(), now.timestamp()))
+    if t1 <= t0:
+        return jsonify({"error": "Empty range"}), 400
+    utcoffset = lambda ts: int(datetime.fromtimestamp(ts, TZ).utcoffset().total_seconds())
+    result = {}
+    for dev_id in ids:
+        spans = outage_index(dev_id).overlap(t0, t1, active_span(device_snapshot(dev_id), t1))
+        result[dev_id] = analytics.reliability([start for start, _ in spans], [end for _, end in spans],
+                                               t0, t1, utcoffset)
+        result[dev_id]["name"] = device_name(dev_id)
+    return jsonify({"start": start_day.isoformat(), "end": end_day.isoformat(), "devices": result})
+
+def build_stats(dev, start_day, end_day, now):
+    device_id = dev.device_id
+    actual_start = day_start(start_day)
+    end_dt = day_start(end_day + timedelta(days=1)) - timedelta(seconds=1)
+
+    # Підсумки і графік - з добового rollup, кількість відключень - з індексу в пам'яті.
+    # Сам список віддає /api/outages сторінками
+    with db_read() as conn:
+        rollup = conn.execute(SQL_ROLLUP_RANGE, (device_id, start_day.isoformat(), end_day.isoformat())).fetchall()
+
+    daily = {}
+    d = start_day
+    while d <= end_day:
+        daily[d.isoformat()] = {"day": d.isoformat(), "off_seconds": 0, "outages": 0, "tech_failures": 0}
+        d += timedelta(days=1)
+    for r in rollup:
+        daily[r["day"]].update(off_seconds=r["off_seconds"], outages=r["outage_count"], tech_failures=r["tech_failure_count"])
+
+    a, b = actual_start.timestamp(), end_dt.timestamp()
+    # Активне - з того ж знімка dev, що й ETag
+    active = active_span(dev, now.timestamp())
+    total_events = outage_index(device_id).count(a, b, active)
+    if active and active[0] <= b:
+        # Активного відключення ще немає в rollup
+        for day, seconds in day_pieces(max(active[0], a), min(active[1], b)):
+            daily[day]["off_seconds"] += seconds
+            daily[day]["outages"] += 1
+
+    total_off_minutes = sum(v["off_seconds"] for v in daily.values()) / 60
 
     # Розрахунок загального часу діапазону для %
     total_range_min = (end_dt - actual_start).total_seconds() / 60
     if total_range_min <= 0: total_range_min = 1
-    
+
     off_percent = min(100, (total_off_minutes / total_range_min) * 100)
 
-    return jsonify({
-        "is_online": state["is_online"],
+    return {
+        "device": {"id": device_id, "name": device_name(device_id)},
+        "is_online": dev.is_online,
         "last_update": now.strftime("%Y-%m-%dT%H:%M:%S"), # ISO формат для надійного JS
         "stats": {
             "on_percent": round(100 - off_percent, 1),
             "off_percent": round(off_percent, 1),
             "on_hours": round((total_range_min - total_off_minutes) / 60, 1),
             "off_hours": round(total_off_minutes / 60, 1),
-            "total_events": len(outages_list),
-            "avg_duration": fmt((total_off_minutes / len(outages_list) * 60)) if outages_list else "0"
+            "total_events": total_events,
+            "avg_duration": fmt((total_off_minutes / total_events * 60)) if total_events else "0"
         },
         "meta": {
             "display_range": f"{actual_start.strftime('%d.%m')} - {end_dt.strftime('%d.%m')}"
         },
-        "outages": outages_list
-    })
+        "daily": [{"day": v["day"], "off_hours": round(v["off_seconds"] / 3600, 3),
+                   "outages": v["outages"], "tech_failures": v["tech_failures"]} for v in daily.values()]
+    }
+
+# --- Prometheus ---
+
+registry.gauge("power_monitor_device_online", "1 if the device is online, 0 otherwise",
+               lambda: [((dev_id,), int(dev.is_online)) for dev_id, dev in list(snapshots.items())], ("device",))
+registry.gauge("power_monitor_device_outage_notified", "1 while a notified outage is in progress",
+               lambda: [((dev_id,), int(not dev.is_online and dev.notification_sent))
+                        for dev_id, dev in list(snapshots.items())], ("device",))
+registry.gauge("power_monitor_ingest_queue_depth", "Writes waiting in the write-behind queue",
+               lambda: ingest.queue.qsize() if ingest else 0)
+registry.gauge("power_monitor_notifier_pending", "Notifications waiting to be sent",
+               lambda: notifier.inbox.qsize() + sum(len(q) for q in list(notifier.chats.values())) if notifier else 0)
+registry.gauge("power_monitor_sse_subscribers", "Open /api/stream connections",
+               lambda: len(broker.subscribers))
+registry.gauge("power_monitor_watchdog_deadlines", "Device deadlines queued in the watchdog heap",
+               lambda: deadlines.pending())
+registry.gauge("power_monitor_leader", "1 if this worker runs the watchdog and the bot", lambda: int(is_leader))
+
+@web_bp.route("/metrics")
+def metrics_endpoint():
+    # Метрики процесу; у WORKER_MODE=shared кожен воркер рахує своє
+    return current_app.response_class(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ================= EXPORT =================
+
+# Вивантаження історії за будь-який період (разом з архівом) у CSV або NDJSON:
+#   /api/export/outages.csv?device=home&start=2024-01-01&end=2025-12-31
+#   /api/export/system_events.ndjson?device=all
+# Рядки йдуть генератором з курсора SQLite і сегментів архіву шматками по EXPORT_CHUNK_BYTES
+# (chunked transfer), gzip - якщо клієнт його приймає (gzip=0 - вимкнути). Пам'ять не
+# залежить від довжини діапазону, а окреме з'єднання не забирає пул у дашборду.
+EXPORT_COLUMNS = {
+    "outages": ("device_id", "start_time", "end_time", "duration_minutes", "start_ts", "end_ts"),
+    "system_events": ("device_id", "time", "ts", "duration_minutes", "reason", "raw_reason"),
+    "ip_history": ("device_id", "time", "ts", "ip"),
+}
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+@web_bp.route("/api/export/<table>.<fmt>")
+def api_export(table, fmt):
+    if table not in EXPORT_COLUMNS or fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "Use /api/export/<outages|system_events|ip_history>.<csv|ndjson>"}), 404
+    arg = request.args.get('device') or DEFAULT_DEVICE_ID
+    ids = sorted(snapshots) if arg == "all" else [arg]
+    if any(device_snapshot(i) is None for i in ids):
+        return jsonify({"error": "Unknown device"}), 404
+    # Без start/end - уся історія
+    try:
+        start_day = datetime.strptime(request.args['start'], "%Y-%m-%d").date() if request.args.get('start') else None
+        end_day = datetime.strptime(request.args['end'], "%Y-%m-%d").date() if request.args.get('end') else None
+    except ValueError:
+        return jsonify({"error": "start/end must be YYYY-MM-DD"}), 400
+    start_ts = int(day_start(start_day).timestamp()) if start_day else None
+    end_ts = int(day_start(end_day + timedelta(days=1)).timestamp()) - 1 if end_day else None
+    compress = request.args.get('gzip') != "0" and request.accept_encodings["gzip"] > 0
+
+    if not export_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many exports in progress"}), 503, {"Retry-After": "10"}
+    name = "-".join([table, arg] + [d.isoformat() for d in (start_day, end_day) if d])
+    resp = current_app.response_class(export_stream(table, fmt, ids, start_ts, end_ts, compress),
+                                      mimetype=EXPORT_FORMATS[fmt])
+    # Слот звільняється, коли сервер закриває відповідь - і після обриву з'єднання теж
+    resp.call_on_close(export_slots.release)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{name}.{fmt}"'
+    resp.headers["Vary"] = "Accept-Encoding"
+    if compress:
+        resp.headers["Content-Encoding"] = "gzip"
+    return resp
+
+def export_stream(table, fmt, ids, start, end, compress):
+    columns = EXPORT_COLUMNS[table]
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None   # 31 - формат gzip
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    if writer:
+        writer.writerow(columns)
+
+    def take():
+        data = buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) if gz else data
+
+    count = 0
+    with pool.dedicated() as conn:
+        for device_id in ids:
+            for row in history_rows(table, device_id, start, end, conn=conn):
+                values = [row.get(c) for c in columns]
+                if writer:
+                    writer.writerow(values)
+                else:
+                    buf.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False) + "\n")
+                count += 1
+                if buf.tell() >= EXPORT_CHUNK_BYTES:
+                    data = take()
+                    if data:   # zlib може притримати вхід до наступного шматка
+                        yield data
+    yield take() + (gz.flush() if gz else b"")
+    EXPORTED_ROWS.inc(table, fmt, amount=count)
 
 # ================= API (POST) =================
 
-@app.route("/ping", methods=["POST"])
+@ingest_bp.route("/ping", methods=["POST"])
 def ping():
-    global last_auth_error_time
-
     # === DEBUG DEBUG DEBUG ===
     # 1. Отримуємо IP так, як його бачить Nginx
     # real_ip = request.headers.get('X-Real-IP') or request.remote_addr
@@ -282,534 +1988,818 @@ def ping():
     # =========================
 
     data = request.get_json(silent=True)
-    if not data: return "Bad Request: No JSON", 400
+    return handle_ping(data, request.headers.get('X-Real-IP') or request.remote_addr)
 
-    if data.get("key") != API_SECRET:
-        now = time.time()
-        if now - last_auth_error_time > 300:
-            last_auth_error_time = now
-            try:
-                ip = request.headers.get('X-Real-IP') or request.remote_addr
-                bot.send_message(TELEGRAM_CHAT_ID, f"⚠️ **AUTH ERROR**\nIP: `{ip}`", parse_mode="Markdown")
-            except: pass
+@ingest_bp.route("/ping/batch", methods=["POST"])
+def ping_batch():
+    data = request.get_json(silent=True)
+    return handle_ping_batch(data, request.headers.get('X-Real-IP') or request.remote_addr)
+
+def check_auth(data, remote_ip):
+    global last_auth_error_time
+    if data.get("key") == API_SECRET:
+        return True
+    now = time.time()
+    if now - last_auth_error_time > 300:
+        last_auth_error_time = now
+        notify(f"⚠️ **AUTH ERROR**\nIP: `{remote_ip}`", kind="auth")
+    return False
+
+def payload_str(value, default=None):
+    # Рядкові поля payload можуть прийти числом чи об'єктом - далі йдуть лише рядки
+    return default if value is None else str(value)
+
+def parse_heartbeat(data, now):
+    # payload ESP -> аргументи apply_heartbeat
+    return (str(data.get("device_id") or DEFAULT_DEVICE_ID), now, int(data.get("uptime", 0)),
+            payload_str(data.get("boot_id")), str(data.get("first")) == "1",
+            payload_str(data.get("ip")), payload_str(data.get("reason"), "N/A"))
+
+@observed("ping")
+def handle_ping(data, remote_ip):
+    # Спільне для Flask /ping і асинхронного приймача (ingest_async.py):
+    # повертає (тіло, статус[, заголовки])
+    if not data or not isinstance(data, dict): return "Bad Request: No JSON", 400
+
+    if not check_auth(data, remote_ip):
         return "Forbidden", 403
 
-    uptime = int(data.get("uptime", 0))
-    boot_id = data.get("boot_id")
-    first = str(data.get("first")) == "1" 
-    ip = data.get("ip")
-    raw_reason = data.get("reason", "N/A")
-    reason_ua = REASON_TRANSLATION.get(raw_reason, raw_reason)
+    hb = parse_heartbeat(data, time.time())
 
-    now = time.time()
+    if SHARED_STATE:
+        apply_shared_heartbeats([hb])
+        return "OK", 200
 
-    with lock:
-        old_ip = state.get("last_ip")
-        state["last_heartbeat"] = now
+    # Місце в черзі запису - до зміни стану; немає - просимо ESP повторити пізніше
+    if not ingest.reserve():
+        return "Busy", 503, {"Retry-After": "5"}
+    writes = []
+    try:
+        with mutating(get_device(hb[0])):
+            writes = apply_heartbeat(*hb)
+    finally:
+        # Диск - поза lock і поза запитом
+        ingest.submit_reserved(writes)
+    return "OK", 200
 
-        if ip and ip != old_ip:
-            state["last_ip"] = ip
-            try:
-                conn = db()
-                conn.execute("INSERT INTO ip_history VALUES (?, ?)", (datetime.now(TZ).isoformat(), ip))
-                conn.commit(); conn.close()
-            except: pass
+@observed("batch")
+def handle_ping_batch(data, remote_ip):
+    # Шлюз із кількома ESP32: одна перевірка ключа і одна транзакція
+    # на всю пачку. Відповідь - результат по кожному запису в тому ж порядку.
+    if not data or not isinstance(data, dict): return "Bad Request: No JSON", 400
 
-        if not state["is_online"]:
-            start_outage = state["outage_start"] or (now - 60)
-            time_restored = now
-            
-            is_hard_reboot = (first or (boot_id and boot_id != state.get("last_boot_id")))
-            if is_hard_reboot:
-                adjust = uptime if uptime > 60 else 120
-                time_restored = now - adjust
-
-            duration_off = (time_restored - start_outage) / 60
-
-            # 1. Довге відключення (було сповіщення)
-            if state.get("notification_sent", False):
-                
-                # === FIX START: Фільтрація технічних збоїв ===
-                TECH_ERRORS = ["Brownout", "Software Reset", "Watchdog", "Exception", "Panic"]
-                is_tech_error = any(err in raw_reason for err in TECH_ERRORS)
-
-                if is_tech_error:
-                    # Це був ТЕХНІЧНИЙ ЗБІЙ. Таймер "online_start" НЕ чіпаємо!
-                    try:
-                        conn = db()
-                        conn.execute("INSERT INTO system_events VALUES (?, ?, ?, ?)",
-                                     (datetime.fromtimestamp(time_restored, TZ).isoformat(),
-                                      duration_off, reason_ua, raw_reason))
-                        conn.commit(); conn.close()
-                    except: pass
-
-                    # Жовте повідомлення
-                    try:
-                        msg = (f"{get_header()}⚠️ **Зв'язок відновлено (після збою)**\n"
-                               f"⏱ Не було зв'язку: {fmt(duration_off * 60)}\n"
-                               f"ℹ️ Причина: {reason_ua}\n"
-                               f"✅ У статистику відключень не записано.")
-                        
-                        reply_to = state.get("last_outage_msg_id")
-                        bot.send_message(TELEGRAM_CHAT_ID, msg,
-                                         parse_mode="Markdown",
-                                         reply_markup=kb_notification(),
-                                         reply_to_message_id=reply_to)
-                        state["last_outage_msg_id"] = None
-                    except Exception as e: print(f"❌ SEND ERROR: {e}")
+    if not check_auth(data, remote_ip):
+        return "Forbidden", 403
 
-                else:
-                    # Це справжнє відключення - оновлюємо таймер
-                    state["online_start"] = time_restored 
+    entries = data.get("heartbeats")
+    if not isinstance(entries, list) or not entries:
+        return "Bad Request: No heartbeats", 400
+    if len(entries) > PING_BATCH_MAX:
+        return f"Too many heartbeats (max {PING_BATCH_MAX})", 413
 
-                    try:
-                        conn = db()
-                        conn.execute("INSERT INTO outages VALUES (?, ?, ?)",
-                                     (datetime.fromtimestamp(start_outage, TZ).isoformat(),
-                                      datetime.fromtimestamp(time_restored, TZ).isoformat(), duration_off))
-                        conn.commit(); conn.close()
-                    except: pass
-
-                    restored_dt = datetime.fromtimestamp(time_restored, TZ)
-                    try:
-                        msg = (f"{get_header()}🟢 **Відновлено електропостачання**\n"
-                               f"⏰ Увімкнули приблизно о {restored_dt.strftime('%H:%M, %d.%m')}\n"
-                               f"🪫 Світла не було: {fmt(duration_off * 60)}")
-                        if raw_reason != "N/A": msg += f"\nℹ️ Інфо: {reason_ua}"
-
-                        reply_to = state.get("last_outage_msg_id")
-                        bot.send_message(TELEGRAM_CHAT_ID, msg,
-                                         parse_mode="Markdown",
-                                         reply_markup=kb_notification(),
-                                         reply_to_message_id=reply_to)
-                        state["last_outage_msg_id"] = None
-                    except Exception as e: print(f"❌ SEND ERROR: {e}")
-                # === FIX END ===
-
-            # 2. Короткий збій (глюк, сповіщення не було)
-            else:
-                try:
-                    conn = db()
-                    conn.execute("INSERT INTO system_events VALUES (?, ?, ?, ?)", 
-                                 (datetime.fromtimestamp(time_restored, TZ).isoformat(), 
-                                  duration_off, reason_ua, raw_reason))
-                    conn.commit(); conn.close()
-                except: pass
-                
-                try:
-                    msg = (f"{get_header()}⚠️ **ЗАФІКСОВАНО ТЕХНІЧНИЙ ЗБІЙ**\n"
-                           f"⏱ Втрата зв'язку: {fmt(duration_off * 60)}\n"
-                           f"ℹ️ Причина: {reason_ua}\n"
-                           f"✅ Таймер світла працює далі (статистику не збито).")
-                    bot.send_message(TELEGRAM_CHAT_ID, msg, parse_mode="Markdown", reply_markup=kb_menu())
-                except Exception as e: print(f"❌ SEND ERROR: {e}")
+    now = time.time()
+    hbs, results = [], []
+    for entry in entries:
+        device_id = entry.get("device_id") if isinstance(entry, dict) else None
+        try:
+            if not device_id:
+                raise ValueError("device_id is required")
+            hbs.append(parse_heartbeat(entry, now))
+            results.append({"device_id": str(device_id), "status": "ok"})
+        except (TypeError, ValueError) as e:
+            results.append({"device_id": device_id, "status": "error", "error": str(e)})
+
+    if SHARED_STATE:
+        apply_shared_heartbeats(hbs)
+        return {"results": results}, 200
+
+    # Один слот на всю пачку, зайнятий до зміни стану: або всі записи підуть у чергу, або 503
+    if not ingest.reserve():
+        return "Busy", 503, {"Retry-After": "5"}
+    writes = []
+    try:
+        for hb in hbs:
+            with mutating(get_device(hb[0])):
+                writes += apply_heartbeat(*hb)
+    finally:
+        ingest.submit_reserved(writes)
+    return {"results": results}, 200
+
+def apply_shared_heartbeats(hbs):
+    # Інший воркер міг змінити стан - перечитуємо рядки в тій самій транзакції
+    def step(conn):
+        writes = []
+        for hb in hbs:
+            row = conn.execute(SQL_STATE_ROW, (hb[0],)).fetchone()
+            dev = device_for_row(row) if row else get_device(hb[0])
+            with mutating(dev):
+                if row:
+                    apply_state_row(dev, row)
+                writes += apply_heartbeat(*hb)
+        return writes
+    run_shared(step)
+
+def apply_heartbeat(device_id, now, uptime, boot_id, first, ip, raw_reason):
+    # Логіка одного пінгу. Викликається під mutating(пристрій); повертає записи для БД
+    reason_ua = REASON_TRANSLATION.get(raw_reason, raw_reason)
+    writes = []
+    log_heartbeat(device_id, now, uptime, ip)
+    if hblog:
+        hblog.append(device_id, now, uptime, boot_id, raw_reason, ip)
+    dev = get_device(device_id)
+    old_ip = dev.last_ip
+    dev.last_heartbeat = now
+    persist(dev, "last_heartbeat")
+
+    if ip and ip != old_ip:
+        dev.last_ip = ip
+        persist(dev, "last_ip")
+        writes.append((SQL_INSERT_IP, (datetime.fromtimestamp(now, TZ).isoformat(), ip, device_id, int(now))))
+
+    if not dev.is_online:
+        start_outage = dev.outage_start or (now - 60)
+        time_restored = now
+        
+        is_hard_reboot = (first or (boot_id and boot_id != dev.last_boot_id))
+        if is_hard_reboot:
+            adjust = uptime if uptime > 60 else 120
+            time_restored = now - adjust
 
-            state["is_online"] = True
-            state["outage_start"] = None
-            state["notification_sent"] = False 
+        duration_off = (time_restored - start_outage) / 60
 
-        if boot_id: state["last_boot_id"] = boot_id
-        save_state()
+        # 1. Довге відключення (було сповіщення)
+        if dev.notification_sent:
+            
+            # === FIX START: Фільтрація технічних збоїв ===
+            TECH_ERRORS = ["Brownout", "Software Reset", "Watchdog", "Exception", "Panic"]
+            is_tech_error = any(err in raw_reason for err in TECH_ERRORS)
+
+            if is_tech_error:
+                # Це був ТЕХНІЧНИЙ ЗБІЙ. Таймер "online_start" НЕ чіпаємо!
+                writes.append((SQL_INSERT_EVENT,
+                               (datetime.fromtimestamp(time_restored, TZ).isoformat(),
+                                duration_off, reason_ua, raw_reason, device_id, int(time_restored))))
+                writes.append(rollup_tech_write(device_id, int(time_restored)))
+                closed_event = ("tech_failure", {"duration_min": duration_off, "reason": raw_reason})
+
+                # Жовте повідомлення
+                msg = (f"{get_header(device_id)}⚠️ **Зв'язок відновлено (після збою)**\n"
+                       f"⏱ Не було зв'язку: {fmt(duration_off * 60)}\n"
+                       f"ℹ️ Причина: {reason_ua}\n"
+                       f"✅ У статистику відключень не записано.")
+                notify(msg, device_id, kind="restored", keyboard="notification",
+                       reply_to_outage=True)
 
-    return "OK", 200
+            else:
+                # Це справжнє відключення - оновлюємо таймер
+                dev.online_start = time_restored
+
+                writes.append((SQL_INSERT_OUTAGE,
+                               (datetime.fromtimestamp(start_outage, TZ).isoformat(),
+                                datetime.fromtimestamp(time_restored, TZ).isoformat(), duration_off, device_id,
+                                int(start_outage), int(time_restored))))
+                writes += rollup_outage_writes(device_id, int(start_outage), int(time_restored))
+                outage_index(device_id).add(int(start_outage), int(time_restored))
+                closed_event = ("outage_closed", {"start": start_outage, "end": time_restored,
+                                                  "duration_min": duration_off})
+
+                restored_dt = datetime.fromtimestamp(time_restored, TZ)
+                msg = (f"{get_header(device_id)}🟢 **Відновлено електропостачання**\n"
+                       f"⏰ Увімкнули приблизно о {restored_dt.strftime('%H:%M, %d.%m')}\n"
+                       f"🪫 Світла не було: {fmt(duration_off * 60)}")
+                if raw_reason != "N/A": msg += f"\nℹ️ Інфо: {reason_ua}"
+                notify(msg, device_id, kind="restored", keyboard="notification",
+                       reply_to_outage=True)
+            # === FIX END ===
+
+        # 2. Короткий збій (глюк, сповіщення не було)
+        else:
+            writes.append((SQL_INSERT_EVENT,
+                           (datetime.fromtimestamp(time_restored, TZ).isoformat(),
+                            duration_off, reason_ua, raw_reason, device_id, int(time_restored))))
+            writes.append(rollup_tech_write(device_id, int(time_restored)))
+            closed_event = ("tech_failure", {"duration_min": duration_off, "reason": raw_reason})
+
+            msg = (f"{get_header(device_id)}⚠️ **ЗАФІКСОВАНО ТЕХНІЧНИЙ ЗБІЙ**\n"
+                   f"⏱ Втрата зв'язку: {fmt(duration_off * 60)}\n"
+                   f"ℹ️ Причина: {reason_ua}\n"
+                   f"✅ Таймер світла працює далі (статистику не збито).")
+            notify(msg, device_id, kind="tech", keyboard="menu")
+
+        dev.is_online = True
+        dev.outage_start = None
+        dev.notification_sent = False
+        persist(dev, "is_online", "outage_start", "notification_sent", "online_start", urgent=True)
+        version_pending.add(device_id)
+        publish_status(dev, "online")
+        writes.append(after_commit(device_id, closed_event))
+        log_event(closed_event[0], device_id, **closed_event[1])
+
+    if boot_id and boot_id != dev.last_boot_id:
+        dev.last_boot_id = boot_id
+        persist(dev, "last_boot_id")
+
+    return writes
 
 # ================= WATCHDOG =================
 
+# Watchdog не опитує всі пристрої за таймером, а спить до найближчого терміну:
+# last_heartbeat + TIMEOUT_SECONDS для онлайн-пристрою, далі outage_start +
+# REAL_OUTAGE_THRESHOLD для сповіщення. Терміни - у мін-купі, по одному запису на
+# пристрій. Пінг лише відсуває due[пристрій] (O(1), купу не чіпає); запис, що
+# спрацював раніше фактичного терміну, повертається в купу з новим. Раніший термін
+# (новий пристрій, очікування сповіщення) додається в купу і будить watchdog.
+
+def next_deadline(dev):
+    # Коли watchdog має подивитись на пристрій (None - нічого не чекаємо)
+    if dev.is_online:
+        return dev.last_heartbeat + TIMEOUT_SECONDS
+    if not dev.notification_sent and dev.outage_start:
+        return dev.outage_start + REAL_OUTAGE_THRESHOLD * 60
+    return None
+
+class DeadlineScheduler:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []      # (термін, device_id)
+        self.queued = {}    # device_id -> термін його запису в купі
+        self.due = {}       # device_id -> фактичний термін
+
+    def schedule(self, device_id, at):
+        with self.cond:
+            if at is None:
+                self.due.pop(device_id, None)
+                return
+            self.due[device_id] = at
+            queued = self.queued.get(device_id)
+            if queued is not None and queued <= at:
+                return
+            # Старий запис (якщо є) стає застарілим і відкидається при виймані
+            self.queued[device_id] = at
+            heapq.heappush(self.heap, (at, device_id))
+            if self.heap[0][1] == device_id:
+                self.cond.notify()
+
+    def wait_due(self):
+        # Блокується до найближчого терміну; -> пристрої, чий термін настав
+        with self.cond:
+            while True:
+                now = time.time()
+                ready = []
+                while self.heap and self.heap[0][0] <= now:
+                    at, device_id = heapq.heappop(self.heap)
+                    if self.queued.get(device_id) != at:
+                        continue
+                    del self.queued[device_id]
+                    due = self.due.get(device_id)
+                    if due is None:
+                        continue
+                    if due > now:
+                        self.queued[device_id] = due
+                        heapq.heappush(self.heap, (due, device_id))
+                    else:
+                        ready.append(device_id)
+                if ready:
+                    return ready
+                self.cond.wait(self.heap[0][0] - now if self.heap else None)
+
+    def pending(self):
+        with self.cond:
+            return len(self.heap)
+
+deadlines = DeadlineScheduler()
+
 def watchdog():
+    if SHARED_STATE:
+        return watchdog_shared()
     while True:
-        time.sleep(10)
-        with lock:
-            if state["is_online"] and time.time() - state["last_heartbeat"] > TIMEOUT_SECONDS:
-                state["is_online"] = False
-                state["outage_start"] = state["last_heartbeat"]
-                state["notification_sent"] = False
-                save_state() 
-
-            if not state["is_online"] and not state.get("notification_sent", False):
-                current_duration_min = (time.time() - state["outage_start"]) / 60.0
-                
-                if current_duration_min > REAL_OUTAGE_THRESHOLD:
-                    state["notification_sent"] = True 
-                    
-                    was_on_duration = ""
-                    if state.get("online_start"):
-                        duration_on = state["outage_start"] - state["online_start"]
-                        if duration_on > 300: 
-                            was_on_duration = f"\n🔋 Світло було: {fmt(duration_on)}"
-
-                    off_dt = datetime.fromtimestamp(state['outage_start'], TZ)
-                    try:
-                        sent_msg = bot.send_message(TELEGRAM_CHAT_ID,
-                            f"{get_header()}🔴 **Відключили електропостачання**\n"
-                            f"⏰ Вимкнули приблизно о {off_dt.strftime('%H:%M, %d.%m')}{was_on_duration}",
-                            parse_mode="Markdown", reply_markup=kb_notification())
-                        
-                        # Зберігаємо ID повідомлення для майбутнього Reply
-                        state["last_outage_msg_id"] = sent_msg.message_id
-                        
-                    except Exception as e: print(f"❌ SEND ERROR: {e}")
-                    
-                    save_state()
+        due = deadlines.wait_due()
+        with WATCHDOG_LOOP.time():
+            for device_id in due:
+                # На виході mutating() ставить наступний термін (відключення -> поріг сповіщення)
+                with mutating(devices[device_id]) as dev:
+                    check_device_timeout(dev)
+
+def watchdog_shared():
+    # Пінги приймають інші воркери - свіжий last_heartbeat лише в БД. Пінг лише відсуває
+    # термін пристрою, а новий пристрій з'являється з терміном не раніше за наявні, тож
+    # спимо до найближчого терміну в таблиці (але не довше TIMEOUT_SECONDS)
+    while True:
+        with WATCHDOG_LOOP.time():
+            try: run_shared(watchdog_shared_step)
+            except Exception as e: logger.error(f"Watchdog error: {e}")
+        try:
+            with db_read() as conn:
+                at = conn.execute(SQL_STATE_NEXT_DEADLINE,
+                                  (TIMEOUT_SECONDS, REAL_OUTAGE_THRESHOLD * 60)).fetchone()[0]
+        except Exception as e:
+            logger.error(f"Watchdog error: {e}")
+            at = None
+        now = time.time()
+        time.sleep(min(max(at - now, 0.05), TIMEOUT_SECONDS) if at is not None else TIMEOUT_SECONDS)
+
+def watchdog_shared_step(conn):
+    for row in conn.execute(SQL_STATE_DUE, (time.time() - TIMEOUT_SECONDS,)).fetchall():
+        dev = device_for_row(row)
+        with mutating(dev):
+            check_device_timeout(apply_state_row(dev, row))
+    return []
+
+def check_device_timeout(dev):
+    changed = False
+    if dev.is_online and time.time() - dev.last_heartbeat > TIMEOUT_SECONDS:
+        dev.is_online = False
+        dev.outage_start = dev.last_heartbeat
+        dev.notification_sent = False
+        changed = True
+        publish_status(dev, "offline")
+
+    if not dev.is_online and not dev.notification_sent:
+        current_duration_min = (time.time() - dev.outage_start) / 60.0
+
+        if current_duration_min > REAL_OUTAGE_THRESHOLD:
+            dev.notification_sent = True
+            changed = True
+            publish_status(dev, "outage")
+
+            was_on_duration = ""
+            if dev.online_start:
+                duration_on = dev.outage_start - dev.online_start
+                if duration_on > 300:
+                    was_on_duration = f"\n🔋 Світло було: {fmt(duration_on)}"
+
+            off_dt = datetime.fromtimestamp(dev.outage_start, TZ)
+            # ID повідомлення для майбутнього Reply запише Notifier після відправки
+            notify(f"{get_header(dev.device_id)}🔴 **Відключили електропостачання**\n"
+                   f"⏰ Вимкнули приблизно о {off_dt.strftime('%H:%M, %d.%m')}{was_on_duration}",
+                   dev.device_id, kind="outage", keyboard="notification",
+                   summary_line=f"• {device_name(dev.device_id)} — {off_dt.strftime('%H:%M')}")
+
+    if changed:
+        persist(dev, "is_online", "outage_start", "notification_sent", urgent=True)
+        version_pending.add(dev.device_id)
 
 # ================= REPORT GENERATION =================
 
-def generate_daily_report_html():
+# Шаблон templates/report.html компілюється Jinja один раз. Блок завершених відключень
+# за день не змінюється, поки не запишеться нове відключення, тому кешується
+# за (device, day) і версією outage_versions; на кожен запит рахується лише активне.
+report_cache = {}   # (device_id, day) -> (outage_version, html, off_seconds)
+report_cache_lock = threading.Lock()
+outage_versions = {}
+
+def report_template():
+    return app.jinja_env.get_template("report.html")
+
+def finished_outages_section(device_id, start_of_day, now):
+    day = start_of_day.date().isoformat()
+    version = outage_versions.get(device_id, 0)
+    cached = report_cache.get((device_id, day))
+    if cached and cached[0] == version:
+        return cached[1]
+
+    idx = outage_index(device_id)
+    day_from, day_to = start_of_day.timestamp(), now.timestamp()
+    events = []
+    for start, end in reversed(idx.overlap(day_from, day_to)):
+        # Ефективний початок (не раніше 00:00); кінець уже в минулому
+        dur = end - max(start, day_from)
+        if dur <= 0:
+            continue
+        e_start = datetime.fromtimestamp(start, TZ)
+        e_end = datetime.fromtimestamp(end, TZ)
+        events.append({
+            "time": f"{e_start.strftime('%H:%M')} - {e_end.strftime('%H:%M')}",
+            # Якщо почалося вчора - показуємо оригінальний час, але додаємо помітку
+            "started": e_start.strftime('%d.%m') if e_start < start_of_day else None,
+            "duration": fmt(dur),
+            "active": False,
+        })
+    html = report_template().module.event_rows(events).strip()
+
+    with report_cache_lock:
+        # Тримаємо тільки поточний день
+        for key in [k for k in report_cache if k[1] != day]:
+            del report_cache[key]
+        report_cache[(device_id, day)] = (version, html)
+    return html
+
+def generate_daily_report_html(device_id=DEFAULT_DEVICE_ID):
+    dev = device_snapshot(device_id)
     now = datetime.now(TZ)
     # Початок сьогоднішнього дня (00:00:00)
-    start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    end_of_day = now # До поточного моменту
-
-    conn = db()
-    cursor = conn.cursor()
-    
-    # Шукаємо відключення:
-    # 1. Ті, що закінчилися сьогодні (end_time > 00:00)
-    # 2. Ті, що почалися сьогодні (start_time >= 00:00)
-    # 3. Ті, що ще тривають (активні)
-    
-    # Беремо трохи з запасом (вчора), а фільтрувати будемо в Python
-    query = """
-        SELECT start_time, end_time, duration_minutes 
-        FROM outages 
-        WHERE end_time >= ? OR start_time >= ?
-        ORDER BY start_time DESC
-    """
-    cursor.execute(query, (start_of_day.isoformat(), start_of_day.isoformat()))
-    rows = cursor.fetchall()
-    conn.close()
-
-    total_off_sec = 0
-    event_list_html = ""
-
-    # Додаємо поточне активне відключення, якщо є
-    active_event = None
-    if not state["is_online"] and state.get("notification_sent"):
-        active_start = datetime.fromtimestamp(state["outage_start"], TZ)
-        active_event = {
-            "start": active_start,
-            "end": now,
-            "is_active": True
-        }
-
-    # Обробка завершених відключень
-    for row in rows:
-        e_start = datetime.fromisoformat(row['start_time']).astimezone(TZ)
-        e_end = datetime.fromisoformat(row['end_time']).astimezone(TZ)
-
-        # Перевіряємо перетин з сьогоднішнім днем
-        # Ефективний початок (не раніше 00:00)
-        eff_start = max(e_start, start_of_day)
-        # Ефективний кінець (не пізніше зараз)
-        eff_end = min(e_end, end_of_day)
-
-        if eff_end > eff_start:
-            dur = (eff_end - eff_start).total_seconds()
-            total_off_sec += dur
-            
-            # Форматуємо рядок для HTML
-            # Якщо почалося вчора - показуємо оригінальний час, але додаємо помітку
-            time_str = f"{e_start.strftime('%H:%M')} - {e_end.strftime('%H:%M')}"
-            note = ""
-            if e_start < start_of_day:
-                note = f"<br><small>(почалось {e_start.strftime('%d.%m')})</small>"
-            
-            event_list_html += f"""
-            <div class="event-row">
-                <div class="icon red">🔴</div>
-                <div class="info">
-                    <div class="time">{time_str}{note}</div>
-                    <div class="dur">Тривалість: {fmt(dur)} (сьогодні)</div>
-                </div>
-            </div>
-            """
-
-    # Обробка активного (якщо є)
-    if active_event:
-        e_start = active_event["start"]
-        e_end = active_event["end"]
-        
-        eff_start = max(e_start, start_of_day)
-        eff_end = min(e_end, end_of_day)
-        
-        if eff_end > eff_start:
-            dur = (eff_end - eff_start).total_seconds()
-            total_off_sec += dur
-            
-            time_str = f"{e_start.strftime('%H:%M')} - ..."
-            note = ""
-            if e_start < start_of_day:
-                note = f"<br><small>(почалось {e_start.strftime('%d.%m')})</small>"
-
-            event_list_html = f"""
-            <div class="event-row active">
-                <div class="icon red pulse">⚡</div>
-                <div class="info">
-                    <div class="time">{time_str}{note}</div>
-                    <div class="dur">Триває вже: {fmt(dur)} (сьогодні)</div>
-                </div>
-            </div>
-            """ + event_list_html
-
-    # Підсумки
-    # total_period_sec = (end_of_day - start_of_day).total_seconds()
-    # off_percent = (total_off_sec / total_period_sec) * 100
-    # on_percent = 100 - off_percent
-
-    # --- ЗМІНА ЛОГІКИ: ДІЛИМО НА 24 ГОДИНИ (86400 сек) ---
+    start_of_day = day_start(now.date())
+
+    finished_html = finished_outages_section(device_id, start_of_day, now)
+    span = active_span(dev, now.timestamp())
+    total_off_sec = outage_index(device_id).off_seconds(start_of_day.timestamp(), now.timestamp(), span)
+
+    # Поточне активне відключення - окремим рядком, якщо є
+    active = None
+    if span:
+        e_start = datetime.fromtimestamp(span[0], TZ)
+        dur = (now - max(e_start, start_of_day)).total_seconds()
+        if dur > 0:
+            active = {
+                "time": f"{e_start.strftime('%H:%M')} - ...",
+                "started": e_start.strftime('%d.%m') if e_start < start_of_day else None,
+                "duration": fmt(dur),
+                "active": True,
+            }
+
+    # --- ДІЛИМО НА 24 ГОДИНИ (86400 сек) ---
     TOTAL_DAY_SECONDS = 24 * 60 * 60  # 86400
-    
+
     # Відсоток відключень від ВСІЄЇ ДОБИ
-    off_percent = (total_off_sec / TOTAL_DAY_SECONDS) * 100
-    if off_percent > 100: off_percent = 100 # На випадок збоїв часу
-    
-    # Решта - це світло (включно з майбутнім)
-    on_percent = 100 - off_percent
-    
-    # Час "Світло було/буде" - це 24г мінус "Світла не було"
-    total_on_sec = TOTAL_DAY_SECONDS - total_off_sec
-
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <style>
-            body {{ font-family: sans-serif; background: #f4f4f5; padding: 20px; color: #333; }}
-            .card {{ background: white; border-radius: 12px; padding: 20px; box-shadow: 0 2px 5px rgba(0,0,0,0.1); margin-bottom: 15px; }}
-            h2 {{ margin-top: 0; color: #2563eb; }}
-            .stats-grid {{ display: grid; grid-template-columns: 1fr 1fr; gap: 10px; margin-bottom: 20px; }}
-            .stat-box {{ background: #eff6ff; padding: 15px; border-radius: 8px; text-align: center; }}
-            .stat-val {{ font-size: 24px; font-weight: bold; display: block; }}
-            .stat-label {{ font-size: 12px; color: #666; }}
-            .red {{ color: #dc2626; background: #fef2f2; }}
-            .green {{ color: #16a34a; background: #dcfce7; }}
-            
-            .event-row {{ display: flex; align-items: center; padding: 10px 0; border-bottom: 1px solid #eee; }}
-            .event-row:last-child {{ border-bottom: none; }}
-            .icon {{ width: 30px; font-size: 18px; }}
-            .time {{ font-weight: bold; }}
-            .dur {{ font-size: 13px; color: #666; }}
-            .active {{ background: #fff1f2; padding: 10px; border-radius: 8px; border: 1px solid #fecdd3; }}
-            .pulse {{ animation: pulse 1s infinite; }}
-            @keyframes pulse {{ 0% {{ opacity: 1; }} 50% {{ opacity: 0.5; }} 100% {{ opacity: 1; }} }}
-        </style>
-    </head>
-    <body>
-        <div class="card">
-            <h2>📊 Звіт: {LOCATION_NAME}</h2>
-            <div>📅 Дата: <b>{now.strftime('%d.%m.%Y')}</b></div>
-            <div>⏱ Час звіту: {now.strftime('%H:%M')}</div>
-        </div>
-
-        <div class="stats-grid">
-            <div class="stat-box green">
-                <span class="stat-val">{round(on_percent, 1)}%</span>
-                <span class="stat-label">Світло було</span>
-                <small>{fmt(total_on_sec)}</small>
-            </div>
-            <div class="stat-box red">
-                <span class="stat-val">{round(off_percent, 1)}%</span>
-                <span class="stat-label">Без світла</span>
-                <small>{fmt(total_off_sec)}</small>
-            </div>
-        </div>
-
-        <div class="card">
-            <h3>📜 Історія за сьогодні</h3>
-            {event_list_html if event_list_html else "<div style='text-align:center; color:#999'>Світло не вимикали! 🎉</div>"}
-        </div>
-    </body>
-    </html>
-    """
+    off_percent = min(100, (total_off_sec / TOTAL_DAY_SECONDS) * 100) # На випадок збоїв часу
+
+    html = report_template().render(
+        title="Звіт", location=device_name(device_id),
+        period_label="Дата", period=now.strftime('%d.%m.%Y'), generated_at=now.strftime('%H:%M'),
+        # Решта - це світло (включно з майбутнім)
+        on_percent=round(100 - off_percent, 1), off_percent=round(off_percent, 1),
+        on_duration=fmt(TOTAL_DAY_SECONDS - total_off_sec), off_duration=fmt(total_off_sec),
+        active=active, finished_html=finished_html,
+    )
+    return io.BytesIO(html.encode('utf-8'))
+
+def generate_period_report_html(device_id=DEFAULT_DEVICE_ID, days=7):
+    # Тижневий/місячний звіт - лише з daily_rollup (days рядків), без сирих відключень
+    dev = device_snapshot(device_id)
+    now = datetime.now(TZ)
+    end_day = now.date()
+    start_day = end_day - timedelta(days=days - 1)
+    with db_read() as conn:
+        rollup = {r["day"]: r for r in conn.execute(SQL_ROLLUP_RANGE, (device_id, start_day.isoformat(), end_day.isoformat()))}
+
+    per_day = {}
+    for i in range(days):
+        d = (start_day + timedelta(days=i)).isoformat()
+        r = rollup.get(d)
+        per_day[d] = [r["off_seconds"], r["outage_count"], r["tech_failure_count"], r["longest_outage_seconds"]] if r else [0, 0, 0, 0]
+    active = active_span(dev, now.timestamp())
+    if active:
+        for d, seconds in day_pieces(max(active[0], day_start(start_day).timestamp()), active[1]):
+            if d in per_day:
+                per_day[d][0] += seconds
+                per_day[d][1] += 1
+                per_day[d][3] = max(per_day[d][3], active[1] - active[0])
+
+    total_off_sec = sum(v[0] for v in per_day.values())
+    total_sec = (now - day_start(start_day)).total_seconds() or 1
+    off_percent = min(100, total_off_sec / total_sec * 100)
+
+    html = report_template().render(
+        title="Звіт за тиждень" if days == 7 else f"Звіт за {days} днів", location=device_name(device_id),
+        period_label="Період", period=f"{start_day.strftime('%d.%m')} - {end_day.strftime('%d.%m.%Y')}",
+        generated_at=now.strftime('%H:%M'),
+        on_percent=round(100 - off_percent, 1), off_percent=round(off_percent, 1),
+        on_duration=fmt(total_sec - total_off_sec), off_duration=fmt(total_off_sec),
+        days=[{"date": datetime.strptime(d, "%Y-%m-%d").strftime('%d.%m'), "off": fmt(v[0]), "outages": v[1],
+               "tech_failures": v[2], "longest": fmt(v[3]) if v[3] else "—"} for d, v in reversed(per_day.items())],
+    )
     return io.BytesIO(html.encode('utf-8'))
 
 # ================= MENU & CONTROLS =================
 
+# Аргумент команди = device_id: "/status dacha", "/menu dacha"
+def command_device_id(message):
+    parts = (message.text or "").split(maxsplit=1)
+    return parts[1].strip() if len(parts) > 1 else None
+
+def no_device_text(device_id):
+    return f"❓ Пристрій `{device_id}` невідомий. Список: /devices" if device_id else "❓ Жоден пристрій ще не виходив на зв'язок."
+
 # 1. КОМАНДА /menu (ДЛЯ ЗАКРІПЛЕННЯ)
-@bot.message_handler(commands=['menu'])
-@bot.channel_post_handler(commands=['menu'])
+@bot_handler("message", commands=['menu'])
+@bot_handler("channel_post", commands=['menu'])
 def send_menu(message):
     try:
-        header = get_header()
+        dev = resolve_device(command_device_id(message))
+        device_id = dev.device_id if dev else DEFAULT_DEVICE_ID
+        header = get_header(device_id)
         msg = f"{header}🎛 **Панель керування**\n\n👇 Оберіть дію:"
         # Відправляємо з кнопками МЕНЮ (kb_menu)
-        bot.send_message(message.chat.id, msg, parse_mode="Markdown", reply_markup=kb_menu())
+        bot.send_message(message.chat.id, msg, parse_mode="Markdown", reply_markup=kb_menu(device_id))
     except Exception as e:
-        pass
+        logger.error(f"Menu error: {e}")
+
+# 2. КОМАНДА /devices (ВИБІР ЛОКАЦІЇ)
+@bot_handler("message", commands=['devices'])
+@bot_handler("channel_post", commands=['devices'])
+def send_devices(message):
+    try:
+        if not snapshots:
+            bot.send_message(message.chat.id, no_device_text(None))
+            return
+        lines = []
+        for dev_id, snap in sorted(snapshots.items()):
+            icon = "🟢" if snap.is_online else "🔴"
+            lines.append(f"{icon} {device_name(dev_id)} (`{dev_id}`)")
+        msg = "📍 **Пристрої:**\n" + "\n".join(lines)
+        bot.send_message(message.chat.id, msg, parse_mode="Markdown", reply_markup=kb_devices())
+    except Exception as e:
+        logger.error(f"Devices error: {e}")
+
+def status_text(dev):
+    now = time.time()
+    if dev.is_online:
+        start_t = dev.online_start or dev.last_heartbeat
+        dur = now - start_t
+        start_dt = datetime.fromtimestamp(start_t, TZ).strftime('%H:%M, %d.%m')
+        return (f"🟢 Світло є вже: {fmt(dur)}\n"
+                f"⏰ З'явилось о: {start_dt}")
+    start_t = dev.outage_start or now
+    dur = now - start_t
+    start_dt = datetime.fromtimestamp(start_t, TZ).strftime('%H:%M, %d.%m')
+    status = f"🔴 Світла немає вже: {fmt(dur)}" if dev.notification_sent else f"🟡 Немає зв'язку: {fmt(dur)} (перевірка...)"
+    return f"{status}\n⏰ Зникло о: {start_dt}"
+
+def history_text(device_id, page):
+    # page - з outage_page(); активне відключення (якщо є) - першим рядком
+    title = "Останні відключення" if page["newer"] is None else "Відключення"
+    msg = f"{get_header(device_id)}📜 **{title}:**\n```\n"
+    if not page["items"]: msg += "Записів немає."
+    for start, end, is_active in page["items"]:
+        start_dt = datetime.fromtimestamp(start, TZ)
+        if is_active:
+            # Вирівнювання з додатковим пробілом: {HH:MM}- ...  |
+            msg += f"{start_dt.strftime('%d.%m %H:%M')}- ...  | {fmt(end - start)}\n"
+        else:
+            end_str = datetime.fromtimestamp(end, TZ).strftime('%H:%M')
+            msg += f"{start_dt.strftime('%d.%m %H:%M')}-{end_str} | {fmt(end - start)}\n"
+    msg += "```"
+    return msg
+
+def send_history(chat_id, device_id):
+    page = outage_page(device_id)
+    bot.send_message(chat_id, history_text(device_id, page), parse_mode="Markdown",
+                     reply_markup=kb_history(device_id, page))
 
 # ================= BUTTON HANDLER =================
 
-@bot.callback_query_handler(func=lambda c: True)
+@bot_handler("callback_query", func=lambda c: True)
 def handle_buttons(call):
     chat_id = call.message.chat.id
-    
+    # Старі кнопки (без ":device") відносяться до дефолтного пристрою
+    action, _, device_id = call.data.partition(":")
+    device_id = device_id or DEFAULT_DEVICE_ID
+
     # === A. КНОПКА СТАТУСУ (ОНОВИТИ) ===
-    if call.data == "status":
-        with lock:
-            now = time.time()
-            header = get_header().replace("**", "") 
-            
-            if state["is_online"]:
-                start_t = state.get("online_start", state["last_heartbeat"])
-                dur = now - start_t
-                start_dt = datetime.fromtimestamp(start_t, TZ).strftime('%H:%M, %d.%m')
-                text_main = (f"🟢 Світло є вже: {fmt(dur)}\n"
-                             f"⏰ З'явилось о: {start_dt}")
-            else:
-                start_t = state["outage_start"] or now
-                dur = now - start_t
-                start_dt = datetime.fromtimestamp(start_t, TZ).strftime('%H:%M, %d.%m')
-                status_text = f"🔴 Світла немає вже: {fmt(dur)}" if state.get("notification_sent") else f"🟡 Немає зв'язку: {fmt(dur)} (перевірка...)"
-                text_main = (f"{status_text}\n⏰ Зникло о: {start_dt}")
-            
-            # Якщо це меню - оновлюємо текст і показуємо kb_menu
-            if "Панель керування" in call.message.text or "Оберіть дію" in call.message.text:
-                 full_text = f"{header}🎛 **Панель керування**\n\n{text_main}\n\n👇 Оберіть дію:"
-                 try: 
-                     bot.edit_message_text(full_text, chat_id, call.message.message_id, parse_mode="Markdown", reply_markup=kb_menu())
-                     bot.answer_callback_query(call.id, "✅ Дані оновлено")
-                 except: 
-                     bot.answer_callback_query(call.id, "Вже актуально")
-            else:
-                 # Якщо це сповіщення - показуємо Alert і не чіпаємо кнопки (kb_notification лишається)
-                 alert_text = text_main.replace("\n"," \n")
-                 try: bot.answer_callback_query(call.id, alert_text, show_alert=True)
-                 except: pass
-                 
+    if action == "status":
+        dev = device_snapshot(device_id)
+        header = get_header(device_id).replace("**", "")
+        text_main = status_text(dev) if dev else no_device_text(device_id)
+
+        # Якщо це меню - оновлюємо текст і показуємо kb_menu
+        if "Панель керування" in call.message.text or "Оберіть дію" in call.message.text:
+             full_text = f"{header}🎛 **Панель керування**\n\n{text_main}\n\n👇 Оберіть дію:"
+             try:
+                 bot.edit_message_text(full_text, chat_id, call.message.message_id, parse_mode="Markdown", reply_markup=kb_menu(device_id))
+                 bot.answer_callback_query(call.id, "✅ Дані оновлено")
+             except:
+                 bot.answer_callback_query(call.id, "Вже актуально")
+        else:
+             # Якщо це сповіщення - показуємо Alert і не чіпаємо кнопки (kb_notification лишається)
+             alert_text = text_main.replace("\n"," \n")
+             try: bot.answer_callback_query(call.id, alert_text, show_alert=True)
+             except: pass
+
     # === B. КНОПКА ЗВІТУ (ФАЙЛ) ===
-    elif call.data == "stats":
+    elif action == "stats":
         try:
             bot.answer_callback_query(call.id, "📊 Генерую звіт...")
-            file_obj = generate_daily_report_html()
+            file_obj = generate_daily_report_html(device_id)
             # ФІКС ЧАСУ ДЛЯ НАЗВИ ФАЙЛУ (TZ)
             file_obj.name = f"Звіт_{datetime.now(TZ).strftime('%d_%m')}.html"
             bot.send_document(chat_id, file_obj, caption="📊 **Ваш звіт за сьогодні**", parse_mode="Markdown")
         except Exception as e:
-            pass
+            logger.error(f"Daily report error: {e}")
 
-     # === C. КНОПКА ІСТОРІЇ (ТЕКСТ 10 шт) ===
-    elif call.data == "history":
+    # === B2. ТИЖНЕВИЙ / МІСЯЧНИЙ ЗВІТ (З ROLLUP) ===
+    elif action in ("week", "month"):
+        try:
+            bot.answer_callback_query(call.id, "📊 Генерую звіт...")
+            send_period_report(chat_id, device_id, 7 if action == "week" else 30)
+        except Exception as e:
+            logger.error(f"Period report error: {e}")
+
+     # === C. КНОПКА ІСТОРІЇ (ПЕРША СТОРІНКА) ===
+    elif action == "history":
         try:
             bot.answer_callback_query(call.id, "📜 Шукаю дані...")
-            
-            conn = db()
-            cursor = conn.cursor()
-            # Беремо 10, але потім підріжемо якщо треба
-            cursor.execute("SELECT start_time, end_time, duration_minutes FROM outages ORDER BY start_time DESC LIMIT 10")
-            rows = cursor.fetchall()
-            conn.close()
+            send_history(chat_id, device_id)
+        except Exception as e:
+            logger.error(f"History error: {e}")
 
-            msg = f"{get_header()}📜 **Останні 10 відключень:**\n```\n"
-            
-            # --- ЛОГІКА АКТИВНОГО ВІДКЛЮЧЕННЯ ---
-            is_active_outage = not state["is_online"] and state.get("notification_sent")
-            
-            if is_active_outage:
-                start_ts = state["outage_start"]
-                start_dt = datetime.fromtimestamp(start_ts, TZ)
-                duration = time.time() - start_ts
-                # Вирівнювання з додатковим пробілом: {HH:MM}- ...  |
-                msg += f"{start_dt.strftime('%d.%m %H:%M')}- ...  | {fmt(duration)}\n"
-                
-                # Якщо є активне, залишаємо тільки 9 архівних (щоб сума була 10)
-                if len(rows) > 9:
-                    rows = rows[:9]
-            # -------------------------------------
-
-            if not rows and not is_active_outage: msg += "Записів немає."
-            else:
-                for row in rows:
-                    start = datetime.fromisoformat(row[0]).astimezone(TZ)
-                    end_str = "??"
-                    if row[1]:
-                        end = datetime.fromisoformat(row[1]).astimezone(TZ)
-                        end_str = end.strftime('%H:%M') 
-                    dur = row[2]
-                    msg += f"{start.strftime('%d.%m %H:%M')}-{end_str} | {fmt(dur*60)}\n"
-            msg += "```"
-            
-            bot.send_message(chat_id, msg, parse_mode="Markdown")
-        except Exception as e: 
-            print(f"History error: {e}")
+    # === C2. ◀️ СТАРІШІ / НОВІШІ ▶️ - ПЕРЕГОРТАЄМО ТЕ САМЕ ПОВІДОМЛЕННЯ ===
+    elif action == "hpage":
+        cursor, _, device_id = device_id.partition(":")
+        device_id = device_by_token(device_id) or DEFAULT_DEVICE_ID
+        try:
+            page = outage_page(device_id, cursor)
+            bot.edit_message_text(history_text(device_id, page), chat_id, call.message.message_id,
+                                  parse_mode="Markdown", reply_markup=kb_history(device_id, page))
+            bot.answer_callback_query(call.id)
+        except Exception as e:
+            logger.error(f"History page error: {e}")
+            try: bot.answer_callback_query(call.id, "Вже актуально")
+            except: pass
+
+    # === D. ВИБІР ПРИСТРОЮ (/devices) ===
+    elif action == "menu":
+        try:
+            bot.answer_callback_query(call.id)
+            msg = f"{get_header(device_id)}🎛 **Панель керування**\n\n👇 Оберіть дію:"
+            bot.send_message(chat_id, msg, parse_mode="Markdown", reply_markup=kb_menu(device_id))
+        except Exception as e:
+            logger.error(f"Menu error: {e}")
 
 # ================= OTHER COMMANDS =================
 
-@bot.message_handler(commands=['last', 'history'])
-@bot.channel_post_handler(commands=['last', 'history'])
-def handle_last_events(message):
+def send_period_report(chat_id, device_id, days):
+    file_obj = generate_period_report_html(device_id, days)
+    file_obj.name = f"Звіт_{days}д_{datetime.now(TZ).strftime('%d_%m')}.html"
+    caption = "📅 **Звіт за тиждень**" if days == 7 else f"🗓 **Звіт за {days} днів**"
+    bot.send_document(chat_id, file_obj, caption=caption, parse_mode="Markdown")
+
+@bot_handler("message", commands=['week', 'month'])
+@bot_handler("channel_post", commands=['week', 'month'])
+def handle_period_report(message):
     try:
-        conn = db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT start_time, end_time, duration_minutes FROM outages ORDER BY start_time DESC LIMIT 10")
-        rows = cursor.fetchall()
-        conn.close()
+        dev = resolve_device(command_device_id(message))
+        device_id = dev.device_id if dev else DEFAULT_DEVICE_ID
+        days = 7 if message.text.startswith("/week") else 30
+        send_period_report(message.chat.id, device_id, days)
+    except Exception as e:
+        bot.send_message(message.chat.id, f"❌ Error: {e}")
 
-        msg = f"{get_header()}📜 **Останні 10 відключень:**\n```\n"
-        
-        is_active_outage = not state["is_online"] and state.get("notification_sent")
-        
-        if is_active_outage:
-            start_ts = state["outage_start"]
-            start_dt = datetime.fromtimestamp(start_ts, TZ)
-            duration = time.time() - start_ts
-            # Вирівнювання з додатковим пробілом
-            msg += f"{start_dt.strftime('%d.%m %H:%M')}- ...  | {fmt(duration)}\n"
-            if len(rows) > 9:
-                rows = rows[:9]
-
-        if not rows and not is_active_outage: msg += "Записів немає."
-        else:
-            for row in rows:
-                start = datetime.fromisoformat(row[0]).astimezone(TZ)
-                end_str = "??"
-                if row[1]:
-                    end = datetime.fromisoformat(row[1]).astimezone(TZ)
-                    end_str = end.strftime('%H:%M')
-                dur = row[2]
-                msg += f"{start.strftime('%d.%m %H:%M')}-{end_str} | {fmt(dur*60)}\n"
-        msg += "```"
-        
-        bot.send_message(message.chat.id, msg, parse_mode="Markdown")
+@bot_handler("message", commands=['last', 'history'])
+@bot_handler("channel_post", commands=['last', 'history'])
+def handle_last_events(message):
+    try:
+        dev = resolve_device(command_device_id(message))
+        device_id = dev.device_id if dev else (command_device_id(message) or DEFAULT_DEVICE_ID)
+        send_history(message.chat.id, device_id)
     except Exception as e:
         bot.send_message(message.chat.id, f"❌ Error: {e}")
 
-@bot.message_handler(commands=['debug', 'info'])
-@bot.channel_post_handler(commands=['debug', 'info'])
+@bot_handler("message", commands=['debug', 'info'])
+@bot_handler("channel_post", commands=['debug', 'info'])
 def handle_debug(message):
-    with lock:
-        boot_id = state.get("last_boot_id", "Unknown")
-        ip = state.get("last_ip", "Unknown")
-        reason = state.get("last_reason", "N/A")
-        msg = (f"{get_header()}🛠 **Технічна інфо:**\n🌐 IP: `{ip}`\n🆔 Boot ID: `{boot_id}`\nℹ️ Last Reboot: {reason}")
+    dev = resolve_device(command_device_id(message))
+    if dev is None:
+        msg = no_device_text(command_device_id(message))
+    else:
+        boot_id = dev.last_boot_id or "Unknown"
+        ip = dev.last_ip or "Unknown"
+        reason = "N/A"
+        msg = (f"{get_header(dev.device_id)}🛠 **Технічна інфо:**\n🆔 Device: `{dev.device_id}`\n"
+               f"🌐 IP: `{ip}`\n🆔 Boot ID: `{boot_id}`\nℹ️ Last Reboot: {reason}")
     bot.send_message(message.chat.id, msg, parse_mode="Markdown")
 
-@bot.message_handler(commands=["status", "start"])
+@bot_handler("message", commands=["status", "start"])
 def handle_status_private(message):
-    with lock:
-        now = time.time()
-        header = get_header()
-        if state["is_online"]:
-            dur = now - state.get("online_start", state["last_heartbeat"])
+    now = time.time()
+    dev = resolve_device(command_device_id(message))
+    if dev is None:
+        msg = no_device_text(command_device_id(message))
+        device_id = DEFAULT_DEVICE_ID
+    else:
+        device_id = dev.device_id
+        header = get_header(device_id)
+        if dev.is_online:
+            dur = now - (dev.online_start or dev.last_heartbeat)
             msg = f"{header}🟢 Світло є вже: {fmt(dur)}"
         else:
-            dur = now - (state["outage_start"] or now)
+            dur = now - (dev.outage_start or now)
             msg = f"{header}🔴 Світла немає вже: {fmt(dur)}"
     # Приватні команди теж отримують розширену клавіатуру
-    try: bot.send_message(message.chat.id, msg, reply_markup=kb_notification())
+    try: bot.send_message(message.chat.id, msg, reply_markup=kb_notification(device_id))
     except: pass
 
 # ================= AUTO-STARTUP =================
 
-init_db()
+# Точка входу - create_app(); підсистеми стартують явно і лише ті, що увімкнені:
+#   gunicorn -k gthread --threads 32 'myhome:create_app()'
+#   gunicorn --preload ... 'myhome:create_app(start="fork")'   # потоки - у воркерах, не в майстрі
+#   SUBSYSTEMS=ingest gunicorn ... 'myhome:create_app()'        # воркер лише на пінги
+running = set()          # підсистеми, запущені в цьому процесі
+leader_election = None   # посилання живе, поки живе процес: файл замка не закривається
 
-if not any(t.name == "WatchdogThread" for t in threading.enumerate()):
-    logger.info("Starting Watchdog thread...")
-    threading.Thread(target=watchdog, daemon=True, name="WatchdogThread").start()
+def create_app(subsystems=None, start=True):
+    """Flask-додаток з маршрутами обраних підсистем.
 
-if not any(t.name == "BotThread" for t in threading.enumerate()):
+    subsystems - рядок "ingest,web" або список (типово SUBSYSTEMS з env).
+    start=True запускає підсистеми одразу; "fork" - у кожному дочірньому процесі
+    після fork (майстер Gunicorn з --preload лише будує додаток); False - не запускає.
+    """
+    global app
+    if subsystems is None or isinstance(subsystems, str):
+        subsystems = (subsystems or SUBSYSTEMS).split(",")
+    enabled = [name.strip() for name in subsystems if name.strip()]
+    unknown = set(enabled) - set(ALL_SUBSYSTEMS)
+    if unknown:
+        raise ValueError(f"Unknown subsystems: {', '.join(sorted(unknown))}")
+
+    setup_logging()
+    app = Flask(__name__,
+                template_folder='templates',
+                static_folder='static',
+                static_url_path='/static')
+    if "web" in enabled:
+        app.register_blueprint(web_bp)
+    if "ingest" in enabled:
+        app.register_blueprint(ingest_bp)
+
+    if start == "fork":
+        os.register_at_fork(after_in_child=lambda: start_subsystems(enabled))
+    elif start:
+        start_subsystems(enabled)
+    return app
+
+def start_subsystems(enabled):
+    global ingest, state_flusher, bus_poller, hblog, leader_election
+    if running:
+        return
+    running.update(enabled)
+    logger.info(f"Starting subsystems: {', '.join(enabled) or 'none'} (pid {os.getpid()})")
+
+    # Сховище потрібне всім: стан пристроїв, черга запису і скидання стану
+    ingest = IngestWriter()
+    state_flusher = StateFlusher()
+    init_db()
+    load_state()
+    load_outage_index()
+    ingest.start()
+    # При зупинці процесу дописуємо все, що лишилось у черзі
+    atexit.register(ingest.stop)
+    state_flusher.start()
+    atexit.register(state_flusher.stop)
+
+    if HEARTBEAT_LOG:
+        # Окремий файл на процес: у спільному режимі воркери не дописують в один сегмент.
+        # Без ingest журнал лише читається (/api/heartbeats)
+        hblog = tsstore.HeartbeatStore(HEARTBEAT_DIR, writer=str(os.getpid()) if SHARED_STATE else "main")
+        if "ingest" in running:
+            hblog.start()
+            atexit.register(hblog.stop)
+
+    if "ingest" in running and ASYNC_INGEST_PORT:
+        import ingest_async
+        ingest_async.start_in_thread(ASYNC_INGEST_HOST, ASYNC_INGEST_PORT, {"/ping": handle_ping, "/ping/batch": handle_ping_batch})
+
+    if SHARED_STATE:
+        bus_poller = BusPoller()
+        bus_poller.start()
+        # Лідер - це watchdog і бот разом; воркери без них (SUBSYSTEMS=ingest,web) не претендують
+        if {"watchdog", "bot"} <= running:
+            leader_election = LeaderElection(start_leader_services)
+            leader_election.start()
+    else:
+        start_leader_services()
+
+def start_leader_services():
+    # Лише один процес на інсталяцію: сповіщення, watchdog і polling Telegram
+    if "bot" in running:
+        start_bot()
+
+    if "watchdog" in running:
+        logger.info("Starting Watchdog thread...")
+        threading.Thread(target=watchdog, daemon=True, name="WatchdogThread").start()
+        if RETENTION_DAYS:
+            threading.Thread(target=retention_loop, daemon=True, name="RetentionThread").start()
+
+def start_bot():
+    # telebot (з requests) імпортується лише тут - воркерам без бота він не потрібен
+    global bot, notifier
+    import telebot
+    if TG_API_URL:
+        telebot.apihelper.API_URL = TG_API_URL.rstrip("/") + "/bot{0}/{1}"
+    bot = telebot.TeleBot(TELEGRAM_TOKEN)
+    for kind, kwargs, fn in bot_handlers:
+        getattr(bot, f"register_{kind}_handler")(fn, **kwargs)
+
+    notifier = Notifier()
+    notifier.start()
+    atexit.register(notifier.stop)
     logger.info("Starting Telegram Bot thread...")
     threading.Thread(target=bot.infinity_polling, daemon=True, name="BotThread").start()
 
 if __name__ == "__main__":
+    if "--rebuild-rollup" in sys.argv:
+        setup_logging()
+        init_db()
+        with db_write() as conn:
+            rebuild_rollup(conn)
+        logger.info("Daily rollup rebuilt from raw tables")
+        sys.exit(0)
+    if "--archive" in sys.argv:
+        # Перенести старі рядки в архів зараз, не чекаючи retention-задачі
+        setup_logging()
+        init_db()
+        logger.info(f"Archived: {archive_old_rows() or 'nothing to move'}")
+        sys.exit(0)
+    create_app()
     logger.info(f"Manual run detected. Server starting on port {PORT}")
     app.run(host="0.0.0.0", port=PORT, use_reloader=False)
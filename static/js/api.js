@@ -1,13 +1,66 @@
+async function loadDevices() {
+    try {
+        const res = await fetch('api/devices', {cache: 'no-cache'});
+        const list = await res.json();
+        const sel = document.getElementById('deviceSelect');
+        // id приходить з /ping без перевірки - лише як текст, не як HTML
+        sel.replaceChildren(...list.map(d => new Option(d.name, d.id)));
+        // Один пристрій - селектор не потрібен
+        sel.style.display = list.length > 1 ? '' : 'none';
+        if (list.length && !list.some(d => d.id === AppState.deviceId)) AppState.deviceId = list[0].id;
+        if (AppState.deviceId) sel.value = AppState.deviceId;
+    } catch(e) {
+        console.error("API Error:", e);
+    }
+}
+
 async function loadData(params) {
     document.getElementById('loader').classList.add('show');
+    const device = AppState.deviceId ? `&device=${encodeURIComponent(AppState.deviceId)}` : '';
     try {
-        const res = await fetch(`api/stats?${params}&nocache=${Date.now()}`);
+        // no-cache: браузер сам шле If-None-Match, сервер відповідає 304, якщо дані ті самі
+        const res = await fetch(`api/stats?${params}${device}`, {cache: 'no-cache'});
         const data = await res.json();
-        AppState.lastOutages = data.outages;
+        AppState.lastDaily = data.daily;
+        AppState.live.events = data.stats.total_events;
+        // Активне відключення сервер порахував до last_update (з тим самим тілом при 304)
+        AppState.live.offCountedTo = data.is_online ? null : new Date(data.last_update).getTime() / 1000;
         updateUI(data);
+        loadOutages(`${params}${device}`);
     } catch(e) { 
         console.error("API Error:", e);
     } finally {
         setTimeout(() => document.getElementById('loader').classList.remove('show'), 200);
     }
 }
+
+// Список відключень - сторінками з api/outages (курсор, а не зсув).
+// query - новий діапазон/пристрій (список з початку), без нього - наступна сторінка
+async function loadOutages(query) {
+    const st = AppState.outages;
+    if (query !== undefined) {
+        st.gen++;
+        st.query = query;
+        st.cursor = null;
+    } else if (st.loading || !st.cursor) {
+        return;
+    }
+    const gen = st.gen;
+    const cursor = st.cursor ? `&cursor=${encodeURIComponent(st.cursor)}` : '';
+    st.loading = true;
+    try {
+        const res = await fetch(`api/outages?${st.query}${cursor}`, {cache: 'no-cache'});
+        const page = await res.json();
+        // Поки чекали, діапазон змінився - ця сторінка вже не потрібна
+        if (gen !== st.gen) return;
+        renderOutages(page.items, !!cursor);
+        st.cursor = page.older;
+    } catch(e) {
+        console.error("API Error:", e);
+    } finally {
+        if (gen === st.gen) {
+            st.loading = false;
+            watchOutagesEnd();
+        }
+    }
+}
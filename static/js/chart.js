@@ -1,16 +1,12 @@
-function renderChart(outages, sIso, eIso) {
+function renderChart(daily) {
     const isDark = document.documentElement.getAttribute('data-theme') === 'dark';
     const ctx = document.getElementById('mainChart').getContext('2d');
     if(AppState.chartInstance) AppState.chartInstance.destroy();
 
+    // Сервер вже віддає погодинні суми по днях (daily_rollup), без перерахунку тут
     const map = {};
-    for(let d = new Date(sIso); d <= new Date(eIso); d.setDate(d.getDate()+1)) {
-        map[d.toLocaleDateString('uk-UA')] = {off: 0};
-    }
-
-    outages.forEach(ev => {
-        const k = new Date(ev.start.replace(' ', 'T')).toLocaleDateString('uk-UA');
-        if(map[k]) map[k].off += (ev.duration_min / 60);
+    daily.forEach(d => {
+        map[new Date(d.day + 'T00:00:00').toLocaleDateString('uk-UA')] = {off: Math.min(24, d.off_hours)};
     });
 
     const labels = Object.keys(map);
@@ -36,5 +32,5 @@ function renderChart(outages, sIso, eIso) {
 
 function toggleChartView() {
     AppState.hideGreenLayer = !AppState.hideGreenLayer;
-    renderChart(AppState.lastOutages, document.getElementById('startDate').value, document.getElementById('endDate').value);
+    renderChart(AppState.lastDaily);
 }
@@ -1,6 +1,12 @@
 const AppState = {
     chartInstance: null,
     hideGreenLayer: false,
-    lastOutages: [],
+    outages: {query: null, cursor: null, gen: 0, loading: false},
+    // Для живих оновлень: кількість відключень у діапазоні і до якої миті (epoch, с)
+    // активне відключення вже враховане в lastDaily
+    live: {events: 0, offCountedTo: null},
+    lastDaily: [],
+    deviceId: null,
+    stream: null,
     projectStart: "2026-01-26"
 };
@@ -5,15 +5,10 @@ function hoursToHM(v) {
     return `${h}г ${m}хв`;
 }
 
-function updateUI(data) {
-    const d = new Date(data.last_update);
-    document.getElementById('lastUpdate').innerText = !isNaN(d.getTime()) 
-        ? d.toLocaleDateString('uk-UA') + ' о ' + d.toLocaleTimeString('uk-UA', {hour:'2-digit', minute:'2-digit'})
-        : data.last_update;
-
+function setStatusBadge(isOnline) {
     const sb = document.getElementById('statusBadge');
     const dot = sb.querySelector('.dot');
-    if(data.is_online) {
+    if(isOnline) {
         sb.className = 'status-badge status-online';
         dot.className = 'dot bg-green';
         document.getElementById('statusText').textContent = "Світло Є";
@@ -22,6 +17,15 @@ function updateUI(data) {
         dot.className = 'dot bg-red';
         document.getElementById('statusText').textContent = "Світла НЕМАЄ";
     }
+}
+
+function updateUI(data) {
+    const d = new Date(data.last_update);
+    document.getElementById('lastUpdate').innerText = !isNaN(d.getTime()) 
+        ? d.toLocaleDateString('uk-UA') + ' о ' + d.toLocaleTimeString('uk-UA', {hour:'2-digit', minute:'2-digit'})
+        : data.last_update;
+
+    setStatusBadge(data.is_online);
 
     document.getElementById('valOnPercent').innerText = data.stats.on_percent + '%';
     document.getElementById('valOnHours').innerText = hoursToHM(data.stats.on_hours);
@@ -31,24 +35,43 @@ function updateUI(data) {
     document.getElementById('valAvg').innerText = data.stats.avg_duration;
     document.getElementById('valRange').innerText = data.meta.display_range;
 
+    renderChart(data.daily);
+}
+
+function renderOutages(items, append) {
     const list = document.getElementById('eventsList');
-    list.innerHTML = '';
-    data.outages.forEach(ev => {
-        const s = new Date(ev.start);
-        const dur = hoursToHM(ev.duration_min/60);
-        list.innerHTML += `
-            <div class="list-item ${ev.is_active ? 'active-outage' : ''}">
-                <div class="list-icon ${ev.is_active ? 'pulse' : ''}" style="background:${ev.is_active ? 'var(--danger)' : 'rgba(239,68,68,0.1)'};color:${ev.is_active ? 'white' : 'var(--danger)'}">
-                    <span class="material-icons-round">${ev.is_active ? 'bolt' : 'power_off'}</span>
-                </div>
-                <div class="list-content">
-                    <div class="list-time">${s.toLocaleTimeString('uk-UA',{hour:'2-digit',minute:'2-digit'})} — ${ev.is_active ? 'Зараз' : new Date(ev.end).toLocaleTimeString('uk-UA',{hour:'2-digit',minute:'2-digit'})}</div>
-                    <div class="list-date">${s.toLocaleDateString('uk-UA')}</div>
-                </div>
-                <div class="list-badge">${dur}</div>
-            </div>`;
-    });
-    renderChart(data.outages, document.getElementById('startDate').value, document.getElementById('endDate').value);
+    if (!append) list.innerHTML = '';
+    list.insertAdjacentHTML('beforeend', items.map(outageHtml).join(''));
+}
+
+function outageHtml(ev) {
+    const s = new Date(ev.start);
+    const dur = hoursToHM(ev.duration_min/60);
+    return `
+        <div class="list-item ${ev.is_active ? 'active-outage' : ''}">
+            <div class="list-icon ${ev.is_active ? 'pulse' : ''}" style="background:${ev.is_active ? 'var(--danger)' : 'rgba(239,68,68,0.1)'};color:${ev.is_active ? 'white' : 'var(--danger)'}">
+                <span class="material-icons-round">${ev.is_active ? 'bolt' : 'power_off'}</span>
+            </div>
+            <div class="list-content">
+                <div class="list-time">${s.toLocaleTimeString('uk-UA',{hour:'2-digit',minute:'2-digit'})} — ${ev.is_active ? 'Зараз' : new Date(ev.end).toLocaleTimeString('uk-UA',{hour:'2-digit',minute:'2-digit'})}</div>
+                <div class="list-date">${s.toLocaleDateString('uk-UA')}</div>
+            </div>
+            <div class="list-badge">${dur}</div>
+        </div>`;
+}
+
+// Нескінченна прокрутка: коли низ списку стає видно - наступна сторінка
+let outagesObserver = null;
+function watchOutagesEnd() {
+    const end = document.getElementById('eventsEnd');
+    if (!outagesObserver) {
+        outagesObserver = new IntersectionObserver(entries => {
+            if (entries.some(e => e.isIntersecting)) loadOutages();
+        }, {rootMargin: '300px'});
+    }
+    // Повторне observe одразу перевіряє видимість - коротка сторінка не заповнила екран
+    outagesObserver.unobserve(end);
+    outagesObserver.observe(end);
 }
 
 function quickFilter(days, btn) {
@@ -68,6 +91,94 @@ function quickFilter(days, btn) {
     loadData(`start=${sStr}&end=${eStr}`);
 }
 
+function selectDevice(id) {
+    AppState.deviceId = id;
+    customDateLoad();
+    connectStream();
+}
+
+// === LIVE (SSE) ===
+// Події змінюють сторінку на місці: статус, список, стовпчик доби і підсумки.
+// Повне перечитування - лише на resync (пропущені події вже не в буфері сервера)
+function connectStream() {
+    if (AppState.stream) AppState.stream.close();
+    const device = AppState.deviceId ? `?device=${encodeURIComponent(AppState.deviceId)}` : '';
+    const es = new EventSource(`api/stream${device}`);
+    es.addEventListener('status', e => {
+        const ev = JSON.parse(e.data);
+        setStatusBadge(ev.is_online);
+        const d = new Date();
+        document.getElementById('lastUpdate').innerText = d.toLocaleDateString('uk-UA') + ' о ' + d.toLocaleTimeString('uk-UA', {hour:'2-digit', minute:'2-digit'});
+        if (ev.change === 'outage' && rangeIsLive()) {
+            const list = document.getElementById('eventsList');
+            list.querySelector('.active-outage')?.remove();
+            list.insertAdjacentHTML('afterbegin', outageHtml({start: new Date(ev.since * 1000).toISOString(), end: null,
+                duration_min: Math.max(0, Date.now() / 1000 - ev.since) / 60, is_active: true}));
+            AppState.live.events++;
+            AppState.live.offCountedTo = ev.since;
+            updateTotals();
+        }
+    });
+    es.addEventListener('outage_closed', e => {
+        const ev = JSON.parse(e.data);
+        if (!rangeIsLive()) return;
+        const list = document.getElementById('eventsList');
+        const active = list.querySelector('.active-outage');
+        // Активне вже в лічильнику - воно просто стає завершеним
+        if (active) active.remove();
+        else AppState.live.events++;
+        list.insertAdjacentHTML('afterbegin', outageHtml({start: new Date(ev.start * 1000).toISOString(),
+            end: new Date(ev.end * 1000).toISOString(), duration_min: ev.duration_min, is_active: false}));
+        addOffTime(Math.max(ev.start, AppState.live.offCountedTo ?? ev.start), ev.end);
+        AppState.live.offCountedTo = null;
+        updateTotals();
+        renderChart(AppState.lastDaily);
+    });
+    es.addEventListener('resync', () => customDateLoad());
+    AppState.stream = es;
+}
+
+function dayKey(d) {
+    return `${d.getFullYear()}-${String(d.getMonth() + 1).padStart(2, '0')}-${String(d.getDate()).padStart(2, '0')}`;
+}
+
+// Події живі лише для діапазону, що включає сьогодні
+function rangeIsLive() {
+    return document.getElementById('endDate').value >= dayKey(new Date());
+}
+
+// Час без світла [a, b] (epoch, с) - у стовпчики діб, як day_pieces() на сервері
+function addOffTime(a, b) {
+    const byDay = Object.fromEntries(AppState.lastDaily.map(d => [d.day, d]));
+    for (let t = a; t < b; ) {
+        const d = new Date(t * 1000);
+        const next = new Date(d.getFullYear(), d.getMonth(), d.getDate() + 1).getTime() / 1000;
+        const day = byDay[dayKey(d)];
+        if (day) day.off_hours += (Math.min(b, next) - t) / 3600;
+        t = next;
+    }
+}
+
+// Картки підсумків з lastDaily - тими ж формулами, що build_stats()
+function updateTotals() {
+    const total = AppState.lastDaily.length * 24 || 1;
+    const off = AppState.lastDaily.reduce((sum, d) => sum + d.off_hours, 0);
+    const offPercent = Math.min(100, off / total * 100);
+    const events = AppState.live.events;
+    document.getElementById('valOnPercent').innerText = Math.round((100 - offPercent) * 10) / 10 + '%';
+    document.getElementById('valOffPercent').innerText = Math.round(offPercent * 10) / 10 + '%';
+    document.getElementById('valOnHours').innerText = hoursToHM(Math.round((total - off) * 10) / 10);
+    document.getElementById('valOffHours').innerText = hoursToHM(Math.round(off * 10) / 10);
+    document.getElementById('valEvents').innerText = events;
+    document.getElementById('valAvg').innerText = events ? fmtDuration(off * 3600 / events) : '0';
+}
+
+// Як fmt() на сервері
+function fmtDuration(sec) {
+    const m = Math.floor(Math.max(0, sec) / 60), h = Math.floor(m / 60);
+    return h ? `${h}г ${m % 60}хв` : `${m}хв`;
+}
+
 function customDateLoad() {
     const s = document.getElementById('startDate').value;
     const e = document.getElementById('endDate').value;
@@ -0,0 +1,362 @@
+# Компактний журнал сирих heartbeat-ів: append-only сегменти на добу (UTC) на пристрій
+# плюс агрегати 1 хв / 1 год. Запит за діапазон читає лише файли, що в нього потрапляють.
+#
+# Сегмент <root>/<device>/<YYYYMMDD>-<writer>.seg:
+#   b"HBS1" varint(base_ts)
+#   запис: varint(dts << 4 | прапорці) [zigzag(uptime - очікуваний)] [boot] [reason] [ip]
+#   рядок: varint(i) - індекс у таблиці сегмента; i == розмір таблиці -> новий: varint(len) + utf-8
+# Uptime передбачається як попередній + dts, рядки пишуться лише при зміні, тож звичайний
+# пінг - 1-2 байти. Обрізаний хвіст (падіння посеред запису) відкидається при читанні
+# разом з рядками, які він встиг додати в таблицю.
+#
+# Агрегати - записи фіксованого розміру: m1-<YYYYMM>-<writer>.agg, h1-<YYYY>-<writer>.agg.
+# Після рестарту посеред хвилини/години той самий бакет може бути записаний двічі -
+# читач їх зливає. <writer> - окремий файл на процес (кілька воркерів у WORKER_MODE=shared).
+
+import heapq
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+logger = logging.getLogger("PowerMonitor")
+
+MAGIC = b"HBS1"
+F_UPTIME, F_BOOT, F_REASON, F_IP = 1, 2, 4, 8
+
+# bucket, samples, resets, ip_changes, max_gap
+MINUTE = struct.Struct("<IHHHH")
+HOUR = struct.Struct("<IIHHI")
+RESOLUTIONS = {"1m": (60, MINUTE, "m1", "%Y%m"), "1h": (3600, HOUR, "h1", "%Y")}
+
+SAFE_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+def write_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def unzigzag(n):
+    return n // 2 if not n & 1 else -(n + 1) // 2
+
+def safe_name(device_id):
+    # device_id приходить від пристрою - у шлях лише безпечні символи
+    return device_id if SAFE_NAME.match(device_id) and device_id not in (".", "..") else \
+        "x-" + device_id.encode().hex()[:120]
+
+def utc_label(ts, fmt):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime(fmt)
+
+class SegmentState:
+    # Стан кодека; однаковий для запису і читання
+    __slots__ = ("ts", "uptime", "boot", "reason", "ip", "table", "index")
+
+    def __init__(self, base_ts):
+        self.ts = base_ts
+        self.uptime = 0
+        self.boot = self.reason = self.ip = ""
+        self.table = []
+        self.index = {}
+
+def clean_string(value):
+    # Самотні сурогати з JSON не кодуються в utf-8 - замінюємо до кодування запису
+    return value.encode("utf-8", "replace").decode()
+
+def truncate_table(state, n):
+    # Рядки незавершеного запису не мають лишатися в таблиці: вона має збігатися з файлом
+    for value in state.table[n:]:
+        if state.index.get(value, -1) >= n:
+            del state.index[value]
+    del state.table[n:]
+
+def encode_string(buf, state, value):
+    i = state.index.get(value)
+    if i is not None:
+        write_varint(buf, i)
+        return
+    raw = value.encode()
+    state.index[value] = len(state.table)
+    write_varint(buf, len(state.table))
+    state.table.append(value)
+    write_varint(buf, len(raw))
+    buf.extend(raw)
+
+def decode_string(data, pos, state):
+    i, pos = read_varint(data, pos)
+    if i < len(state.table):
+        return state.table[i], pos
+    if i > len(state.table):
+        raise IndexError("bad string index")
+    n, pos = read_varint(data, pos)
+    if pos + n > len(data):
+        raise IndexError("truncated string")
+    value = bytes(data[pos:pos + n]).decode()
+    state.index[value] = len(state.table)
+    state.table.append(value)
+    return value, pos + n
+
+def encode_sample(state, ts, uptime, boot, reason, ip):
+    # Запис кодується цілком у буфер; стан змінюється лише після успіху
+    boot, reason, ip = clean_string(boot), clean_string(reason), clean_string(ip)
+    buf = bytearray()
+    ts = max(ts, state.ts)   # годинник назад - не ламаємо дельти
+    dts = ts - state.ts
+    residual = uptime - (state.uptime + dts)
+    flags = ((F_UPTIME if residual else 0) | (F_BOOT if boot != state.boot else 0)
+             | (F_REASON if reason != state.reason else 0) | (F_IP if ip != state.ip else 0))
+    mark = len(state.table)
+    try:
+        write_varint(buf, dts << 4 | flags)
+        if residual:
+            write_varint(buf, zigzag(residual))
+        if flags & F_BOOT:
+            encode_string(buf, state, boot)
+        if flags & F_REASON:
+            encode_string(buf, state, reason)
+        if flags & F_IP:
+            encode_string(buf, state, ip)
+    except BaseException:
+        truncate_table(state, mark)
+        raise
+    state.ts, state.uptime, state.boot, state.reason, state.ip = ts, uptime, boot, reason, ip
+    return bytes(buf), flags
+
+def decode_segment(data):
+    # -> (зразки [(ts, uptime, boot, reason, ip, прапорці)], довжина валідної частини, стан)
+    if len(data) < len(MAGIC) + 1 or data[:len(MAGIC)] != MAGIC:
+        return [], 0, None
+    base_ts, pos = read_varint(data, len(MAGIC))
+    state = SegmentState(base_ts)
+    samples, valid = [], pos
+    while pos < len(data):
+        mark = len(state.table)
+        try:
+            head, pos = read_varint(data, pos)
+            dts, flags = head >> 4, head & 0xF
+            uptime = state.uptime + dts
+            if flags & F_UPTIME:
+                residual, pos = read_varint(data, pos)
+                uptime += unzigzag(residual)
+            boot, reason, ip = state.boot, state.reason, state.ip
+            if flags & F_BOOT:
+                boot, pos = decode_string(data, pos, state)
+            if flags & F_REASON:
+                reason, pos = decode_string(data, pos, state)
+            if flags & F_IP:
+                ip, pos = decode_string(data, pos, state)
+        except (IndexError, UnicodeDecodeError):
+            truncate_table(state, mark)
+            break
+        state.ts += dts
+        state.uptime, state.boot, state.reason, state.ip = uptime, boot, reason, ip
+        samples.append((state.ts, uptime, boot, reason, ip, flags))
+        valid = pos
+    return samples, valid, state
+
+class Bucket:
+    __slots__ = ("key", "samples", "resets", "ip_changes", "max_gap")
+
+    def __init__(self, key):
+        self.key = key
+        self.samples = self.resets = self.ip_changes = self.max_gap = 0
+
+class DeviceLog:
+    # Сегмент поточної доби + незакриті бакети агрегатів одного пристрою.
+    # Файл відкривається лише на час flush(): пристроїв може бути більше, ніж дескрипторів
+    def __init__(self, root, device_id, writer):
+        self.dir = os.path.join(root, safe_name(device_id))
+        self.writer = writer
+        self.day = None
+        self.path = None
+        self.size = 0       # довжина валідної частини файлу
+        self.buf = bytearray()   # закодовані, ще не записані записи
+        self.state = None
+        self.buckets = {}   # resolution -> Bucket
+        self.last = None    # (ts, boot, ip) попереднього зразка
+
+    def open_day(self, ts):
+        self.flush()
+        os.makedirs(self.dir, exist_ok=True)
+        self.day = ts // 86400
+        self.path = os.path.join(self.dir, f"{utc_label(ts, '%Y%m%d')}-{self.writer}.seg")
+        state, valid = None, 0
+        if os.path.exists(self.path):
+            # Дописуємо після рестарту: відновлюємо стан кодека; битий хвіст перезапише flush()
+            with open(self.path, "rb") as f:
+                _, valid, state = decode_segment(f.read())
+        self.size = valid if state else 0
+        if not state:
+            state = SegmentState(self.day * 86400)
+            write_varint(self.buf, state.ts)
+            self.buf[:0] = MAGIC
+        self.state = state
+
+    def append(self, ts, uptime, boot, reason, ip):
+        if self.state is None or ts // 86400 != self.day:
+            self.open_day(ts)
+        data, _ = encode_sample(self.state, ts, uptime, boot, reason, ip)
+        self.buf.extend(data)
+        # Зміни відносно попереднього зразка пристрою (а не сегмента) - для агрегатів
+        gap = ts - self.last[0] if self.last else 0
+        reset = bool(self.last and boot != self.last[1] and self.last[1])
+        ip_change = bool(self.last and ip != self.last[2] and self.last[2])
+        self.last = (ts, boot, ip)
+        closed = []
+        for resolution, (size, _, _, _) in RESOLUTIONS.items():
+            key = ts // size * size
+            bucket = self.buckets.get(resolution)
+            if bucket is None or bucket.key != key:
+                if bucket is not None:
+                    closed.append((resolution, bucket))
+                bucket = self.buckets[resolution] = Bucket(key)
+            bucket.samples += 1
+            bucket.resets += reset
+            bucket.ip_changes += ip_change
+            bucket.max_gap = max(bucket.max_gap, gap)
+        return closed
+
+    def expire(self, now, force=False):
+        # Бакети, час яких минув, хоч нових зразків і не було
+        closed = []
+        for resolution, bucket in list(self.buckets.items()):
+            size = RESOLUTIONS[resolution][0]
+            if force or now >= bucket.key + size:
+                closed.append((resolution, bucket))
+                del self.buckets[resolution]
+        return closed
+
+    def write_buckets(self, closed):
+        for resolution, bucket in closed:
+            size, record, prefix, fmt = RESOLUTIONS[resolution]
+            path = os.path.join(self.dir, f"{prefix}-{utc_label(bucket.key, fmt)}-{self.writer}.agg")
+            limit = 0xFFFF if record is MINUTE else 0xFFFFFFFF
+            with open(path, "ab") as f:
+                f.write(record.pack(bucket.key // size, min(bucket.samples, limit), min(bucket.resets, 0xFFFF),
+                                    min(bucket.ip_changes, 0xFFFF), min(bucket.max_gap, limit)))
+
+    def flush(self):
+        # Пишемо з кінця валідної частини: невдалий запис лишає буфер і перезаписується наступним
+        if not self.buf:
+            return
+        with open(self.path, "r+b" if self.size else "wb") as f:
+            f.seek(self.size)
+            f.write(self.buf)
+            f.truncate()
+        self.size += len(self.buf)
+        self.buf.clear()
+
+class HeartbeatStore(threading.Thread):
+    # append() - лише deque.append на гарячому шляху; кодування і диск - у цьому потоці
+    def __init__(self, root, writer="main", interval=1.0):
+        super().__init__(daemon=True, name="HeartbeatStoreThread")
+        self.root = root
+        self.writer = writer
+        self.interval = interval
+        self.pending = deque()
+        self.logs = {}
+        self.flush_lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def append(self, device_id, ts, uptime, boot_id, reason, ip):
+        # Поля з payload пристрою - будь-якого JSON-типу; у сегмент пишуться лише рядки
+        self.pending.append((device_id, int(ts), int(uptime or 0), str(boot_id or ""), str(reason or ""), str(ip or "")))
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try: self.flush()
+            except Exception as e: logger.error(f"Heartbeat store flush failed: {e}")
+
+    def stop(self):
+        self.stopping.set()
+        self.join(timeout=5)
+        self.flush(final=True)
+
+    def flush(self, final=False):
+        with self.flush_lock:
+            while self.pending:
+                device_id, ts, uptime, boot, reason, ip = self.pending[0]
+                log = self.logs.get(device_id)
+                if log is None:
+                    log = self.logs[device_id] = DeviceLog(self.root, device_id, self.writer)
+                # Зразок знімаємо з черги лише після кодування: збій диска - повтор наступного разу
+                closed = log.append(ts, uptime, boot, reason, ip)
+                self.pending.popleft()
+                log.write_buckets(closed)
+            now = time.time()
+            for log in self.logs.values():
+                log.write_buckets(log.expire(now, force=final))
+                log.flush()
+
+    # --- читання ---
+
+    def files(self, device_id, prefix, labels):
+        path = os.path.join(self.root, safe_name(device_id))
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(path, n) for n in names
+                      if n.startswith(prefix) and n.split("-")[-2] in labels)
+
+    def samples(self, device_id, start_ts, end_ts):
+        # Сирі зразки [start_ts, end_ts] з усіх writer-ів, по порядку часу
+        days = range(int(start_ts) // 86400, int(end_ts) // 86400 + 1)
+        labels = {utc_label(d * 86400, "%Y%m%d") for d in days}
+        streams = []
+        for path in self.files(device_id, "", labels):
+            if not path.endswith(".seg"):
+                continue
+            with open(path, "rb") as f:
+                samples, _, _ = decode_segment(f.read())
+            streams.append([s for s in samples if start_ts <= s[0] <= end_ts])
+        return list(heapq.merge(*streams))
+
+    def aggregates(self, device_id, resolution, start_ts, end_ts):
+        size, record, prefix, fmt = RESOLUTIONS[resolution]
+        labels, t = set(), int(start_ts) // size * size
+        # Мітки файлів-партицій, що покривають діапазон
+        step = 86400 if resolution == "1m" else 86400 * 28
+        while t <= end_ts + step:
+            labels.add(utc_label(t, fmt))
+            t += step
+        merged = {}
+        for path in self.files(device_id, prefix + "-", labels):
+            with open(path, "rb") as f:
+                data = f.read()
+            for key, samples, resets, ip_changes, max_gap in record.iter_unpack(data[:len(data) // record.size * record.size]):
+                ts = key * size
+                if not start_ts <= ts <= end_ts:
+                    continue
+                b = merged.get(ts)
+                if b is None:
+                    merged[ts] = [samples, resets, ip_changes, max_gap]
+                else:
+                    b[0] += samples; b[1] += resets; b[2] += ip_changes; b[3] = max(b[3], max_gap)
+        # Незакриті бакети цього процесу - щоб поточна хвилина/година теж була видна
+        with self.flush_lock:
+            log = self.logs.get(device_id)
+            bucket = log.buckets.get(resolution) if log else None
+            if bucket and start_ts <= bucket.key <= end_ts:
+                b = merged.setdefault(bucket.key, [0, 0, 0, 0])
+                b[0] += bucket.samples; b[1] += bucket.resets; b[2] += bucket.ip_changes
+                b[3] = max(b[3], bucket.max_gap)
+        return [{"ts": ts, "samples": b[0], "resets": b[1], "ip_changes": b[2], "max_gap": b[3]}
+                for ts, b in sorted(merged.items())]